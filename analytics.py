@@ -0,0 +1,222 @@
+import os
+import json
+from typing import Dict, List, Optional
+import numpy as np
+from data_model import CATEGORY_LIST_REGULAR, TAG_LIST_REGULAR, CURRENCY_LIST_REGULAR
+
+# Enum fields stored as int8 codes: the position of the value in its list, -1 for anything else
+ENUM_FIELDS = {
+    'category': CATEGORY_LIST_REGULAR,
+    'tag': TAG_LIST_REGULAR,
+    'currency': CURRENCY_LIST_REGULAR,
+}
+
+# Value of one unit of each currency in USD, used when rates.json is missing
+DEFAULT_RATES = {'USD': 1.0, 'EUR': 1.08, 'ILS': 0.27}
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+
+def load_rates(rates_file: str) -> Dict[str, float]:
+    '''Read {currency: value in a common base currency} from rates_file, falling back to DEFAULT_RATES'''
+    rates = dict(DEFAULT_RATES)
+    if os.path.exists(rates_file):
+        with open(rates_file, 'r') as file:
+            rates.update(json.load(file))
+    return rates
+
+
+class RatesFile:
+    '''
+    The rates of load_rates(rates_file), read once and then again only when
+    the file's inode, mtime or size changes, so edits apply without a restart.
+    '''
+
+    def __init__(self, rates_file: str):
+        self.rates_file = rates_file
+        self._signature = None
+        self._rates: Optional[Dict[str, float]] = None
+
+    def _read_signature(self):
+        try:
+            stat_result = os.stat(self.rates_file)
+        except FileNotFoundError:
+            return None
+        return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+    def get(self) -> Dict[str, float]:
+        signature = self._read_signature()
+        if self._rates is None or signature != self._signature:
+            self._rates = load_rates(self.rates_file)
+            self._signature = signature
+        return self._rates
+
+
+class ColumnarExpenses:
+    '''
+    Column projection of the expense table for vectorized analytics: amounts
+    as float64 and the enum fields as int8 codes, in dense NumPy arrays.
+    Deleting moves the last row into the freed slot, so the arrays never
+    have holes. Supports the add(row, expense) / remove(row, expense) /
+    clear() protocol of the repository's maintained indexes.
+    '''
+
+    def __init__(self, capacity: int = 1024):
+        self._capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self._size = 0
+        self._slots: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._amounts = np.zeros(self._capacity, dtype=np.float64)
+        self._codes = {field: np.full(self._capacity, -1, dtype=np.int8) for field in ENUM_FIELDS}
+        self._code_maps = {field: {value: code for code, value in enumerate(values)}
+                           for field, values in ENUM_FIELDS.items()}
+
+    @classmethod
+    def from_expenses(cls, expenses) -> 'ColumnarExpenses':
+        expenses = list(expenses)
+        columns = cls(capacity=max(len(expenses), 1))
+        for expense in expenses:
+            columns.add(None, expense)
+        return columns
+
+    def __len__(self) -> int:
+        return self._size
+
+    def snapshot(self) -> 'ColumnarExpenses':
+        '''
+        Copy of the amounts and codes, for build_report to read on another
+        thread while these columns keep changing. It has no ids, so it cannot
+        be changed itself.
+        '''
+        columns = ColumnarExpenses(capacity=max(self._size, 1))
+        columns._size = self._size
+        columns._amounts[:self._size] = self.amounts
+        for field, codes in columns._codes.items():
+            codes[:self._size] = self.codes(field)
+        return columns
+
+    def _grow(self):
+        self._capacity *= 2
+        self._amounts = np.resize(self._amounts, self._capacity)
+        for field, codes in self._codes.items():
+            self._codes[field] = np.resize(codes, self._capacity)
+
+    def add(self, row: Optional[int], expense: dict):
+        slot = self._slots.get(expense['id'])
+        if slot is None:
+            if self._size == self._capacity:
+                self._grow()
+            slot = self._size
+            self._size += 1
+            self._slots[expense['id']] = slot
+            self._ids.append(expense['id'])
+        self._amounts[slot] = expense.get('amount') or 0.0
+        for field, codes in self._codes.items():
+            codes[slot] = self._code_maps[field].get(expense.get(field), -1)
+
+    def remove(self, row: Optional[int], expense: dict):
+        slot = self._slots.pop(expense['id'], None)
+        if slot is None:
+            return
+        last = self._size - 1
+        if slot != last:
+            moved_id = self._ids[last]
+            self._ids[slot] = moved_id
+            self._slots[moved_id] = slot
+            self._amounts[slot] = self._amounts[last]
+            for codes in self._codes.values():
+                codes[slot] = codes[last]
+        self._ids.pop()
+        self._size = last
+
+    @property
+    def amounts(self) -> np.ndarray:
+        return self._amounts[:self._size]
+
+    def codes(self, field: str) -> np.ndarray:
+        return self._codes[field][:self._size]
+
+
+def _group_rows(keys: np.ndarray, values: np.ndarray, group_by: List[str], strides: List[int]) -> List[dict]:
+    '''count/sum/mean/min/max of values per distinct key, computed on the sorted keys with reduceat'''
+    if not len(values):
+        return []
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    sorted_values = values[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    counts = np.diff(np.append(starts, len(sorted_keys)))
+    sums = np.add.reduceat(sorted_values, starts)
+    mins = np.minimum.reduceat(sorted_values, starts)
+    maxs = np.maximum.reduceat(sorted_values, starts)
+
+    rows = []
+    for key, count, total, minimum, maximum in zip(sorted_keys[starts], counts, sums, mins, maxs):
+        row = {}
+        for field, stride in zip(group_by, strides):
+            code = int(key // stride) % (len(ENUM_FIELDS[field]) + 1) - 1
+            row[field] = ENUM_FIELDS[field][code] if code >= 0 else None
+        row.update(count=int(count), sum=float(total), mean=float(total / count), min=float(minimum), max=float(maximum))
+        rows.append(row)
+    return rows
+
+
+def build_report(columns: ColumnarExpenses, rates: Dict[str, float], reporting_currency: str = 'USD',
+                 category: Optional[str] = None, tag: Optional[str] = None, currency: Optional[str] = None,
+                 group_by: Optional[List[str]] = None, percentiles=DEFAULT_PERCENTILES, bins: int = 10) -> dict:
+    '''
+    Convert every matching amount into reporting_currency and summarize it:
+    totals, percentiles, a histogram and optional per-group totals. All work
+    is done with array operations over the columns.
+    '''
+    if reporting_currency not in rates:
+        raise ValueError(f"No exchange rate for reporting currency '{reporting_currency}'")
+
+    amounts = columns.amounts
+    currency_codes = columns.codes('currency')
+    mask = np.ones(len(amounts), dtype=bool)
+    for field, value in (('category', category), ('tag', tag), ('currency', currency)):
+        if value:
+            code = ENUM_FIELDS[field].index(value) if value in ENUM_FIELDS[field] else -2
+            mask &= columns.codes(field) == code
+
+    # Rate of each currency code into the reporting currency, unknown currencies (code -1) become NaN
+    rate_vector = np.array([rates.get(code, np.nan) for code in CURRENCY_LIST_REGULAR] + [np.nan], dtype=np.float64)
+    rate_vector /= rates[reporting_currency]
+    converted = amounts[mask] * rate_vector[currency_codes[mask]]
+    known = ~np.isnan(converted)
+    converted = converted[known]
+
+    report = {
+        'reporting_currency': reporting_currency,
+        'count': int(len(converted)),
+        'unconverted': int((~known).sum()),
+        'sum': float(converted.sum()),
+        'mean': None,
+        'min': None,
+        'max': None,
+        'percentiles': {f'p{p}': None for p in percentiles},
+        'histogram': {'edges': [], 'counts': []},
+    }
+    if len(converted):
+        report.update(mean=float(converted.mean()), min=float(converted.min()), max=float(converted.max()))
+        report['percentiles'] = {f'p{p}': float(value) for p, value in zip(percentiles, np.percentile(converted, percentiles))}
+        counts, edges = np.histogram(converted, bins=bins)
+        report['histogram'] = {'edges': edges.tolist(), 'counts': counts.tolist()}
+
+    if group_by:
+        group_by = [field for field in ENUM_FIELDS if field in group_by]
+        keys = np.zeros(len(converted), dtype=np.int64)
+        strides = []
+        stride = 1
+        for field in reversed(group_by):
+            # Shift codes by one so -1 (unknown) gets its own group
+            keys += (columns.codes(field)[mask][known].astype(np.int64) + 1) * stride
+            strides.insert(0, stride)
+            stride *= len(ENUM_FIELDS[field]) + 1
+        report['groups'] = _group_rows(keys, converted, group_by, strides)
+
+    return report
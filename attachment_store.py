@@ -0,0 +1,564 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+import contextlib
+from collections import Counter
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Set, Tuple
+from file_storage import write_json_atomic
+from store_lock import StoreLock
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Seconds the removal worker waits before looking at a shared removal queue again, other processes append to it too
+PURGE_POLL_SECONDS = 1.0
+# The removal worker unlinks a slice of this many seconds' worth of bytes at a time, then sleeps off the rest
+PURGE_SLICE_SECONDS = 0.1
+# Most queue entries claimed per slice, so the lock is released between slices even without a rate limit
+PURGE_SLICE_ENTRIES = 256
+# refs.journal is folded into refs.json once it holds at least this many entries, and more than there are refs
+REFS_COMPACT_MIN_ENTRIES = 1000
+# The sweeper leaves upload temp files alone until they are this old, they may belong to an upload in progress
+STALE_UPLOAD_SECONDS = 3600
+
+
+class AttachmentFile(NamedTuple):
+    '''Where an attachment's content lives, its size and mtime, and its content hash (None for legacy files)'''
+    path: str
+    stat: os.stat_result
+    content_hash: Optional[str]
+
+
+class AttachmentStore:
+    '''
+    Content-addressed storage for attachment files.
+
+    Every distinct file content is stored once as attachments/blobs/<hh>/<sha256>.
+    refs.json maps "<expense_id>/<file_name>" to the hash of its content, and a
+    blob is no longer used once its last reference is removed. Changes to the
+    references are appended to refs.journal, one {key, hash} line each (hash
+    null for a dropped reference), and folded into refs.json once the journal
+    holds more entries than there are references. Files written by
+    older versions under attachments/<expense_id>/<file_name> are still served
+    and removed.
+
+    Removing attachments only changes the references and appends the files no longer
+    used to the removal queue, removals.jsonl, so deletes do not wait on the
+    disk. A background thread unlinks queued files, at most purge_bytes_per_s
+    on average (0 for no limit), and skips blobs referenced again since. It
+    works through the queue in slices: under the lock it claims the next
+    entries after the offset recorded in removals.offset, renaming their blobs
+    aside so no upload reuses them, then unlinks them without the lock. The
+    queue is emptied once every entry is consumed. It is written before
+    the references, and sweep() finds whatever a crash left behind.
+
+    Blobs never change once written, so their stat results are cached and
+    locate() costs two dict lookups after the first download of a blob.
+
+    With shared=True several processes use the store. References are changed
+    under a StoreLock on attachments/refs.lock, after replaying what other
+    processes appended to refs.journal, and locate() replays it too (or
+    re-reads both files once refs.json was compacted).
+
+    All other methods block on the disk and are meant to run on an I/O thread.
+    '''
+
+    def __init__(self, attachments_dir: str, shared: bool = False, purge_bytes_per_s: float = 0):
+        self.attachments_dir = attachments_dir
+        self.blobs_dir = os.path.join(attachments_dir, 'blobs')
+        self.refs_file = os.path.join(attachments_dir, 'refs.json')
+        self.refs_journal_file = os.path.join(attachments_dir, 'refs.journal')
+        self.removals_file = os.path.join(attachments_dir, 'removals.jsonl')
+        # {offset, size, pending}: the queue is consumed up to offset, and held pending entries from there to size
+        self.removals_offset_file = os.path.join(attachments_dir, 'removals.offset')
+        self.purge_bytes_per_s = purge_bytes_per_s
+        self._lock = threading.Lock()
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self._store_lock = StoreLock(os.path.join(attachments_dir, 'refs.lock')) if shared else None
+        self._blob_stats: Dict[str, os.stat_result] = {}
+        # Reference changes not yet appended to refs.journal
+        self._ref_changes: List[Tuple[str, Optional[str]]] = []
+        # Created up front, so the journal other processes see is the same file from the start
+        open(self.refs_journal_file, 'a').close()
+        self._load_refs(locked=True)
+        # References to attachments no expense lists, found by the last sweep
+        self._suspect_refs: Set[str] = set()
+        # Files this process claimed from the queue and is unlinking, sweep() leaves them alone
+        self._claimed: Set[str] = set()
+        self.pending_removals = 0
+        self.purged_files = 0
+        self.purged_bytes = 0
+        self.swept_files = 0
+        self.swept_bytes = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        # Set once so files queued before a restart are removed too
+        self._wake.set()
+        self._purger = threading.Thread(target=self._run_purger, name='attachment-purger', daemon=True)
+        self._purger.start()
+
+    def _read_refs_signature(self):
+        try:
+            stat_result = os.stat(self.refs_file)
+        except FileNotFoundError:
+            return None
+        return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+    def _journal_identity(self) -> Tuple[Optional[int], int]:
+        try:
+            stat_result = os.stat(self.refs_journal_file)
+        except FileNotFoundError:
+            return None, 0
+        return stat_result.st_ino, stat_result.st_size
+
+    def _load_refs(self, locked: bool = False):
+        '''Read refs.json and replay refs.journal over it. With locked, a torn journal tail is truncated.'''
+        while True:
+            signature = self._read_refs_signature()
+            refs: Dict[str, str] = {}
+            if signature is not None:
+                with open(self.refs_file, 'r') as file:
+                    refs = json.load(file)
+            self._refs = refs
+            self._refcounts = Counter(refs.values())
+            self._refs_journal_inode, _ = self._journal_identity()
+            self._refs_journal_entries = 0
+            self._refs_journal_size = 0
+            self._replay_refs_journal(locked)
+            # Compacted by another process in between, the journal read may not belong to this refs.json
+            if self._read_refs_signature() == signature:
+                break
+        self._refs_signature = signature
+        # Another process may have unlinked blobs nobody references any more
+        self._blob_stats = {digest: stat_result for digest, stat_result in self._blob_stats.items()
+                            if digest in self._refcounts}
+
+    def _replay_refs_journal(self, locked: bool):
+        '''Apply the complete journal lines after the part already replayed'''
+        try:
+            with open(self.refs_journal_file, 'rb') as file:
+                file.seek(self._refs_journal_size)
+                appended = file.read()
+        except FileNotFoundError:
+            return
+        valid_size = self._refs_journal_size
+        for line in appended.splitlines(keepends=True):
+            try:
+                record = json.loads(line) if line.endswith(b'\n') else None
+            except ValueError:
+                record = None
+            if record is None:
+                if locked:
+                    # Torn write from a crash, nobody appends while the lock is held
+                    logger.warning("Discarding corrupt reference journal tail at offset %d", valid_size)
+                    with open(self.refs_journal_file, 'rb+') as file:
+                        file.truncate(valid_size)
+                # Otherwise possibly a line still being appended, read again next time
+                break
+            self._apply_ref(record['key'], record['hash'])
+            self._refs_journal_entries += 1
+            valid_size += len(line)
+        self._refs_journal_size = valid_size
+
+    def _refresh_refs(self, locked: bool = False):
+        '''Catch up with the references another process changed'''
+        if self._store_lock is None:
+            return
+        journal_inode, journal_size = self._journal_identity()
+        if self._read_refs_signature() != self._refs_signature or journal_inode != self._refs_journal_inode \
+                or journal_size < self._refs_journal_size:
+            self._load_refs(locked)
+        elif journal_size > self._refs_journal_size:
+            self._replay_refs_journal(locked)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''Hold the thread lock, and the store lock when shared, with the refs up to date'''
+        with self._lock, self._store_lock or contextlib.nullcontext():
+            self._refresh_refs(locked=True)
+            yield
+
+    @staticmethod
+    def _ref_key(expense_id: str, file_name: str) -> str:
+        return f'{expense_id}/{file_name}'
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blobs_dir, digest[:2], digest)
+
+    def _legacy_path(self, expense_id: str, file_name: str) -> str:
+        return os.path.join(self.attachments_dir, expense_id, file_name)
+
+    def save(self, expense_id: str, file_name: str, source: BinaryIO) -> str:
+        '''Stream source to the blob store in fixed-size chunks and reference it from the expense'''
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.blobs_dir, prefix='upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+
+            content_hash = digest.hexdigest()
+            blob_path = self.blob_path(content_hash)
+            with self._locked():
+                # A blob still on disk is reused, even when queued for removal: the queue skips referenced blobs
+                if os.path.exists(blob_path):
+                    os.remove(tmp_path)
+                else:
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    os.replace(tmp_path, blob_path)
+                unused = self._set_ref(self._ref_key(expense_id, file_name), content_hash)
+                if unused is not None:
+                    self._enqueue([{'blob': unused}])
+                self._save_refs()
+            return content_hash
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _set_ref(self, key: str, content_hash: Optional[str]) -> Optional[str]:
+        '''Point key at content_hash (or drop it) and return the hash of a blob that lost its last reference'''
+        self._ref_changes.append((key, content_hash))
+        return self._apply_ref(key, content_hash)
+
+    def _apply_ref(self, key: str, content_hash: Optional[str]) -> Optional[str]:
+        old_hash = self._refs.pop(key, None)
+        if content_hash is not None:
+            self._refs[key] = content_hash
+            self._refcounts[content_hash] += 1
+        if old_hash is not None:
+            self._refcounts[old_hash] -= 1
+            if self._refcounts[old_hash] <= 0:
+                del self._refcounts[old_hash]
+                self._blob_stats.pop(old_hash, None)
+                return old_hash
+        return None
+
+    def _save_refs(self):
+        '''Append the reference changes to refs.journal, compacting it when due. Call with the lock held.'''
+        lines = b''.join(json.dumps({'key': key, 'hash': content_hash}).encode() + b'\n'
+                         for key, content_hash in self._ref_changes)
+        self._ref_changes = []
+        with open(self.refs_journal_file, 'ab') as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        self._refs_journal_inode, _ = self._journal_identity()
+        self._refs_journal_entries += lines.count(b'\n')
+        self._refs_journal_size += len(lines)
+        if self._refs_journal_entries >= REFS_COMPACT_MIN_ENTRIES and self._refs_journal_entries > len(self._refs):
+            self._compact_refs()
+
+    def _compact_refs(self):
+        '''Fold refs.journal into refs.json. Call with the lock held.'''
+        # refs.json first: until the journal is emptied too, replaying all of it is still correct
+        write_json_atomic(self.refs_file, self._refs)
+        with open(self.refs_journal_file, 'rb+') as file:
+            file.truncate(0)
+            os.fsync(file.fileno())
+        self._refs_signature = self._read_refs_signature()
+        self._refs_journal_entries = 0
+        self._refs_journal_size = 0
+        logger.info("Compacted attachment reference journal into %d references", len(self._refs))
+
+    def locate(self, expense_id: str, file_name: str) -> Optional[AttachmentFile]:
+        '''
+        Return the path and stat result of an attachment's content, or None if
+        it is missing. Only stats the disk the first time a blob is asked for
+        (and for every legacy file, and the reference files when shared), so it
+        can run on the event loop.
+        '''
+        # Replaying changes the refs in place, so not while a change holds the lock: it is caught up already
+        if self._lock.acquire(blocking=False):
+            try:
+                self._refresh_refs()
+            finally:
+                self._lock.release()
+        content_hash = self._refs.get(self._ref_key(expense_id, file_name))
+        if content_hash is None:
+            file_path = self._legacy_path(expense_id, file_name)
+            try:
+                return AttachmentFile(file_path, os.stat(file_path), None)
+            except FileNotFoundError:
+                return None
+
+        file_path = self.blob_path(content_hash)
+        stat_result = self._blob_stats.get(content_hash)
+        if stat_result is None:
+            try:
+                stat_result = os.stat(file_path)
+            except FileNotFoundError:
+                return None
+            self._blob_stats[content_hash] = stat_result
+        return AttachmentFile(file_path, stat_result, content_hash)
+
+    def remove(self, expense_id: str, file_names: List[str]):
+        '''Drop the references of an expense's attachments and queue the files nobody else uses for removal'''
+        with self._locked():
+            changed = False
+            removals = []
+            for file_name in file_names:
+                key = self._ref_key(expense_id, file_name)
+                if key in self._refs:
+                    unused = self._set_ref(key, None)
+                    if unused is not None:
+                        removals.append({'blob': unused})
+                    changed = True
+                elif os.path.exists(self._legacy_path(expense_id, file_name)):
+                    removals.append({'file': os.path.join(expense_id, file_name)})
+            self._enqueue(removals)
+            if changed:
+                self._save_refs()
+
+    def _enqueue(self, removals: List[dict]):
+        '''Append entries to the removal queue and wake the worker. Call with the lock held.'''
+        if not removals:
+            return
+        with open(self.removals_file, 'a') as file:
+            file.write(''.join(json.dumps(removal) + '\n' for removal in removals))
+            file.flush()
+            os.fsync(file.fileno())
+        self.pending_removals += len(removals)
+        self._wake.set()
+
+    def _read_queue_marker(self) -> Tuple[int, int, int]:
+        try:
+            with open(self.removals_offset_file, 'r') as file:
+                marker = json.load(file)
+            return marker['offset'], marker['size'], marker['pending']
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0, 0, 0
+
+    def _write_queue_marker(self, offset: int, size: int, pending: int):
+        write_json_atomic(self.removals_offset_file, {'offset': offset, 'size': size, 'pending': pending})
+
+    def _count_entries(self, start: int, end: int) -> int:
+        '''Queue entries (lines) between the byte offsets start and end'''
+        count = 0
+        with open(self.removals_file, 'rb') as file:
+            file.seek(start)
+            while start < end:
+                chunk = file.read(min(CHUNK_SIZE, end - start))
+                if not chunk:
+                    break
+                count += chunk.count(b'\n')
+                start += len(chunk)
+        return count
+
+    def _read_removals(self) -> List[dict]:
+        '''The queue entries not consumed yet'''
+        offset = self._read_queue_marker()[0]
+        try:
+            with open(self.removals_file, 'rb') as file:
+                file.seek(offset)
+                lines = file.readlines()
+        except FileNotFoundError:
+            return []
+        removals = []
+        for line in lines:
+            try:
+                removals.append(json.loads(line))
+            except ValueError:
+                # A line torn by a crash while appending, its files are left to the sweeper
+                continue
+        return removals
+
+    def _claim(self, removal: dict) -> Optional[Tuple[str, int]]:
+        '''
+        Take the file of a queue entry out of use and return its path and size,
+        None if it is in use again or gone. Call with the lock held.
+        '''
+        digest = removal.get('blob')
+        if digest is not None:
+            if digest in self._refcounts:
+                return None
+            # Renamed aside, so an upload of the same content writes a new blob instead of reusing this one
+            file_path = os.path.join(self.blobs_dir, f'purge-{uuid.uuid4().hex}')
+            try:
+                size = os.stat(self.blob_path(digest)).st_size
+                os.rename(self.blob_path(digest), file_path)
+            except FileNotFoundError:
+                return None
+            return file_path, size
+        # Legacy files, upload temp files and blobs left aside by a crash are never used again
+        file_path = os.path.join(self.attachments_dir, removal['file'])
+        try:
+            return file_path, os.stat(file_path).st_size
+        except FileNotFoundError:
+            return None
+
+    def _purge(self, file_path: str) -> int:
+        '''Unlink a claimed file and return its size'''
+        try:
+            size = os.stat(file_path).st_size
+            os.remove(file_path)
+        except FileNotFoundError:
+            return 0
+        self.purged_files += 1
+        self.purged_bytes += size
+        # Directories of legacy files go with their last file
+        directory = os.path.dirname(file_path)
+        if directory not in (self.attachments_dir, self.blobs_dir):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+        return size
+
+    def _purge_slice(self) -> Tuple[int, bool]:
+        '''Remove queued files worth one slice at the rate limit; return the bytes removed and whether more are queued'''
+        if not os.path.exists(self.removals_file) or os.path.getsize(self.removals_file) == 0:
+            self.pending_removals = 0
+            return 0, False
+        budget = self.purge_bytes_per_s * PURGE_SLICE_SECONDS
+        claimed: List[str] = []
+        with self._locked():
+            offset, counted_size, pending = self._read_queue_marker()
+            size = os.path.getsize(self.removals_file)
+            if offset > size or counted_size > size:
+                # Emptied after the marker was written, count it over again
+                offset, counted_size, pending = 0, 0, 0
+            # Only the entries appended since the last slice are counted
+            pending += self._count_entries(counted_size, size)
+
+            claimed_bytes = 0
+            entries = 0
+            with open(self.removals_file, 'rb') as file:
+                file.seek(offset)
+                for line in file:
+                    if not line.endswith(b'\n'):
+                        # Tail torn by a crash while appending, nobody appends while we hold the lock
+                        os.truncate(self.removals_file, offset)
+                        size = offset
+                        break
+                    offset += len(line)
+                    entries += 1
+                    try:
+                        claim = self._claim(json.loads(line))
+                    except ValueError:
+                        # A line torn by a crash while appending, its files are left to the sweeper
+                        claim = None
+                    if claim is not None:
+                        claimed.append(claim[0])
+                        claimed_bytes += claim[1]
+                    if entries >= PURGE_SLICE_ENTRIES or (budget and claimed_bytes >= budget):
+                        break
+            pending = max(0, pending - entries)
+            self._claimed.update(claimed)
+
+            if offset >= size:
+                # Marker first: a crash before the truncation only replays entries already done
+                self._write_queue_marker(0, 0, 0)
+                os.truncate(self.removals_file, 0)
+                pending = 0
+            else:
+                self._write_queue_marker(offset, size, pending)
+            self.pending_removals = pending
+
+        # Claimed files are out of use, unlinking them needs no lock
+        removed_bytes = sum(self._purge(file_path) for file_path in claimed)
+        with self._lock:
+            self._claimed.difference_update(claimed)
+        return removed_bytes, self.pending_removals > 0
+
+    def _run_purger(self):
+        while not self._stop.is_set():
+            # Only a shared queue can grow without this process waking the worker
+            self._wake.wait(PURGE_POLL_SECONDS if self._store_lock is not None else None)
+            self._wake.clear()
+            more = True
+            while more and not self._stop.is_set():
+                start = time.monotonic()
+                try:
+                    removed_bytes, more = self._purge_slice()
+                except Exception:
+                    logger.exception("Could not remove queued attachment files, retrying later")
+                    break
+                if self.purge_bytes_per_s:
+                    self._stop.wait(max(0.0, removed_bytes / self.purge_bytes_per_s - (time.monotonic() - start)))
+
+    def sweep(self, references: Set[Tuple[str, str]]) -> dict:
+        '''
+        Reconcile the attachments directory with references, the (expense id,
+        file name) of every attachment the expenses list. Blobs nobody
+        references, legacy files of no listed attachment and stale upload temp
+        files are queued for removal. References to attachments no expense lists
+        are dropped when two sweeps in a row find them, since an upload is
+        referenced just before its expense lists it. Returns the number and
+        bytes of the files queued and the references dropped.
+        '''
+        orphans: List[Tuple[dict, int]] = []
+        with self._locked():
+            queued = self._read_removals()
+            queued_blobs = {removal['blob'] for removal in queued if 'blob' in removal}
+            queued_files = {removal['file'] for removal in queued if 'file' in removal}
+            queued_files.update(os.path.relpath(file_path, self.attachments_dir) for file_path in self._claimed)
+
+            dangling = {key for key in self._refs if tuple(key.split('/', 1)) not in references}
+            dropped = dangling & self._suspect_refs
+            for key in dropped:
+                # Blobs left without references are picked up by the scan below
+                self._set_ref(key, None)
+            if dropped:
+                self._save_refs()
+            self._suspect_refs = dangling - dropped
+
+            now = time.time()
+            for entry in os.scandir(self.blobs_dir):
+                if entry.is_dir():
+                    for blob in os.scandir(entry.path):
+                        if blob.name not in self._refcounts and blob.name not in queued_blobs:
+                            orphans.append(({'blob': blob.name}, blob.stat().st_size))
+                elif entry.name.startswith('upload-'):
+                    stat_result = entry.stat()
+                    file_name = os.path.join('blobs', entry.name)
+                    if now - stat_result.st_mtime > STALE_UPLOAD_SECONDS and file_name not in queued_files:
+                        orphans.append(({'file': file_name}, stat_result.st_size))
+                elif entry.name.startswith('purge-'):
+                    # Claimed by a removal worker that stopped before unlinking it
+                    file_name = os.path.join('blobs', entry.name)
+                    if file_name not in queued_files:
+                        orphans.append(({'file': file_name}, entry.stat().st_size))
+
+            for entry in os.scandir(self.attachments_dir):
+                if not entry.is_dir() or entry.path == self.blobs_dir:
+                    continue
+                for legacy in os.scandir(entry.path):
+                    file_name = os.path.join(entry.name, legacy.name)
+                    if legacy.is_file() and (entry.name, legacy.name) not in references \
+                            and file_name not in queued_files:
+                        orphans.append(({'file': file_name}, legacy.stat().st_size))
+
+            self._enqueue([removal for removal, _ in orphans])
+        swept_bytes = sum(size for _, size in orphans)
+        self.swept_files += len(orphans)
+        self.swept_bytes += swept_bytes
+        return {'files': len(orphans), 'bytes': swept_bytes, 'dropped_refs': len(dropped)}
+
+    def stats(self) -> dict:
+        return {
+            'pending_removals': self.pending_removals,
+            'purged_files': self.purged_files,
+            'purged_bytes': self.purged_bytes,
+            'swept_files': self.swept_files,
+            'swept_bytes': self.swept_bytes,
+        }
+
+    def close(self):
+        '''Stop the removal worker, whatever is still queued is removed after the next start'''
+        self._stop.set()
+        self._wake.set()
+        self._purger.join()
+        if self._store_lock is not None:
+            self._store_lock.close()
@@ -0,0 +1 @@
+'''Benchmarks for the expense tracker. Run from the repository root, e.g. `python -m benchmarks.bench_filter_index`.'''
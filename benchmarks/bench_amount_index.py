@@ -0,0 +1,60 @@
+'''Compare amount range and top-k queries on the sorted amount index against a full scan and sort'''
+import argparse
+import json
+import os
+import tempfile
+import timeit
+
+from benchmarks.dataset import generate_expenses
+from fs_expense_repository import FileExpenseRepository
+
+QUERIES = [
+    ('top 50 by amount', {'order_by': '-amount', 'limit': 50}),
+    ('over 990, by amount', {'min_amount': 990, 'order_by': '-amount'}),
+    ('100 to 101, first 50', {'min_amount': 100, 'max_amount': 101, 'order_by': 'amount', 'limit': 50}),
+    ('over 500, file order', {'min_amount': 500}),
+]
+
+
+def linear_scan(expenses, min_amount=None, max_amount=None, order_by=None, limit=None):
+    expenses = [expense for expense in expenses
+                if (min_amount is None or expense['amount'] >= min_amount)
+                and (max_amount is None or expense['amount'] <= max_amount)]
+    if order_by:
+        expenses.sort(key=lambda expense: (expense['amount'], expense['id']), reverse=order_by == '-amount')
+    return expenses[:limit] if limit else expenses
+
+
+def indexed(repository, min_amount=None, max_amount=None, order_by=None, limit=None):
+    if order_by is None and limit is None:
+        return repository._select_expenses(None, None, None, min_amount, max_amount)
+    return repository._select_page(None, None, None, None, limit, min_amount, max_amount, order_by)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        expenses = generate_expenses(args.records)
+        with open(os.path.join(data_dir, 'expenses.json'), 'w') as file:
+            json.dump(expenses, file)
+        FileExpenseRepository._instance = None
+        repository = FileExpenseRepository(data_dir)
+
+        print(f"{args.records} expenses, best of {args.repeat} runs")
+        for label, query in QUERIES:
+            expected = linear_scan(expenses, **query)
+            assert indexed(repository, **query) == expected
+
+            scan_time = min(timeit.repeat(lambda: linear_scan(expenses, **query), number=1, repeat=args.repeat))
+            index_time = min(timeit.repeat(lambda: indexed(repository, **query), number=1, repeat=args.repeat))
+            print(f"{label:<24} {len(expected):>7} rows  scan {scan_time * 1000:8.2f} ms  "
+                  f"index {index_time * 1000:8.2f} ms  speedup {scan_time / index_time:6.1f}x")
+        repository.close()
+
+
+if __name__ == '__main__':
+    main()
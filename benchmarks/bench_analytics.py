@@ -0,0 +1,53 @@
+'''
+Compare the vectorized analytics report against the equivalent Python loop
+over Expense objects: convert every amount to EUR, then compute totals,
+percentiles, a histogram and per-category sums.
+'''
+import argparse
+import statistics
+import timeit
+
+from analytics import DEFAULT_RATES, ColumnarExpenses, build_report
+from benchmarks.dataset import generate_expenses
+from data_model import Expense
+
+
+def python_report(expenses, rates, reporting_currency, bins=10):
+    converted = [expense.amount * rates[expense.currency] / rates[reporting_currency] for expense in expenses]
+    by_category = {}
+    for expense, amount in zip(expenses, converted):
+        by_category[expense.category] = by_category.get(expense.category, 0.0) + amount
+    ordered = sorted(converted)
+    percentiles = [ordered[int(len(ordered) * p / 100) - 1] for p in (50, 90, 95, 99)]
+    low, high = ordered[0], ordered[-1]
+    width = (high - low) / bins or 1.0
+    histogram = [0] * bins
+    for amount in converted:
+        histogram[min(int((amount - low) / width), bins - 1)] += 1
+    return sum(converted), statistics.fmean(converted), percentiles, histogram, by_category
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for count in args.records:
+        records = generate_expenses(count)
+        expenses = [Expense(**record) for record in records]
+        columns = ColumnarExpenses.from_expenses(records)
+
+        report = build_report(columns, DEFAULT_RATES, 'EUR', group_by=['category'])
+        total = python_report(expenses, DEFAULT_RATES, 'EUR')[0]
+        assert abs(report['sum'] - total) <= 1e-6 * abs(total)
+
+        loop_time = min(timeit.repeat(lambda: python_report(expenses, DEFAULT_RATES, 'EUR'), number=1, repeat=args.repeat))
+        vector_time = min(timeit.repeat(lambda: build_report(columns, DEFAULT_RATES, 'EUR', group_by=['category']),
+                                        number=1, repeat=args.repeat))
+        print(f"{count:>9} expenses  python loop {loop_time * 1000:9.2f} ms  vectorized {vector_time * 1000:8.2f} ms  "
+              f"speedup {loop_time / vector_time:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Latency of deleting expenses with many large attachments. "synchronous"
+unlinks the files inside the request, as deletes did before the removal
+queue; "deferred" only queues them and lets the background worker unlink
+them at --purge-mb-per-s. Reports delete latencies, then how long the
+worker took to empty the queue and checks that no blob is left.
+
+    python -m benchmarks.bench_attachment_delete --expenses 20 --attachments 10 --attachment-mb 8
+'''
+import argparse
+import asyncio
+import glob
+import io
+import os
+import sys
+import tempfile
+import time
+
+from fastapi import UploadFile
+
+from benchmarks.results import add_output_arguments, latency_stats, report
+from data_model import Expense
+from fs_expense_repository import FileExpenseRepository
+
+
+async def measure(data_dir: str, deferred: bool, args) -> dict:
+    FileExpenseRepository._instance = None
+    repository = FileExpenseRepository(data_dir, args.storage_mode, purge_bytes_per_s=args.purge_mb_per_s * 2 ** 20)
+    store = repository._attachments
+    expense_ids = []
+    for _ in range(args.expenses):
+        expense = await repository.add_expense(Expense(name='Scans', amount=1))
+        files = [UploadFile(io.BytesIO(os.urandom(args.attachment_mb * 2 ** 20)), filename=f'scan-{i}.pdf')
+                 for i in range(args.attachments)]
+        await repository.add_attachment(expense.id, files)
+        expense_ids.append(expense.id)
+
+    latencies = []
+    start = time.perf_counter()
+    for expense_id in expense_ids:
+        call_start = time.perf_counter()
+        await repository.delete_expense(expense_id)
+        if not deferred:
+            # The whole queue at once, as the request itself used to unlink every file
+            rate, store.purge_bytes_per_s = store.purge_bytes_per_s, 0
+            await repository._run_io(store._purge_slice)
+            store.purge_bytes_per_s = rate
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+
+    drain_start = time.perf_counter()
+    while store.pending_removals:
+        await asyncio.sleep(0.01)
+    drained = time.perf_counter() - drain_start
+    repository.close()
+
+    left = glob.glob(os.path.join(data_dir, 'attachments', 'blobs', '*', '*'))
+    if left:
+        raise AssertionError(f"{len(left)} blobs left after the queue drained")
+    stats = latency_stats(latencies, elapsed)
+    stats['drain_s'] = drained
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--expenses', type=int, default=20)
+    parser.add_argument('--attachments', type=int, default=10, help="Attachments per expense")
+    parser.add_argument('--attachment-mb', type=int, default=4)
+    parser.add_argument('--purge-mb-per-s', type=float, default=64)
+    parser.add_argument('--storage-mode', default='journal', choices=['json', 'journal', 'binary'])
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    results = {}
+    for label, deferred in [('synchronous', False), ('deferred', True)]:
+        with tempfile.TemporaryDirectory() as data_dir:
+            results[label] = asyncio.run(measure(data_dir, deferred, args))
+        print(f"{label}: queue drained {results[label]['drain_s']:.2f} s after the last delete", file=sys.stderr)
+
+    params = {name: getattr(args, name) for name in ('expenses', 'attachments', 'attachment_mb', 'purge_mb_per_s',
+                                                     'storage_mode')}
+    sys.exit(report(args, 'attachment_delete', params, results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+'''
+Measure GET /expenses/ latency while large writes and uploads are running.
+
+The server app is driven in-process through httpx. With blocking file I/O on
+the event loop, read latency under load jumps to the duration of a full
+expenses.json rewrite or attachment save; with the I/O thread pool it stays
+close to the idle numbers. With --max-read-ms the run fails if any read under
+load took longer.
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.dataset import generate_expenses
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def read_loop(client, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = await client.get('/expenses/', params={'tag': 'Work', 'category': 'Car', 'currency': 'ILS'})
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+        await asyncio.sleep(0.005)
+
+
+async def write_loop(client, stop, expense_ids):
+    i = 0
+    while not stop.is_set():
+        expense_id = expense_ids[i % len(expense_ids)]
+        response = await client.put(f'/expenses/{expense_id}', json={'name': f'Updated {i}', 'amount': i})
+        response.raise_for_status()
+        i += 1
+
+
+async def upload_loop(client, stop, expense_ids, upload_bytes):
+    payload = os.urandom(upload_bytes)
+    i = 0
+    while not stop.is_set():
+        expense_id = expense_ids[i % len(expense_ids)]
+        response = await client.post(f'/expenses/{expense_id}/attachments',
+                                     files=[('files', (f'scan-{i}.pdf', payload))])
+        response.raise_for_status()
+        i += 1
+
+
+async def measure(client, duration, expense_ids, writers, uploaders, upload_bytes):
+    stop = asyncio.Event()
+    latencies = []
+    tasks = [asyncio.create_task(read_loop(client, stop, latencies))]
+    tasks += [asyncio.create_task(write_loop(client, stop, expense_ids)) for _ in range(writers)]
+    tasks += [asyncio.create_task(upload_loop(client, stop, expense_ids, upload_bytes)) for _ in range(uploaders)]
+    await asyncio.sleep(duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def report(label, latencies):
+    print(f"{label:<12} {len(latencies):>6} reads  p50 {statistics.median(latencies) * 1000:7.2f} ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.2f} ms  max {max(latencies) * 1000:7.2f} ms")
+
+
+async def run(args):
+    import httpx
+    import server
+
+    # ASGITransport does not run the app's startup and shutdown events
+    await server.startup_event()
+    transport = httpx.ASGITransport(app=server.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            expense_ids = [expense.id for expense in await server.expense_repository.get_all_expenses()][:100]
+            report('idle', await measure(client, args.duration, expense_ids, 0, 0, 0))
+            latencies = await measure(client, args.duration, expense_ids,
+                                      args.writers, args.uploaders, args.upload_mb * 1024 * 1024)
+            report('under load', latencies)
+            return max(latencies)
+    finally:
+        await server.shutdown_event()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50_000)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--uploaders', type=int, default=2)
+    parser.add_argument('--upload-mb', type=int, default=20)
+    parser.add_argument('--max-read-ms', type=float, help="Fail if a read under load takes longer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        with open(os.path.join(data_dir, 'expenses.json'), 'w') as file:
+            json.dump(generate_expenses(args.records), file)
+        os.environ['TRACKXPENSE_DATA_DIR'] = data_dir
+        os.environ.setdefault('TRACKXPENSE_BACKEND', 'file')
+        if 'server' in sys.modules:
+            raise RuntimeError("server must be imported after TRACKXPENSE_DATA_DIR is set")
+        slowest = asyncio.run(run(args))
+    if args.max_read_ms is not None and slowest * 1000 > args.max_read_ms:
+        sys.exit(f"A read under load took {slowest * 1000:.0f} ms, over --max-read-ms {args.max_read_ms:g}")
+
+
+if __name__ == '__main__':
+    main()
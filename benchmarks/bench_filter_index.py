@@ -0,0 +1,54 @@
+'''Compare indexed /expenses/ filtering against the old linear scan'''
+import argparse
+import json
+import os
+import tempfile
+import timeit
+
+from benchmarks.dataset import generate_expenses
+from fs_expense_repository import FileExpenseRepository
+
+QUERIES = [
+    {'tag': 'Travel', 'category': None, 'currency': None},
+    {'tag': None, 'category': 'Food', 'currency': 'EUR'},
+    {'tag': 'Work', 'category': 'Transport', 'currency': 'ILS'},
+]
+
+
+def linear_scan(expenses, tag, category, currency):
+    if tag:
+        expenses = [expense for expense in expenses if expense['tag'] == tag]
+    if category:
+        expenses = [expense for expense in expenses if expense['category'] == category]
+    if currency:
+        expenses = [expense for expense in expenses if expense['currency'] == currency]
+    return expenses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        expenses = generate_expenses(args.records)
+        with open(os.path.join(data_dir, 'expenses.json'), 'w') as file:
+            json.dump(expenses, file)
+        FileExpenseRepository._instance = None
+        repository = FileExpenseRepository(data_dir)
+
+        print(f"{args.records} expenses, best of {args.repeat} runs")
+        for query in QUERIES:
+            expected = linear_scan(expenses, **query)
+            assert repository._select_expenses(**query) == expected
+
+            scan_time = min(timeit.repeat(lambda: linear_scan(expenses, **query), number=1, repeat=args.repeat))
+            index_time = min(timeit.repeat(lambda: repository._select_expenses(**query), number=1, repeat=args.repeat))
+            filters = ', '.join(f'{field}={value}' for field, value in query.items() if value)
+            print(f"{filters:<40} {len(expected):>7} rows  scan {scan_time * 1000:8.2f} ms  "
+                  f"index {index_time * 1000:8.2f} ms  speedup {scan_time / index_time:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Measure write throughput with hundreds of concurrent writers.
+
+Each writer adds expenses to a FileExpenseRepository as fast as it can. With
+a commit window of 0 and a batch size of 1 every change is its own storage
+commit; with group commit concurrent changes share one. After each run the
+data is reloaded from disk to check that no acknowledged write was lost.
+'''
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.dataset import generate_expenses
+from data_model import Expense
+from fs_expense_repository import FileExpenseRepository
+
+
+def new_repository(data_dir, storage_mode, window=0.002, max_batch=1000, shards=1):
+    FileExpenseRepository._instance = None
+    return FileExpenseRepository(data_dir, storage_mode, commit_window=window, commit_max_batch=max_batch,
+                                 shards=shards)
+
+
+async def writer(repository, count):
+    for i in range(count):
+        await repository.add_expense(Expense(name=f'Concurrent {i}', amount=i, category='Food', tag='Home'))
+
+
+async def measure(data_dir, storage_mode, records, writers, writes, window, max_batch, shards):
+    with open(os.path.join(data_dir, 'expenses.json'), 'w') as file:
+        json.dump(generate_expenses(records), file)
+    # Files of the previous run, the binary mode would start from expenses.bin instead of the new dataset
+    for file_name in ('expenses.journal', 'expenses.bin'):
+        if os.path.exists(os.path.join(data_dir, file_name)):
+            os.remove(os.path.join(data_dir, file_name))
+    shutil.rmtree(os.path.join(data_dir, 'shards'), ignore_errors=True)
+
+    repository = new_repository(data_dir, storage_mode, window, max_batch, shards)
+    await repository.get_all_expenses()
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(repository, writes) for _ in range(writers)))
+    elapsed = time.perf_counter() - start
+    stats = repository.cache_stats()['commits']
+    in_memory = len(await repository.get_all_expenses())
+    repository.close()
+
+    reloaded = new_repository(data_dir, storage_mode, shards=shards)
+    on_disk = len(await reloaded.get_all_expenses())
+    reloaded.close()
+
+    expected = records + writers * writes
+    if in_memory != expected or on_disk != expected:
+        raise AssertionError(f"lost writes: expected {expected}, {in_memory} in memory, {on_disk} on disk")
+    return elapsed, stats['batches']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=10_000)
+    parser.add_argument('--writers', type=int, default=200)
+    parser.add_argument('--writes', type=int, default=5)
+    parser.add_argument('--storage-mode', choices=['json', 'journal', 'binary'], default='journal')
+    parser.add_argument('--shards', type=int, default=1)
+    args = parser.parse_args()
+
+    total = args.writers * args.writes
+    with tempfile.TemporaryDirectory() as data_dir:
+        for label, window, max_batch in (('one by one', 0, 1), ('grouped', 0.002, 1000)):
+            elapsed, batches = asyncio.run(measure(data_dir, args.storage_mode, args.records,
+                                                   args.writers, args.writes, window, max_batch, args.shards))
+            print(f"{label:<12} {total} writes in {elapsed:7.2f} s  {total / elapsed:9.0f} writes/s  "
+                  f"{batches:>6} commits")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+'''
+Load test of the FastAPI app, driven in-process through httpx.
+
+Each endpoint is hammered in turn by --concurrency clients for --duration
+seconds, followed by a mixed scenario of mostly reads. Reports p50/p95/p99
+latency, requests per second and peak RSS per scenario; --save and
+--baseline work as in bench_repository.
+
+    python -m benchmarks.bench_load --records 100000 --save load.json
+'''
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.dataset import write_dataset
+from benchmarks.results import RssSampler, add_output_arguments, latency_stats, report
+
+SCENARIOS = ['list page', 'list all', 'filter', 'summary', 'analytics', 'changes', 'create', 'update',
+             'batch', 'download attachment', 'upload attachment', 'delete', 'mixed']
+
+
+class Workload:
+    '''Requests of every scenario, with the ids they need'''
+
+    def __init__(self, client, expenses, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.ids = [expense['id'] for expense in expenses]
+        self.with_attachments = [expense for expense in expenses if expense['attachments']]
+        # Updates replace the whole expense, attachment list included, so they leave these alone
+        self.without_attachments = [expense['id'] for expense in expenses if not expense['attachments']]
+        self.created = []
+        self.version = None
+        self.payload = os.urandom(args.attachment_bytes)
+        self.batch = [{'op': 'create', 'expense': {'name': 'Batch', 'amount': 1.0}} for _ in range(args.batch_size)]
+
+    async def request(self, scenario: str) -> bool:
+        '''Send one request of the scenario; False when the scenario has nothing left to do'''
+        client, rng = self.client, self.rng
+        if scenario == 'mixed':
+            scenario = rng.choices(['list page', 'filter', 'summary', 'changes', 'create', 'update'],
+                                   weights=[30, 25, 15, 10, 10, 10])[0]
+        if scenario == 'list page':
+            response = await client.get('/expenses/all', params={'cursor': rng.choice(self.ids), 'limit': self.args.page_size})
+        elif scenario == 'list all':
+            response = await client.get('/expenses/all')
+        elif scenario == 'filter':
+            response = await client.get('/expenses/', params={'tag': 'Work', 'category': 'Food'})
+        elif scenario == 'summary':
+            response = await client.get('/expenses/summary', params={'group_by': ['category', 'currency']})
+        elif scenario == 'analytics':
+            response = await client.get('/expenses/analytics', params={'reporting_currency': 'EUR', 'group_by': 'tag'})
+        elif scenario == 'changes':
+            if self.version is None:
+                self.version = int((await client.get('/expenses/all', params={'limit': 1})).headers['X-Expenses-Version'])
+            # Poll like a client would, from the version of the previous answer
+            response = await client.get('/expenses/changes', params={'since': self.version})
+            self.version = response.json()['version']
+        elif scenario == 'create':
+            response = await client.post('/expenses/', json={'name': 'Load', 'amount': 1.0, 'tag': 'Work'})
+            self.created.append(response.json()['id'])
+        elif scenario == 'update':
+            response = await client.put(f'/expenses/{rng.choice(self.without_attachments)}',
+                                        json={'name': 'Updated', 'amount': 2.0})
+        elif scenario == 'batch':
+            response = await client.post('/expenses/batch', json=self.batch)
+            self.created += [result['id'] for result in response.json()]
+        elif scenario == 'download attachment':
+            expense = rng.choice(self.with_attachments)
+            response = await client.get(f"/expenses/{expense['id']}/attachments/download",
+                                        params={'file_name': expense['attachments'][0]})
+        elif scenario == 'upload attachment':
+            response = await client.post(f'/expenses/{rng.choice(self.ids)}/attachments',
+                                         files=[('files', (f'load-{rng.randrange(10 ** 9)}.pdf', self.payload))])
+        elif scenario == 'delete':
+            if not self.created:
+                return False
+            response = await client.delete(f'/expenses/{self.created.pop()}')
+        response.raise_for_status()
+        return True
+
+
+async def run_scenario(workload: Workload, scenario: str, concurrency: int, duration: float) -> dict:
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def user():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if not await workload.request(scenario):
+                return
+            latencies.append(time.perf_counter() - start)
+
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    stats = latency_stats(latencies, elapsed)
+    stats['peak_rss_mb'] = rss.peak_mb
+    return stats
+
+
+async def run(args, expenses) -> dict:
+    import httpx
+    import server
+
+    results = {}
+    # ASGITransport does not run the app's startup and shutdown events
+    await server.startup_event()
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+        workload = Workload(client, expenses, args)
+        for scenario in args.scenarios:
+            if scenario == 'download attachment' and not workload.with_attachments:
+                continue
+            results[scenario] = await run_scenario(workload, scenario, args.concurrency, args.duration)
+            print(f"{scenario:<40} {results[scenario]['ops_per_s']:9.0f} req/s", file=sys.stderr)
+    await server.shutdown_event()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['file', 'sqlite'], default='file')
+    parser.add_argument('--storage-mode', choices=['json', 'journal', 'binary'], default='journal')
+    parser.add_argument('--records', type=int, default=10_000, help="Dataset size, 1k to 1M")
+    parser.add_argument('--attachment-ratio', type=float, default=0.1, help="Share of expenses with an attachment")
+    parser.add_argument('--attachment-bytes', type=int, default=64 * 1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent clients per scenario")
+    parser.add_argument('--duration', type=float, default=3.0, help="Seconds per scenario")
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        expenses = write_dataset(data_dir, args.records, args.seed, args.attachment_ratio, args.attachment_bytes)
+        os.environ['TRACKXPENSE_DATA_DIR'] = data_dir
+        os.environ['TRACKXPENSE_BACKEND'] = args.backend
+        os.environ['TRACKXPENSE_STORAGE_MODE'] = args.storage_mode
+        if 'server' in sys.modules:
+            raise RuntimeError("server must be imported after TRACKXPENSE_DATA_DIR is set")
+        results = asyncio.run(run(args, expenses))
+
+    params = {name: getattr(args, name) for name in ('backend', 'storage_mode', 'records', 'attachment_ratio',
+                                                     'seed', 'concurrency', 'duration', 'page_size', 'batch_size')}
+    sys.exit(report(args, 'load', params, results))
+
+
+if __name__ == '__main__':
+    main()
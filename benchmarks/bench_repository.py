@@ -0,0 +1,147 @@
+'''
+Micro-benchmarks of every repository method, called directly on a
+FileExpenseRepository or SqliteExpenseRepository over a generated dataset.
+
+Reports p50/p95/p99 latency, calls per second and peak RSS per method.
+Save a run with --save and check a later one with --baseline, e.g.
+
+    python -m benchmarks.bench_repository --records 100000 --save base.json
+    python -m benchmarks.bench_repository --records 100000 --baseline base.json
+'''
+import argparse
+import asyncio
+import io
+import random
+import sys
+import tempfile
+import time
+
+from fastapi import UploadFile
+
+from benchmarks.dataset import write_dataset
+from benchmarks.results import RssSampler, add_output_arguments, latency_stats, report
+from data_model import BatchOperation, Expense
+
+
+def create_repository(backend: str, storage_mode: str, data_dir: str):
+    if backend == 'sqlite':
+        from sqlite_expense_repository import SqliteExpenseRepository
+        SqliteExpenseRepository._instance = None
+        return SqliteExpenseRepository(data_dir)
+    from fs_expense_repository import FileExpenseRepository
+    FileExpenseRepository._instance = None
+    return FileExpenseRepository(data_dir, storage_mode)
+
+
+def upload(file_name: str, size: int) -> UploadFile:
+    return UploadFile(io.BytesIO(random.randbytes(size)), filename=file_name)
+
+
+async def measure(func, iterations: int, max_seconds: float) -> dict:
+    '''Call func(i) up to iterations times or until max_seconds have passed'''
+    latencies = []
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        for i in range(iterations):
+            call_start = time.perf_counter()
+            await func(i)
+            latencies.append(time.perf_counter() - call_start)
+            if call_start - start > max_seconds:
+                break
+        elapsed = time.perf_counter() - start
+    stats = latency_stats(latencies, elapsed)
+    stats['peak_rss_mb'] = rss.peak_mb
+    return stats
+
+
+async def run(args, data_dir: str) -> dict:
+    rng = random.Random(args.seed)
+    expenses = write_dataset(data_dir, args.records, args.seed, args.attachment_ratio)
+    repository = create_repository(args.backend, args.storage_mode, data_dir)
+    ids = [expense['id'] for expense in expenses]
+    with_attachments = [expense for expense in expenses if expense['attachments']]
+    created = []
+    attached = []
+    version = await repository.get_version()
+
+    async def add_expense(i):
+        created.append((await repository.add_expense(Expense(name=f'Bench {i}', amount=i, tag='Work'))).id)
+
+    async def add_attachment(i):
+        expense_id = created[i % len(created)]
+        await repository.add_attachment(expense_id, [upload(f'bench-{i}.pdf', args.attachment_bytes)])
+        attached.append((expense_id, f'bench-{i}.pdf'))
+
+    async def download_attachment(i):
+        expense = with_attachments[i % len(with_attachments)]
+        await repository.download_attachment(expense['id'], expense['attachments'][0])
+
+    async def delete_attachment(i):
+        await repository.delete_attachment(*attached.pop())
+
+    batch = [BatchOperation(op='create', expense=Expense(name='Batch', amount=1.0)) for _ in range(args.batch_size)]
+    pages = sorted(rng.sample(ids, min(len(ids), 100)))
+
+    # Reads first, then writes; each write benchmark leaves what the next one needs
+    operations = [
+        ('get_all_expenses', lambda i: repository.get_all_expenses()),
+        ('get_all_expenses page', lambda i: repository.get_all_expenses(pages[i % len(pages)], args.page_size)),
+        ('get_expenses tag', lambda i: repository.get_expenses('Work', None, None)),
+        ('get_expenses tag+category+currency', lambda i: repository.get_expenses('Work', 'Food', 'EUR')),
+        ('get_summary category', lambda i: repository.get_summary(['category'])),
+        ('get_summary all fields', lambda i: repository.get_summary(['category', 'tag', 'currency'])),
+        ('get_columns', lambda i: repository.get_columns()),
+        ('get_version', lambda i: repository.get_version()),
+        ('add_expense', add_expense),
+        ('update_expense', lambda i: repository.update_expense(ids[rng.randrange(len(ids))],
+                                                               Expense(name=f'Updated {i}', amount=i))),
+        ('get_changes', lambda i: repository.get_changes(version)),
+        ('apply_batch', lambda i: repository.apply_batch(batch)),
+        ('add_attachment', add_attachment),
+        ('delete_attachment', delete_attachment),
+        ('delete_expense', lambda i: repository.delete_expense(created.pop())),
+    ]
+    if with_attachments:
+        operations.insert(8, ('download_attachment', download_attachment))
+
+    results = {}
+    for name, func in operations:
+        if name == 'get_changes':
+            # Versions restart on reload for the file backend, so take it after the writes above
+            version = await repository.get_version() - 1
+        iterations = args.iterations
+        if name == 'delete_attachment':
+            iterations = min(iterations, len(attached))
+        elif name == 'delete_expense':
+            iterations = min(iterations, len(created))
+        results[name] = await measure(func, iterations, args.max_seconds)
+        print(f"{name:<40} {results[name]['p50_ms']:9.3f} ms p50", file=sys.stderr)
+    repository.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['file', 'sqlite'], default='file')
+    parser.add_argument('--storage-mode', choices=['json', 'journal', 'binary'], default='journal')
+    parser.add_argument('--records', type=int, default=10_000, help="Dataset size, 1k to 1M")
+    parser.add_argument('--attachment-ratio', type=float, default=0.1, help="Share of expenses with an attachment")
+    parser.add_argument('--attachment-bytes', type=int, default=64 * 1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=200, help="Calls per method at most")
+    parser.add_argument('--max-seconds', type=float, default=5.0, help="Time budget per method")
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=100)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        results = asyncio.run(run(args, data_dir))
+
+    params = {name: getattr(args, name) for name in ('backend', 'storage_mode', 'records', 'attachment_ratio',
+                                                     'seed', 'iterations', 'page_size', 'batch_size')}
+    sys.exit(report(args, 'repository', params, results))
+
+
+if __name__ == '__main__':
+    main()
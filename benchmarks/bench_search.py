@@ -0,0 +1,110 @@
+'''
+Measure the full-text search index on expenses with realistic names and
+notes: building it, saving and restoring it, query latency (single words,
+prefixes and multi-word queries) and incremental updates.
+
+    python -m benchmarks.bench_search --records 1000000
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.dataset import generate_expenses
+from benchmarks.results import add_output_arguments, latency_stats, report
+from search_index import SearchIndex
+
+# Name and notes vocabulary, most common first, so word frequencies follow a long tail
+WORDS = ['taxi', 'lunch', 'coffee', 'hotel', 'train', 'dinner', 'groceries', 'fuel', 'parking', 'flight',
+         'berlin', 'paris', 'london', 'tel', 'aviv', 'office', 'supplies', 'client', 'meeting', 'conference',
+         'museum', 'ticket', 'pharmacy', 'rent', 'internet', 'phone', 'gym', 'books', 'laptop', 'charger',
+         'airport', 'bus', 'metro', 'breakfast', 'snacks', 'gift', 'birthday', 'insurance', 'repair', 'bike',
+         'café', 'bakery', 'market', 'cinema', 'concert', 'visa', 'passport', 'souvenir', 'laundry', 'tips']
+
+QUERIES = ['taxi', 'berlin', 'tax', 'ber', 'taxi berlin', 'hotel paris conference', 'cafe', 'lunch client meeting',
+           'receipt 4711', 'nothingmatches']
+
+
+def pick_words(rng: random.Random, count: int) -> str:
+    return ' '.join(WORDS[min(int(rng.paretovariate(1.0)) - 1, len(WORDS) - 1)] for _ in range(count))
+
+
+def generate_texts(count: int, seed: int):
+    rng = random.Random(seed)
+    expenses = generate_expenses(count, seed)
+    for expense in expenses:
+        expense['name'] = pick_words(rng, rng.randint(1, 3))
+        if rng.random() < 0.3:
+            expense['name'] += f' receipt {rng.randrange(10_000)}'
+        expense['notes'] = pick_words(rng, rng.randint(0, 8))
+    return expenses
+
+
+def measure(func, iterations: int) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        call_start = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - call_start)
+    return latency_stats(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queries', type=int, default=50, help="Runs of every query")
+    parser.add_argument('--updates', type=int, default=2000, help="Incremental updates, each followed by a query")
+    parser.add_argument('--limit', type=int, default=50)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    expenses = generate_texts(args.records, args.seed)
+    by_id = {expense['id']: expense for expense in expenses}
+    rows = {expense['id']: row for row, expense in enumerate(expenses)}
+    results = {}
+
+    index = SearchIndex()
+    start = time.perf_counter()
+    for row, expense in enumerate(expenses):
+        index.add(row, expense)
+    index.search('warmup', 1)
+    print(f"build   {time.perf_counter() - start:8.2f} s", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        file_path = os.path.join(data_dir, 'search_index.npz')
+        start = time.perf_counter()
+        index.save(file_path, by_id, rows)
+        print(f"save    {time.perf_counter() - start:8.2f} s  "
+              f"{os.path.getsize(file_path) / 2 ** 20:.1f} MB", file=sys.stderr)
+        restored = SearchIndex()
+        start = time.perf_counter()
+        assert restored.restore(file_path, by_id, rows)
+        print(f"restore {time.perf_counter() - start:8.2f} s", file=sys.stderr)
+    assert restored.search('taxi berlin', args.limit) == index.search('taxi berlin', args.limit)
+
+    for query in QUERIES:
+        matches = len(index.search(query, args.records))
+        results[f'search "{query}" ({matches} matches)'] = measure(lambda i: index.search(query, args.limit),
+                                                                   args.queries)
+
+    rng = random.Random(args.seed)
+
+    def update(i):
+        # Like the repository, an update keeps the expense's row
+        row = rng.randrange(len(expenses))
+        index.remove(row, expenses[row])
+        expenses[row] = dict(expenses[row], name=pick_words(rng, 2))
+        index.add(row, expenses[row])
+        index.search('taxi berlin', args.limit)
+    results['update + search'] = measure(update, args.updates)
+
+    params = {name: getattr(args, name) for name in ('records', 'seed', 'queries', 'updates', 'limit')}
+    sys.exit(report(args, 'search', params, results))
+
+
+if __name__ == '__main__':
+    main()
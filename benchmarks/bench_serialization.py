@@ -0,0 +1,71 @@
+'''
+Compare list response serialization: the response model path (Expense
+objects from the repository, validated and encoded again by FastAPI)
+against joining cached per-expense JSON, and the bytes sent with gzip and
+brotli compression.
+'''
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import timeit
+from typing import List
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute, serialize_response
+
+from benchmarks.dataset import generate_expenses
+from compression import brotli, compress
+from data_model import Expense
+from fs_expense_repository import FileExpenseRepository
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        with open(os.path.join(data_dir, 'expenses.json'), 'w') as file:
+            json.dump(generate_expenses(args.records), file)
+        FileExpenseRepository._instance = None
+        repository = FileExpenseRepository(data_dir)
+        loop = asyncio.new_event_loop()
+        response_field = APIRoute('/expenses/all', lambda: None, response_model=List[Expense]).response_field
+
+        def response_model_path() -> bytes:
+            expenses = loop.run_until_complete(repository.get_all_expenses())
+            content = loop.run_until_complete(serialize_response(field=response_field, response_content=expenses))
+            return JSONResponse(content).body
+
+        def encoded_path() -> bytes:
+            return loop.run_until_complete(repository.get_expenses_json(None, None, None)).body
+
+        def first_encoded_read() -> bytes:
+            repository._encoded.clear()
+            return encoded_path()
+
+        body = response_model_path()
+        assert encoded_path() == body
+
+        print(f"{args.records} expenses, best of {args.repeat} runs")
+        baseline = None
+        for label, func in [('response model', response_model_path), ('encoded, first read', first_encoded_read),
+                            ('encoded, cached', encoded_path)]:
+            elapsed = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            baseline = baseline or elapsed
+            print(f"{label:<22} {elapsed * 1000:9.1f} ms  speedup {baseline / elapsed:6.1f}x")
+
+        print(f"{'identity':<22} {len(body) / 2 ** 20:9.1f} MB")
+        for encoding in ['gzip'] + (['br'] if brotli is not None else []):
+            elapsed = min(timeit.repeat(lambda: compress(body, encoding), number=1, repeat=args.repeat))
+            size = len(compress(body, encoding))
+            print(f"{encoding:<22} {size / 2 ** 20:9.1f} MB  {size / len(body):6.1%} in {elapsed * 1000:.1f} ms")
+        repository.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+Cold start of the clients, each run in a fresh process: the time to import
+cli_client, pyqt_client and (for reference) server, and the time until the
+first request is answered by `cli_client.py export --start-server`, which
+starts the embedded server, waits on /health and streams /expenses/.
+
+A PyInstaller build of the command line client is timed the same way with
+--frozen-cli dist/cli_client/cli_client: `--help` for its cold start and
+`export --start-server` for its first request.
+
+    python -m benchmarks.bench_startup --repeat 10 --records 1000
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.dataset import write_dataset
+from benchmarks.results import add_output_arguments, latency_stats, report
+
+
+def time_command(command, env, repeat: int):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--records', type=int, default=1000, help="Expenses loaded by the embedded server")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--frozen-cli', help="PyInstaller build of cli_client to time as well")
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_dataset(data_dir, args.records)
+        env = dict(os.environ, TRACKXPENSE_DATA_DIR=data_dir, QT_QPA_PLATFORM='offscreen')
+        export = ['export', os.path.join(data_dir, 'export.jsonl'), '--start-server',
+                  '--url', f'http://127.0.0.1:{args.port}']
+        commands = {
+            'import cli_client': [sys.executable, '-c', 'import cli_client'],
+            'import pyqt_client': [sys.executable, '-c', 'import pyqt_client'],
+            'import server': [sys.executable, '-c', 'import server'],
+            'cli first request': [sys.executable, 'cli_client.py'] + export,
+        }
+        if args.frozen_cli:
+            commands['frozen cli cold start'] = [args.frozen_cli, '--help']
+            commands['frozen cli first request'] = [args.frozen_cli] + export
+
+        results = {}
+        for name, command in commands.items():
+            start = time.perf_counter()
+            latencies = time_command(command, env, args.repeat)
+            results[name] = latency_stats(latencies, time.perf_counter() - start)
+
+    params = {'records': args.records, 'frozen_cli': bool(args.frozen_cli)}
+    sys.exit(report(args, 'startup', params, results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Compare the file backend's storage modes on the same dataset: a
+single-expense commit, size on disk and full load.
+
+    python -m benchmarks.bench_storage_format --records 100000
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.dataset import write_dataset
+from benchmarks.results import RssSampler, add_output_arguments, latency_stats, report
+from file_storage import create_storage
+
+
+def measure(func, iterations: int) -> dict:
+    latencies = []
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        for i in range(iterations):
+            call_start = time.perf_counter()
+            func(i)
+            latencies.append(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start
+    stats = latency_stats(latencies, elapsed)
+    stats['peak_rss_mb'] = rss.peak_mb
+    return stats
+
+
+def run_mode(storage_mode: str, args) -> dict:
+    results = {}
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_dataset(data_dir, args.records, args.seed)
+        storage = create_storage(storage_mode, data_dir)
+        # The binary mode converts expenses.json here, on first start
+        storage.ensure_files()
+        expenses = storage.load()
+        ids = list(expenses)
+
+        def commit(i):
+            expense = dict(expenses[ids[rng.randrange(len(ids))]], name=f'Updated {i}')
+            expenses[expense['id']] = expense
+            storage.commit(expenses, [('put', expense)])
+        results[f'{storage_mode} commit'] = measure(commit, args.commits)
+
+        # After the commits, so the files are in the layout each mode writes (expenses.json with indent=4)
+        results[f'{storage_mode} load'] = measure(lambda i: storage.load(), args.loads)
+        results[f'{storage_mode} load']['file_mb'] = os.path.getsize(storage.expenses_data_file) / 2 ** 20
+        storage.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', nargs='+', choices=['json', 'journal', 'binary'], default=['json', 'journal', 'binary'])
+    parser.add_argument('--loads', type=int, default=5, help="Full loads per mode")
+    parser.add_argument('--commits', type=int, default=20, help="Single-expense commits per mode")
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    results = {}
+    for storage_mode in args.modes:
+        results.update(run_mode(storage_mode, args))
+        print(f"{storage_mode:<10} done", file=sys.stderr)
+
+    for name, metrics in results.items():
+        if 'file_mb' in metrics:
+            print(f"{name.split()[0]:<10} {metrics['file_mb']:8.1f} MB on disk")
+    params = {name: getattr(args, name) for name in ('records', 'seed', 'loads', 'commits')}
+    sys.exit(report(args, 'storage_format', params, results))
+
+
+if __name__ == '__main__':
+    main()
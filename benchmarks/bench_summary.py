@@ -0,0 +1,70 @@
+'''
+Check the incrementally maintained /expenses/summary rollups against a full
+scan after a random mix of adds, updates and deletes, and time both.
+'''
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import timeit
+
+from benchmarks.dataset import generate_expenses
+from fs_expense_repository import FileExpenseRepository
+from rollups import GROUPINGS, compute_summary
+
+
+def assert_same_summary(rollup, full_scan):
+    assert len(rollup) == len(full_scan), (len(rollup), len(full_scan))
+    for rollup_row, scan_row in zip(rollup, full_scan):
+        assert rollup_row.keys() == scan_row.keys(), (rollup_row, scan_row)
+        for key, value in scan_row.items():
+            if isinstance(value, float):
+                assert math.isclose(rollup_row[key], value, rel_tol=1e-9, abs_tol=1e-6), (key, rollup_row, scan_row)
+            else:
+                assert rollup_row[key] == value, (key, rollup_row, scan_row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--mutations', type=int, default=20_000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        with open(os.path.join(data_dir, 'expenses.json'), 'w') as file:
+            json.dump(generate_expenses(args.records), file)
+        FileExpenseRepository._instance = None
+        repository = FileExpenseRepository(data_dir)
+
+        # Mutate the cache directly, the rollups only depend on _apply
+        expense_ids = list(repository._expenses)
+        for replacement in generate_expenses(args.mutations, seed=1):
+            choice = random.random()
+            if choice < 0.4:
+                repository._apply([('put', replacement)])
+                expense_ids.append(replacement['id'])
+            elif choice < 0.7:
+                replacement['id'] = random.choice(expense_ids)
+                repository._apply([('put', replacement)])
+            else:
+                position = random.randrange(len(expense_ids))
+                expense_ids[position], expense_ids[-1] = expense_ids[-1], expense_ids[position]
+                repository._apply([('delete', expense_ids.pop())])
+
+        expenses = list(repository._expenses.values())
+        print(f"{len(expenses)} expenses after {args.mutations} mutations, best of {args.repeat} runs")
+        for group_by in GROUPINGS:
+            assert_same_summary(repository._rollups.summary(group_by), compute_summary(expenses, group_by))
+            rollup_time = min(timeit.repeat(lambda: repository._rollups.summary(group_by), number=1, repeat=args.repeat))
+            scan_time = min(timeit.repeat(lambda: compute_summary(expenses, group_by), number=1, repeat=args.repeat))
+            label = ', '.join(group_by) or '(total)'
+            print(f"{label:<25} rollup {rollup_time * 1000:8.3f} ms  full scan {scan_time * 1000:8.2f} ms  "
+                  f"speedup {scan_time / rollup_time:8.1f}x")
+        print("Rollups match the full scan")
+
+
+if __name__ == '__main__':
+    main()
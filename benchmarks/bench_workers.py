@@ -0,0 +1,112 @@
+'''
+Throughput of a real server (uvicorn over HTTP) with one or more worker
+processes sharing a data directory. Client processes send a mix of list,
+filter and summary reads plus --write-ratio creates; at the end every
+create must be visible from every worker, or the run fails.
+
+    python -m benchmarks.bench_workers --workers 1 2 4 --records 100000
+'''
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from benchmarks.dataset import write_dataset
+from benchmarks.results import add_output_arguments, latency_stats, report
+
+READS = ['/expenses/?limit=100', '/expenses/?tag=Work&limit=100', '/expenses/summary?group_by=category',
+         '/expenses/?order_by=-amount&limit=20']
+
+
+def wait_until_serving(url: str, server: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with status {server.returncode}")
+        try:
+            requests.get(url + '/stats/cache', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server not answering at {url} after {timeout} s")
+
+
+def run_client(url: str, duration: float, write_ratio: float, seed: int):
+    '''One client process: returns its latencies and the ids it created'''
+    rng = random.Random(seed)
+    session = requests.Session()
+    latencies = []
+    created = []
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        if rng.random() < write_ratio:
+            response = session.post(url + '/expenses/', json={'name': 'bench', 'amount': rng.random() * 100})
+            response.raise_for_status()
+            created.append(response.json()['id'])
+        else:
+            session.get(url + rng.choice(READS)).raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return latencies, created
+
+
+def check_writes(url: str, expected: int, workers: int):
+    '''Ask enough fresh connections that every worker answers at least once'''
+    for _ in range(workers * 4):
+        count = requests.get(url + '/stats/cache', headers={'Connection': 'close'}).json()['size']
+        if count != expected:
+            raise AssertionError(f"A worker holds {count} expenses, {expected} expected: writes were lost")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--records', type=int, default=10_000)
+    parser.add_argument('--clients', type=int, default=8, help="Client processes")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.05)
+    parser.add_argument('--storage-mode', default='journal', choices=['json', 'journal', 'binary'])
+    parser.add_argument('--port', type=int, default=8765)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    url = f'http://127.0.0.1:{args.port}'
+    results = {}
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as data_dir:
+            write_dataset(data_dir, args.records)
+            env = dict(os.environ, TRACKXPENSE_DATA_DIR=data_dir, TRACKXPENSE_BACKEND='file',
+                       TRACKXPENSE_STORAGE_MODE=args.storage_mode, TRACKXPENSE_WORKERS=str(workers))
+            server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'server:app', '--port', str(args.port),
+                                       '--workers', str(workers), '--log-level', 'warning'], env=env)
+            try:
+                wait_until_serving(url, server)
+                # Every worker loads the data on its own, give the last ones time to finish
+                time.sleep(1 + args.records / 100_000 * workers)
+                start = time.perf_counter()
+                with multiprocessing.Pool(args.clients) as pool:
+                    outcomes = pool.starmap(run_client, [(url, args.duration, args.write_ratio, seed)
+                                                         for seed in range(args.clients)])
+                elapsed = time.perf_counter() - start
+                latencies = [latency for client_latencies, _ in outcomes for latency in client_latencies]
+                created = sum(len(client_created) for _, client_created in outcomes)
+                check_writes(url, args.records + created, workers)
+            finally:
+                server.terminate()
+                server.wait()
+        results[f'{workers} worker(s)'] = latency_stats(latencies, elapsed)
+        print(f"{workers} worker(s): {len(latencies) / elapsed:.0f} requests/s, {created} creates, none lost",
+              file=sys.stderr)
+
+    params = {name: getattr(args, name) for name in ('records', 'clients', 'duration', 'write_ratio', 'storage_mode')}
+    sys.exit(report(args, 'workers', params, results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Synthetic, reproducible expense datasets.
+
+The same count and seed always produce the same expenses (ids included), so
+results from different runs and commits are comparable.
+'''
+import hashlib
+import json
+import os
+import random
+import uuid
+from typing import List, Optional
+
+from attachment_store import AttachmentStore
+from file_storage import write_json_atomic
+from data_model import CATEGORY_LIST_REGULAR, CURRENCY_LIST_REGULAR, TAG_LIST_REGULAR
+
+# Distinct attachment contents per dataset, shared by many expenses like real receipts scanned twice
+ATTACHMENT_VARIANTS = 16
+
+
+def generate_expenses(count: int, seed: Optional[int] = 0, attachment_ratio: float = 0.0) -> List[dict]:
+    '''count expenses with random enum fields and amounts; attachment_ratio of them list one attachment'''
+    rng = random.Random(seed)
+    expenses = []
+    for i in range(count):
+        expense_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        expenses.append({
+            'id': expense_id,
+            'name': f'Expense {i}',
+            'category': rng.choice(CATEGORY_LIST_REGULAR),
+            'amount': round(rng.uniform(1, 1000), 2),
+            'currency': rng.choice(CURRENCY_LIST_REGULAR),
+            'tag': rng.choice(TAG_LIST_REGULAR),
+            'notes': '',
+            'attachments': [f'receipt-{i}.pdf'] if rng.random() < attachment_ratio else [],
+        })
+    return expenses
+
+
+def write_dataset(data_dir: str, count: int, seed: Optional[int] = 0, attachment_ratio: float = 0.0,
+                  attachment_bytes: int = 64 * 1024) -> List[dict]:
+    '''
+    Write a generated dataset as expenses.json into data_dir, which every
+    backend starts from (SQLite imports it on first start), and store the
+    listed attachments in its attachment store.
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    expenses = generate_expenses(count, seed, attachment_ratio)
+    with open(os.path.join(data_dir, 'expenses.json'), 'w') as file:
+        json.dump(expenses, file)
+
+    if attachment_ratio:
+        rng = random.Random(seed)
+        store = AttachmentStore(os.path.join(data_dir, 'attachments'))
+        digests = []
+        for _ in range(ATTACHMENT_VARIANTS):
+            content = rng.randbytes(attachment_bytes)
+            digest = hashlib.sha256(content).hexdigest()
+            os.makedirs(os.path.dirname(store.blob_path(digest)), exist_ok=True)
+            with open(store.blob_path(digest), 'wb') as file:
+                file.write(content)
+            digests.append(digest)
+        # One refs.json write for the whole dataset instead of one per AttachmentStore.save
+        refs = {AttachmentStore._ref_key(expense['id'], file_name): digests[i % ATTACHMENT_VARIANTS]
+                for i, expense in enumerate(expenses) for file_name in expense['attachments']}
+        write_json_atomic(store.refs_file, refs)
+        store.close()
+    return expenses
@@ -0,0 +1,154 @@
+'''
+Latency statistics, memory readings and JSON result files shared by the
+benchmark suite, plus the comparison of a run against a stored baseline.
+'''
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Metrics where a lower value is better; every other metric is better when higher
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'peak_rss_mb')
+
+# Metrics compared against a baseline. Only those in REGRESSION_METRICS fail a run, tail latencies
+# over a few hundred samples are too noisy for that.
+COMPARED_METRICS = ('p50_ms', 'p99_ms', 'ops_per_s', 'peak_rss_mb')
+REGRESSION_METRICS = ('p50_ms', 'ops_per_s', 'peak_rss_mb')
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def latency_stats(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    '''p50/p95/p99 and mean in milliseconds, plus operations per second over elapsed seconds'''
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'ops_per_s': len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def current_rss_mb() -> float:
+    '''Resident set size right now, read from /proc where available, else the peak so far'''
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+class RssSampler:
+    '''Tracks the highest resident set size seen while the with-block runs'''
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_mb = current_rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(file_path: str, benchmark: str, params: dict, results: Dict[str, dict]):
+    '''Write {benchmark, params, environment, results} so runs can be compared later'''
+    document = {
+        'benchmark': benchmark,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+    with open(file_path, 'w') as file:
+        json.dump(document, file, indent=4)
+
+
+def compare_to_baseline(file_path: str, params: dict, results: Dict[str, dict], tolerance: float) -> List[str]:
+    '''
+    Print each metric next to its value in the baseline file and return the
+    REGRESSION_METRICS that got worse by more than tolerance (0.1 = 10%).
+    '''
+    with open(file_path, 'r') as file:
+        baseline = json.load(file)
+    if baseline.get('params') != params:
+        print(f"Warning: baseline was run with {baseline.get('params')}", file=sys.stderr)
+
+    regressions = []
+    print(f"\nAgainst baseline {file_path} (commit {baseline.get('commit')}):")
+    for name, metrics in results.items():
+        base_metrics = baseline['results'].get(name)
+        if base_metrics is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in metrics or not base_metrics.get(metric):
+                continue
+            change = metrics[metric] / base_metrics[metric] - 1
+            worse = metric in REGRESSION_METRICS and (change > tolerance if metric in LOWER_IS_BETTER
+                                                       else change < -tolerance)
+            marker = '  REGRESSION' if worse else ''
+            print(f"  {name:<40} {metric:<12} {base_metrics[metric]:10.2f} -> {metrics[metric]:10.2f} "
+                  f"({change:+.0%}){marker}")
+            if worse:
+                regressions.append(f'{name} {metric}')
+    return regressions
+
+
+def print_table(results: Dict[str, dict]):
+    print(f"{'':<40} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10} {'peak RSS MB':>12}")
+    for name, metrics in results.items():
+        print(f"{name:<40} {metrics['count']:>7} {metrics['p50_ms']:>9.3f} {metrics['p95_ms']:>9.3f} "
+              f"{metrics['p99_ms']:>9.3f} {metrics['ops_per_s']:>10.0f} {metrics.get('peak_rss_mb', 0):>12.1f}")
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against results saved earlier with --save")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Relative change against the baseline reported as a regression")
+
+
+def report(args, benchmark: str, params: dict, results: Dict[str, dict]) -> int:
+    '''Print, save and compare results as requested on the command line; return the exit status'''
+    print_table(results)
+    if args.save:
+        save_results(args.save, benchmark, params, results)
+    if args.baseline:
+        regressions = compare_to_baseline(args.baseline, params, results, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}", file=sys.stderr)
+            return 1
+    return 0
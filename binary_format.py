@@ -0,0 +1,246 @@
+'''
+Compact binary encoding of expenses, used by the 'binary' storage mode.
+
+A file starts with MAGIC followed by records:
+
+    u32 payload length | u32 CRC-32 of the payload | u8 op | payload
+
+A delete payload is the UTF-8 expense id. A put payload starts with a fixed
+header: category, currency and tag as one-byte codes (their position in
+CATEGORY_LIST/CURRENCY_LIST/TAG_LIST, 0xFF for None), a flags byte marking
+None fields, the amount as a float64, then the u32 byte lengths of id, name
+and notes and the number of attachments. The UTF-8 id, name and notes
+follow, then each attachment name prefixed with its u32 length. Integers
+are little-endian.
+
+One struct unpack yields every length, so decoding a record costs a few
+slices and no parsing.
+
+Convert a data directory between formats with
+
+    python -m binary_format to-binary data/expenses.json data/expenses.bin
+    python -m binary_format to-json data/expenses.bin data/expenses.json
+'''
+import argparse
+import json
+import mmap
+import struct
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+from data_model import CATEGORY_LIST_REGULAR, CURRENCY_LIST_REGULAR, TAG_LIST_REGULAR
+
+MAGIC = b'TXPBIN1\n'
+
+OP_PUT = 0
+OP_DELETE = 1
+OP_CODES = {'put': OP_PUT, 'delete': OP_DELETE}
+
+# Record header: payload length, payload CRC-32, op
+FRAME = struct.Struct('<IIB')
+# Put payload header: category, currency and tag codes, flags, amount, id/name/notes lengths, attachment count
+HEADER = struct.Struct('<BBBBdIIII')
+LENGTH = struct.Struct('<I')
+
+NULL_CODE = 0xFF
+# Flags bits of the fields that are None; their length or amount is stored as 0
+AMOUNT_NULL = 0x01
+NAME_NULL = 0x02
+NOTES_NULL = 0x04
+ATTACHMENTS_NULL = 0x08
+
+
+def _codes(values: List[str]) -> Tuple[Dict[Optional[str], int], Tuple[Optional[str], ...]]:
+    '''Value -> code for encoding, and a 256 entry code -> value table for decoding'''
+    encode = {value: code for code, value in enumerate(values)}
+    encode[None] = NULL_CODE
+    decode = tuple(values) + (None,) * (256 - len(values))
+    return encode, decode
+
+
+NULL_FLAGS = ((AMOUNT_NULL, 'amount'), (NAME_NULL, 'name'), (NOTES_NULL, 'notes'), (ATTACHMENTS_NULL, 'attachments'))
+
+CATEGORY_CODES, CATEGORIES = _codes(CATEGORY_LIST_REGULAR)
+CURRENCY_CODES, CURRENCIES = _codes(CURRENCY_LIST_REGULAR)
+TAG_CODES, TAGS = _codes(TAG_LIST_REGULAR)
+
+
+def _encode_code(codes: Dict[Optional[str], int], value: Optional[str], field: str) -> int:
+    try:
+        return codes[value]
+    except KeyError:
+        raise ValueError(f"Cannot encode {field} '{value}', it is not one of {list(codes)[:-1]}") from None
+
+
+def encode_expense(expense: dict) -> bytes:
+    amount = expense.get('amount')
+    name = expense.get('name')
+    notes = expense.get('notes')
+    attachments = expense.get('attachments')
+    flags = ((AMOUNT_NULL if amount is None else 0) | (NAME_NULL if name is None else 0) |
+             (NOTES_NULL if notes is None else 0) | (ATTACHMENTS_NULL if attachments is None else 0))
+    expense_id = expense['id'].encode('utf-8')
+    name = (name or '').encode('utf-8')
+    notes = (notes or '').encode('utf-8')
+    parts = [
+        HEADER.pack(_encode_code(CATEGORY_CODES, expense.get('category'), 'category'),
+                    _encode_code(CURRENCY_CODES, expense.get('currency'), 'currency'),
+                    _encode_code(TAG_CODES, expense.get('tag'), 'tag'),
+                    flags, amount or 0.0, len(expense_id), len(name), len(notes), len(attachments or [])),
+        expense_id, name, notes,
+    ]
+    for file_name in attachments or []:
+        data = file_name.encode('utf-8')
+        parts += [LENGTH.pack(len(data)), data]
+    return b''.join(parts)
+
+
+def encode_record(op: str, payload) -> bytes:
+    '''Encode a storage operation: ('put', expense dict) or ('delete', expense id)'''
+    data = encode_expense(payload) if op == 'put' else payload.encode('utf-8')
+    return FRAME.pack(len(data), zlib.crc32(data), OP_CODES[op]) + data
+
+
+def decode_expense(buffer, offset: int) -> dict:
+    '''Decode the put payload starting at offset'''
+    category, currency, tag, flags, amount, id_length, name_length, notes_length, count = \
+        HEADER.unpack_from(buffer, offset)
+    offset += HEADER.size
+    name_start = offset + id_length
+    notes_start = name_start + name_length
+    notes_end = end = notes_start + notes_length
+    attachments = []
+    for _ in range(count):
+        (length,) = LENGTH.unpack_from(buffer, end)
+        attachments.append(str(buffer[end + 4:end + 4 + length], 'utf-8'))
+        end += 4 + length
+    # Same key order as Expense.dict(), so converted JSON matches what the json mode writes
+    expense = {
+        'id': str(buffer[offset:name_start], 'utf-8'),
+        'name': str(buffer[name_start:notes_start], 'utf-8'),
+        'category': CATEGORIES[category],
+        'amount': amount,
+        'currency': CURRENCIES[currency],
+        'tag': TAGS[tag],
+        'notes': str(buffer[notes_start:notes_end], 'utf-8') if notes_length else '',
+        'attachments': attachments,
+    }
+    if flags:
+        for flag, field in NULL_FLAGS:
+            if flags & flag:
+                expense[field] = None
+    return expense
+
+
+def decode_record(buffer, offset: int) -> Tuple[int, object]:
+    '''Decode the record at offset into (op code, expense dict or deleted id)'''
+    length, _, op = FRAME.unpack_from(buffer, offset)
+    start = offset + FRAME.size
+    if op == OP_PUT:
+        return op, decode_expense(buffer, start)
+    return op, str(buffer[start:start + length], 'utf-8')
+
+
+def read_records(buffer, offset: int, expenses: Dict[str, dict],
+                 operations: Optional[list] = None) -> Tuple[int, int]:
+    '''
+    Replay the records of buffer from offset on into expenses, and append
+    them to operations if given. Stops at the end of the buffer or at the first torn
+    or corrupt record. Returns the offset after the last good record and the
+    number of records replayed.
+    '''
+    size = len(buffer)
+    records = 0
+    frame_size = FRAME.size
+    unpack_frame = FRAME.unpack_from
+    crc32 = zlib.crc32
+    while offset + frame_size <= size:
+        length, checksum, op = unpack_frame(buffer, offset)
+        start = offset + frame_size
+        end = start + length
+        if end > size or crc32(buffer[start:end]) != checksum:
+            break
+        if op == OP_PUT:
+            expense = decode_expense(buffer, start)
+            expenses[expense['id']] = expense
+            if operations is not None:
+                operations.append(('put', expense))
+        elif op == OP_DELETE:
+            expense_id = str(buffer[start:end], 'utf-8')
+            expenses.pop(expense_id, None)
+            if operations is not None:
+                operations.append(('delete', expense_id))
+        else:
+            break
+        offset = end
+        records += 1
+    return offset, records
+
+
+def read_operations(buffer, offset: int) -> Tuple[int, list]:
+    '''
+    Like read_records, but return the records of buffer from offset on as
+    storage operations, ('put', expense) or ('delete', expense id), in order.
+    '''
+    operations = []
+    end, _ = read_records(buffer, offset, {}, operations)
+    return end, operations
+
+
+def write_records(file, expenses: Iterable[dict]):
+    '''Write a put record per expense to file'''
+    chunk = []
+    for expense in expenses:
+        chunk.append(encode_record('put', expense))
+        if len(chunk) >= 4096:
+            file.write(b''.join(chunk))
+            chunk = []
+    file.write(b''.join(chunk))
+
+
+def check_magic(buffer, file_path: str):
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{file_path} is not a binary expense file")
+
+
+def load_file(file_path: str) -> Dict[str, dict]:
+    '''All live expenses of a binary file, keyed by id'''
+    expenses = {}
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        check_magic(buffer, file_path)
+        # Slicing a memoryview of the map is cheaper than slicing the map itself
+        with memoryview(buffer) as view:
+            read_records(view, len(MAGIC), expenses)
+    return expenses
+
+
+def json_to_binary(json_path: str, binary_path: str) -> int:
+    with open(json_path, 'r') as file:
+        expenses = json.load(file)
+    with open(binary_path, 'wb') as file:
+        file.write(MAGIC)
+        write_records(file, expenses)
+    return len(expenses)
+
+
+def binary_to_json(binary_path: str, json_path: str, indent: Optional[int] = 4) -> int:
+    expenses = list(load_file(binary_path).values())
+    with open(json_path, 'w') as file:
+        json.dump(expenses, file, indent=indent)
+    return len(expenses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('direction', choices=['to-binary', 'to-json'])
+    parser.add_argument('source')
+    parser.add_argument('target')
+    args = parser.parse_args()
+    if args.direction == 'to-binary':
+        count = json_to_binary(args.source, args.target)
+    else:
+        count = binary_to_json(args.source, args.target)
+    print(f"Converted {count} expenses to {args.target}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+
+def _ids_since(versions: 'OrderedDict[str, int]', since: int) -> List[str]:
+    '''Ids changed after version since, oldest first. versions is kept in version order.'''
+    ids = []
+    for expense_id, version in reversed(versions.items()):
+        if version <= since:
+            break
+        ids.append(expense_id)
+    ids.reverse()
+    return ids
+
+
+class ChangeLog:
+    '''
+    Versions of an in-memory expense table for delta sync.
+
+    Every change bumps version. The log keeps the version at which each live
+    expense was last written and a tombstone for each deleted one, both in
+    version order (an updated id moves to the end), so changes since N are
+    read from the tail in O(changes).
+
+    Versions are not persisted. Each reset starts counting from the current
+    time in microseconds, so versions handed out before a restart or reload
+    fall below floor and are reported as too old. Only the newest
+    max_tombstones deletions are kept; dropping one raises floor.
+    '''
+
+    def __init__(self, max_tombstones: int = 100_000):
+        self.max_tombstones = max_tombstones
+        self.version = 0
+        self.reset()
+
+    def reset(self, version: Optional[int] = None):
+        '''Forget all changes, for when the whole table is reloaded, and start from version if given'''
+        self.version = max(time.time_ns() // 1000, self.version + 1) if version is None else version
+        self.floor = self.version
+        self._written: 'OrderedDict[str, int]' = OrderedDict()
+        self._deleted: 'OrderedDict[str, int]' = OrderedDict()
+
+    def put(self, expense_id: str, version: Optional[int] = None):
+        '''Log a write at the next version, or at version for changes made elsewhere'''
+        self.version = self.version + 1 if version is None else version
+        self._deleted.pop(expense_id, None)
+        self._written[expense_id] = self.version
+        self._written.move_to_end(expense_id)
+
+    def delete(self, expense_id: str, version: Optional[int] = None):
+        self.version = self.version + 1 if version is None else version
+        self._written.pop(expense_id, None)
+        self._deleted[expense_id] = self.version
+        self._deleted.move_to_end(expense_id)
+        if len(self._deleted) > self.max_tombstones:
+            _, self.floor = self._deleted.popitem(last=False)
+
+    def changes_since(self, since: int) -> Optional[Tuple[List[str], List[str]]]:
+        '''
+        Return (written ids, deleted ids) for changes after version since, or
+        None if since is older than floor or newer than version and the
+        caller has to reload everything.
+        '''
+        if since < self.floor or since > self.version:
+            return None
+        return _ids_since(self._written, since), _ids_since(self._deleted, since)
@@ -1,11 +1,21 @@
 import requests
 import json
-import threading
 import time
+import csv
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from pydantic import ValidationError
 
-from server import run_server
+from embedded_server import start_server
+from data_model import Expense
 
 BASE_URL = "http://127.0.0.1:8000"
+# Columns of exported CSV files, imported CSV files may use any subset
+CSV_FIELDS = ['id', 'name', 'category', 'amount', 'currency', 'tag', 'notes', 'attachments']
+# Seconds between progress lines of import/export
+PROGRESS_INTERVAL = 1.0
 
 def add_expense():
     name = input("Enter expense name: ")
@@ -109,13 +119,185 @@ def main():
         else:
             print("Invalid choice. Please try again.")
 
-def start_server():
-    server_thread = threading.Thread(target=run_server)
-    server_thread.daemon = True
-    server_thread.start()
+def open_session(pool_size: int) -> requests.Session:
+    '''Session keeping up to pool_size keep-alive connections to the server'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def detect_format(file_name: str, file_format: str) -> str:
+    if file_format:
+        return file_format
+    return 'csv' if file_name.lower().endswith('.csv') else 'jsonl'
+
+def read_rows(file, file_format: str):
+    '''Yield (line number, record) for every record of a CSV or JSONL file, one at a time'''
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            # Empty cells fall back to the Expense defaults
+            yield reader.line_num, {key: value for key, value in row.items() if key and value not in ('', None)}
+        return
+    for line_number, line in enumerate(file, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                yield line_number, None
+
+def validated_expenses(rows, invalid: list):
+    '''Yield the records that pass Expense validation, collecting the line numbers of the others in invalid'''
+    for line_number, row in rows:
+        if not isinstance(row, dict):
+            invalid.append(line_number)
+            print(f"Skipping line {line_number}: not a JSON object", file=sys.stderr)
+            continue
+        # Imported expenses get new ids, and attachment files are not part of the export
+        row.pop('id', None)
+        row.pop('attachments', None)
+        try:
+            yield Expense(**row)
+        except ValidationError as e:
+            invalid.append(line_number)
+            problems = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+            print(f"Skipping line {line_number}: {problems}", file=sys.stderr)
+
+def batches(expenses, batch_size: int):
+    batch = []
+    for expense in expenses:
+        batch.append({'op': 'create', 'expense': expense.dict(exclude={'id'})})
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Progress:
+    '''Prints counts and throughput to stderr at most every PROGRESS_INTERVAL seconds'''
+
+    def __init__(self, verb: str):
+        self.verb = verb
+        self.done = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+
+    def update(self, done: int, failed: int = 0):
+        self.done += done
+        self.failed += failed
+        now = time.perf_counter()
+        if now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        print(f"{self.verb} {self.done} expenses, {self.failed} failed, {elapsed:.1f} s, {rate:.0f} expenses/s",
+              file=sys.stderr)
+
+def post_batch(session: requests.Session, url: str, batch: list):
+    '''Send one batch, return (created, failed)'''
+    try:
+        response = session.post(f"{url}/expenses/batch", json=batch)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Batch of {len(batch)} failed: {e}", file=sys.stderr)
+        return 0, len(batch)
+    created = sum(1 for result in response.json() if result['status'] == 201)
+    return created, len(batch) - created
+
+def import_expenses(args):
+    file_format = detect_format(args.file, args.format)
+    session = open_session(args.concurrency)
+    progress = Progress('Imported')
+    invalid = []
+
+    with open(args.file, 'r', newline='', encoding='utf-8') as file, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        expenses = validated_expenses(read_rows(file, file_format), invalid)
+        in_flight = set()
+        for batch in batches(expenses, args.batch_size):
+            # At most `concurrency` batches are in memory, however large the file
+            if len(in_flight) >= args.concurrency:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    progress.update(*future.result())
+            in_flight.add(executor.submit(post_batch, session, args.url, batch))
+        for future in in_flight:
+            progress.update(*future.result())
+
+    progress.failed += len(invalid)
+    progress.report()
+    return 1 if progress.failed else 0
+
+def export_expenses(args):
+    file_format = detect_format(args.file, args.format)
+    params = {'stream': 'true'}
+    for field in ('tag', 'category', 'currency'):
+        if getattr(args, field):
+            params[field] = getattr(args, field)
+    progress = Progress('Exported')
+
+    with open_session(1) as session, \
+            session.get(f"{args.url}/expenses/", params=params, stream=True) as response, \
+            open(args.file, 'w', newline='', encoding='utf-8') as file:
+        response.raise_for_status()
+        writer = None
+        if file_format == 'csv':
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+        # The server streams newline-delimited JSON, written out line by line
+        for line in response.iter_lines():
+            if not line:
+                continue
+            if writer is None:
+                file.write(line.decode('utf-8') + '\n')
+            else:
+                expense = json.loads(line)
+                expense['attachments'] = json.dumps(expense.get('attachments') or [])
+                writer.writerow(expense)
+            progress.update(1)
+
+    progress.report()
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Expense Tracker command line client. "
+                                                 "Without a command it starts the interactive menu.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    import_parser = subparsers.add_parser('import', help="Create expenses from a CSV or JSONL file")
+    import_parser.add_argument('file')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension")
+    import_parser.add_argument('--batch-size', type=int, default=500, help="Expenses per /expenses/batch request")
+    import_parser.add_argument('--concurrency', type=int, default=4, help="Batches in flight at once")
+
+    export_parser = subparsers.add_parser('export', help="Write expenses to a CSV or JSONL file")
+    export_parser.add_argument('file')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension")
+    export_parser.add_argument('--tag')
+    export_parser.add_argument('--category')
+    export_parser.add_argument('--currency')
+
+    for subparser in (import_parser, export_parser):
+        subparser.add_argument('--url', default=BASE_URL, help="Server to talk to")
+        subparser.add_argument('--start-server', action='store_true', help="Run the server in this process first")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    start_server()
-    # Wait for the server to start :-)
-    time.sleep(0.5)
-    main()
+    args = parse_args()
+    if args.command is None or args.start_server:
+        try:
+            start_server(getattr(args, 'url', BASE_URL))
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    if args.command == 'import':
+        sys.exit(import_expenses(args))
+    elif args.command == 'export':
+        sys.exit(export_expenses(args))
+    else:
+        main()
@@ -0,0 +1,43 @@
+import gzip
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fast settings: list responses are compressed on every request, not once ahead of time
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    '''Content codings of an Accept-Encoding header that are not refused with q=0'''
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    '''br if the client takes it and brotli is installed, else gzip if the client takes it'''
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
@@ -0,0 +1,50 @@
+import os
+
+# Server configuration, read from the environment at startup
+
+# Directory holding expenses.json / expenses.db and attachments/
+DATA_DIR = os.environ.get('TRACKXPENSE_DATA_DIR', 'data')
+
+# Repository implementation: 'file' (FileExpenseRepository) or 'sqlite' (SqliteExpenseRepository)
+BACKEND = os.environ.get('TRACKXPENSE_BACKEND', 'file')
+
+# Exchange rates used by /expenses/analytics: {"USD": 1.0, "EUR": 1.08, ...} in a common base currency
+RATES_FILE = os.environ.get('TRACKXPENSE_RATES_FILE', os.path.join(DATA_DIR, 'rates.json'))
+
+# File backend only: 'json' rewrites expenses.json on every change, 'journal' appends to expenses.journal,
+# 'binary' appends compact records to expenses.bin
+STORAGE_MODE = os.environ.get('TRACKXPENSE_STORAGE_MODE', 'json')
+
+# File backend only: number of shards the expenses are split into by id, each with its own files; 1 keeps one store
+SHARDS = int(os.environ.get('TRACKXPENSE_SHARDS', '1'))
+
+# Number of server processes. Above 1 they share the data directory, coordinated through lock files
+# (needs fcntl, so not on Windows)
+WORKERS = int(os.environ.get('TRACKXPENSE_WORKERS', '1'))
+
+# File backend only: size of the thread pool running blocking file I/O
+IO_WORKERS = int(os.environ.get('TRACKXPENSE_IO_WORKERS', '4'))
+
+# File backend only: how long the writer waits for more concurrent changes before committing them together
+COMMIT_WINDOW_MS = float(os.environ.get('TRACKXPENSE_COMMIT_WINDOW_MS', '2'))
+
+# File backend only: most changes persisted by a single commit
+COMMIT_MAX_BATCH = int(os.environ.get('TRACKXPENSE_COMMIT_MAX_BATCH', '1000'))
+
+# Files of removed attachments are unlinked in the background at most this many MB per second; 0 means no limit
+ATTACHMENT_PURGE_MB_PER_S = float(os.environ.get('TRACKXPENSE_ATTACHMENT_PURGE_MB_PER_S', '64'))
+
+# Seconds between sweeps queueing attachment files no expense lists for removal; 0 disables them
+ATTACHMENT_SWEEP_INTERVAL_S = float(os.environ.get('TRACKXPENSE_ATTACHMENT_SWEEP_INTERVAL_S', '3600'))
+
+# SQLite backend only: number of pooled connections
+SQLITE_POOL_SIZE = int(os.environ.get('TRACKXPENSE_SQLITE_POOL_SIZE', '4'))
+
+# List responses of at least this many bytes are compressed (brotli or gzip) when the client accepts it; 0 disables it
+COMPRESS_MIN_BYTES = int(os.environ.get('TRACKXPENSE_COMPRESS_MIN_BYTES', '4096'))
+
+# Requests taking at least this long are logged with their size and status; 0 disables the log
+SLOW_REQUEST_MS = float(os.environ.get('TRACKXPENSE_SLOW_REQUEST_MS', '500'))
+
+# Sample the event loop's stack every this many ms and serve the counts at /metrics/profile; 0 disables it
+PROFILER_INTERVAL_MS = float(os.environ.get('TRACKXPENSE_PROFILER_INTERVAL_MS', '0'))
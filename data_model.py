@@ -20,6 +20,29 @@ class Expense(BaseModel):
     attachments: Optional[List[str]] = []
 
 
+class BatchOperation(BaseModel):
+    """One item of a batch request: create needs expense, update needs id and expense, delete needs id"""
+    op: Literal['create', 'update', 'delete']
+    id: Optional[str] = None
+    expense: Optional[Expense] = None
+
+
+class BatchResult(BaseModel):
+    """Outcome of one batch item, status is the HTTP status the single-item endpoint would return"""
+    op: str
+    status: int
+    id: Optional[str] = None
+    expense: Optional[Expense] = None
+    detail: Optional[str] = None
+
+
+class ExpenseChanges(BaseModel):
+    """Expenses created or updated and ids deleted after a version, oldest change first"""
+    version: int
+    expenses: List[Expense] = []
+    deleted: List[str] = []
+
+
 # Extract regular lists from Literal types
 CURRENCY_LIST_REGULAR = list(get_args(CURRENCY_LIST))
 CATEGORY_LIST_REGULAR = list(get_args(CATEGORY_LIST))
@@ -0,0 +1,48 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+# First and longest wait between /health polls while the embedded server starts. Refused
+# connections fail at once, so polls are cheap and the cap keeps the wait close to the start time.
+FIRST_POLL_DELAY = 0.01
+MAX_POLL_DELAY = 0.1
+# Seconds a single poll may take once the server accepts connections
+POLL_TIMEOUT = 2
+
+
+def wait_until_ready(base_url: str, timeout: float = 30, server_thread: threading.Thread = None) -> float:
+    '''
+    Poll /health with exponential backoff until the server answers, and
+    return the seconds waited. Raises RuntimeError if the server thread
+    stops first or the timeout passes.
+    '''
+    start = time.monotonic()
+    delay = FIRST_POLL_DELAY
+    while True:
+        try:
+            requests.get(f"{base_url}/health", timeout=POLL_TIMEOUT).raise_for_status()
+            return time.monotonic() - start
+        except requests.RequestException:
+            pass
+        if server_thread is not None and not server_thread.is_alive():
+            raise RuntimeError(f"The embedded server stopped before answering at {base_url}")
+        if time.monotonic() - start + delay > timeout:
+            raise RuntimeError(f"The server did not answer at {base_url} within {timeout} s")
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_POLL_DELAY)
+
+
+def run_embedded_server(port: int):
+    # FastAPI, uvicorn and the repository are only imported when a client really runs the server
+    from server import run_server
+    run_server(port=port)
+
+
+def start_server(base_url: str, timeout: float = 30) -> float:
+    '''Run the server in a daemon thread on the port of base_url and wait until it is ready'''
+    server_thread = threading.Thread(target=run_embedded_server, args=(urlsplit(base_url).port or 8000,),
+                                     daemon=True)
+    server_thread.start()
+    return wait_until_ready(base_url, timeout, server_thread)
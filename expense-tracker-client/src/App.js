@@ -1,14 +1,28 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 import ExpenseList from './components/ExpenseList';
 import ExpenseForm from './components/ExpenseForm';
 import ExpenseDetails from './components/ExpenseDetails';
 
 const BASE_URL = "http://127.0.0.1:8000";
+const PAGE_SIZE = 500;
+
+// Merge a /expenses/changes response into the current list
+const applyChanges = (current, changes) => {
+  const deleted = new Set(changes.deleted);
+  const changed = new Map(changes.expenses.map((expense) => [expense.id, expense]));
+  const known = new Set(current.map((expense) => expense.id));
+  return current
+    .filter((expense) => !deleted.has(expense.id))
+    .map((expense) => changed.get(expense.id) || expense)
+    .concat(changes.expenses.filter((expense) => !known.has(expense.id)));
+};
 
 function App() {
   const [expenses, setExpenses] = useState([]);
   const [selectedExpense, setSelectedExpense] = useState(null);
+  // Version of the data held in expenses, null until the first full load
+  const version = useRef(null);
 
   useEffect(() => {
     loadExpenses();
@@ -16,17 +30,48 @@ function App() {
 
   const loadExpenses = async () => {
     try {
-      const response = await axios.get(`${BASE_URL}/expenses/all`);
-      setExpenses(response.data);
+      // Fetch one page at a time and render each as soon as it arrives
+      let loaded = [];
+      let cursor = null;
+      do {
+        const params = { limit: PAGE_SIZE };
+        if (cursor) {
+          params.cursor = cursor;
+        }
+        const response = await axios.get(`${BASE_URL}/expenses/all`, { params });
+        if (!cursor) {
+          version.current = Number(response.headers['x-expenses-version']);
+        }
+        loaded = loaded.concat(response.data);
+        setExpenses(loaded);
+        cursor = response.headers['x-next-cursor'];
+      } while (cursor);
     } catch (error) {
       console.error("Failed to load expenses", error);
     }
   };
 
+  // Fetch only what changed since the last load, falling back to a full load
+  const syncExpenses = async () => {
+    if (version.current === null) {
+      return loadExpenses();
+    }
+    try {
+      const response = await axios.get(`${BASE_URL}/expenses/changes`, { params: { since: version.current } });
+      version.current = response.data.version;
+      setExpenses((current) => applyChanges(current, response.data));
+    } catch (error) {
+      if (error.response && error.response.status === 410) {
+        return loadExpenses();
+      }
+      console.error("Failed to sync expenses", error);
+    }
+  };
+
   const addExpense = async (expense) => {
     try {
       await axios.post(`${BASE_URL}/expenses/`, expense);
-      loadExpenses();
+      syncExpenses();
     } catch (error) {
       console.error("Failed to add expense", error);
     }
@@ -35,7 +80,7 @@ function App() {
   const updateExpense = async (expense) => {
     try {
       await axios.put(`${BASE_URL}/expenses/${expense.id}`, expense);
-      loadExpenses();
+      syncExpenses();
       setSelectedExpense(null);
     } catch (error) {
       console.error("Failed to update expense", error);
@@ -45,7 +90,7 @@ function App() {
   const deleteExpense = async (id) => {
     try {
       await axios.delete(`${BASE_URL}/expenses/${id}`);
-      loadExpenses();
+      syncExpenses();
       setSelectedExpense(null);
     } catch (error) {
       console.error("Failed to delete expense", error);
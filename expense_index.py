@@ -0,0 +1,141 @@
+import bisect
+import math
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+class FieldIndex:
+    '''
+    Maps each value of one expense field to the set of row positions of the
+    expenses having it. Positions are small ints, so sets intersect and sort
+    much faster than sets of id strings would.
+    '''
+
+    def __init__(self, field: str):
+        self.field = field
+        self._rows: Dict[Optional[str], Set[int]] = {}
+
+    def add(self, row: int, expense: dict):
+        self._rows.setdefault(expense.get(self.field), set()).add(row)
+
+    def remove(self, row: int, expense: dict):
+        value = expense.get(self.field)
+        rows = self._rows.get(value)
+        if rows is not None:
+            rows.discard(row)
+            if not rows:
+                del self._rows[value]
+
+    def clear(self):
+        self._rows = {}
+
+    def lookup(self, value: Optional[str]) -> Set[int]:
+        return self._rows.get(value, set())
+
+
+class AttachmentIndex:
+    '''
+    The (expense id, file name) pair of every attachment, so checking that a
+    download names an attachment of its expense is one set lookup.
+    '''
+
+    def __init__(self):
+        self._keys: Set[Tuple[str, str]] = set()
+
+    def add(self, row: int, expense: dict):
+        for file_name in expense.get('attachments') or ():
+            self._keys.add((expense['id'], file_name))
+
+    def remove(self, row: int, expense: dict):
+        for file_name in expense.get('attachments') or ():
+            self._keys.discard((expense['id'], file_name))
+
+    def clear(self):
+        self._keys = set()
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self._keys
+
+    def snapshot(self) -> Set[Tuple[str, str]]:
+        return set(self._keys)
+
+
+def in_amount_range(expense: dict, min_amount: Optional[float], max_amount: Optional[float]) -> bool:
+    amount = expense.get('amount') or 0.0
+    return (min_amount is None or amount >= min_amount) and (max_amount is None or amount <= max_amount)
+
+
+class SortedIndex:
+    '''
+    Expenses ordered by a numeric field, kept as a sorted list of (value, id)
+    keys; None counts as 0, as in the summaries. A range or top-k read
+    bisects to its first key and walks k keys, O(log n + k). Keys added
+    since the last read are sorted in on the next one, so building the
+    index from scratch is one sort rather than n inserts.
+    '''
+
+    def __init__(self, field: str):
+        self.field = field
+        self.clear()
+
+    def clear(self):
+        self._keys: List[Tuple[float, str]] = []
+        self._pending: List[Tuple[float, str]] = []
+
+    def key(self, expense: dict) -> Tuple[float, str]:
+        return (expense.get(self.field) or 0.0, expense['id'])
+
+    def add(self, row: int, expense: dict):
+        self._pending.append(self.key(expense))
+
+    def remove(self, row: int, expense: dict):
+        self._merge()
+        key = self.key(expense)
+        position = bisect.bisect_left(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            del self._keys[position]
+
+    def _merge(self):
+        if len(self._pending) > 64:
+            self._keys += self._pending
+            self._keys.sort()
+        else:
+            for key in self._pending:
+                bisect.insort(self._keys, key)
+        self._pending = []
+
+    def _bounds(self, low: Optional[float], high: Optional[float]) -> Tuple[int, int]:
+        '''Positions of the first key with value >= low and of the first one with value > high'''
+        self._merge()
+        keys = self._keys
+        start = 0 if low is None else bisect.bisect_left(keys, (low,))
+        # (value,) sorts before every (value, id), so the next float up bounds the values equal to high
+        end = len(keys) if high is None else bisect.bisect_left(keys, (math.nextafter(high, math.inf),))
+        return start, max(start, end)
+
+    def count(self, low: Optional[float] = None, high: Optional[float] = None) -> int:
+        start, end = self._bounds(low, high)
+        return end - start
+
+    def select(self, low: Optional[float] = None, high: Optional[float] = None, descending: bool = False,
+               after: Optional[Tuple[float, str]] = None) -> Iterator[str]:
+        '''
+        Ids of the expenses with low <= value <= high, in value then id order
+        (reversed if descending), starting after the key after.
+        '''
+        keys = self._keys
+        start, end = self._bounds(low, high)
+        if after is not None:
+            if descending:
+                end = min(end, bisect.bisect_left(keys, after))
+            else:
+                start = max(start, bisect.bisect_right(keys, after))
+        positions = range(end - 1, start - 1, -1) if descending else range(start, end)
+        return (keys[position][1] for position in positions)
+
+
+def intersect(row_sets: Iterable[Set[int]]) -> Set[int]:
+    '''Intersect row sets starting from the smallest, so the cost follows the result size'''
+    row_sets = sorted(row_sets, key=len)
+    if not row_sets:
+        return set()
+    return row_sets[0].intersection(*row_sets[1:])
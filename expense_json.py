@@ -0,0 +1,64 @@
+import json
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from data_model import Expense
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value) -> bytes:
+    '''Compact UTF-8 JSON, with orjson when it is installed'''
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def encode_expense(expense: dict) -> bytes:
+    '''Validate a stored expense as the response model would and encode it'''
+    return dumps(Expense(**expense).dict())
+
+
+def join_array(items: Iterable[bytes]) -> bytes:
+    return b'[' + b','.join(items) + b']'
+
+
+class ExpensesJson(NamedTuple):
+    '''A list response already encoded as a JSON array, with its length and last id for X-Next-Cursor'''
+    body: bytes
+    count: int
+    last_id: Optional[str]
+
+    @classmethod
+    def from_expenses(cls, expenses: List[Expense]) -> 'ExpensesJson':
+        return cls(join_array(dumps(expense.dict()) for expense in expenses), len(expenses),
+                   expenses[-1].id if expenses else None)
+
+
+class EncodedExpenses:
+    '''
+    JSON bytes of cached expenses by row, so list responses are built by
+    joining them instead of validating and encoding every expense again.
+    Rows are encoded on their first read and dropped when their expense
+    changes, so loading the expenses costs nothing extra.
+    '''
+
+    def __init__(self):
+        self._encoded: Dict[int, bytes] = {}
+
+    def add(self, row: int, expense: dict):
+        pass
+
+    def remove(self, row: int, expense: dict):
+        self._encoded.pop(row, None)
+
+    def clear(self):
+        self._encoded = {}
+
+    def get(self, row: int, expense: dict) -> bytes:
+        encoded = self._encoded.get(row)
+        if encoded is None:
+            encoded = self._encoded[row] = encode_expense(expense)
+        return encoded
@@ -0,0 +1,682 @@
+import os
+import json
+import mmap
+import logging
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Tuple
+from metrics import timed
+import binary_format
+
+logger = logging.getLogger(__name__)
+
+# A storage operation is either ('put', expense_dict) or ('delete', expense_id)
+Operation = Tuple[str, object]
+
+
+def apply_operations(expenses: Dict[str, dict], operations: List[Operation]):
+    '''Apply storage operations to an id-keyed expense dict'''
+    for op, payload in operations:
+        if op == 'put':
+            expenses[payload['id']] = payload
+        elif op == 'delete':
+            expenses.pop(payload, None)
+        else:
+            raise ValueError(f"Unknown storage operation: {op}")
+
+
+class StagedExpenses(Mapping):
+    '''
+    The expenses of base with storage operations staged on top, in the order
+    a dict would hold them once the operations are applied. base itself is
+    left alone, so its readers keep seeing the committed state until the
+    operations are durable.
+    '''
+
+    def __init__(self, base: Dict[str, dict]):
+        self._base = base
+        # Staged expense by id, None for an expense of base deleted here
+        self._staged: Dict[str, Optional[dict]] = {}
+        # Expenses of base deleted and put again: a dict moves them to its end
+        self._moved = set()
+        self._size = len(base)
+
+    def stage(self, operations: List[Operation]):
+        for op, payload in operations:
+            if op == 'put':
+                expense_id = payload['id']
+                if expense_id not in self:
+                    self._size += 1
+                    self._staged.pop(expense_id, None)
+                    if expense_id in self._base:
+                        self._moved.add(expense_id)
+                self._staged[expense_id] = payload
+            elif op == 'delete':
+                if payload in self:
+                    self._size -= 1
+                    if payload in self._base:
+                        self._staged[payload] = None
+                    else:
+                        del self._staged[payload]
+            else:
+                raise ValueError(f"Unknown storage operation: {op}")
+
+    def __getitem__(self, expense_id: str) -> dict:
+        if expense_id in self._staged:
+            expense = self._staged[expense_id]
+            if expense is None:
+                raise KeyError(expense_id)
+            return expense
+        return self._base[expense_id]
+
+    def get(self, expense_id: str, default=None):
+        if expense_id in self._staged:
+            expense = self._staged[expense_id]
+            return default if expense is None else expense
+        return self._base.get(expense_id, default)
+
+    def __contains__(self, expense_id) -> bool:
+        if expense_id in self._staged:
+            return self._staged[expense_id] is not None
+        return expense_id in self._base
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[str]:
+        for expense_id, _ in self.items():
+            yield expense_id
+
+    def items(self):
+        staged = self._staged
+        for expense_id, expense in self._base.items():
+            if expense_id in staged:
+                if expense_id in self._moved or staged[expense_id] is None:
+                    continue
+                expense = staged[expense_id]
+            yield expense_id, expense
+        for expense_id, expense in staged.items():
+            if expense is not None and (expense_id not in self._base or expense_id in self._moved):
+                yield expense_id, expense
+
+    def values(self):
+        for _, expense in self.items():
+            yield expense
+
+
+def diff_operations(old: Dict[str, dict], new: Dict[str, dict]) -> List[Operation]:
+    '''The operations turning the expenses old into new'''
+    operations: List[Operation] = [('put', expense) for expense_id, expense in new.items()
+                                   if old.get(expense_id) != expense]
+    operations += [('delete', expense_id) for expense_id in old if expense_id not in new]
+    return operations
+
+
+def _fsync_dir(path: str):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(file_path: str, data, indent: Optional[int] = None):
+    '''Write data as JSON to a temp file, fsync it and rename it over file_path'''
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=indent)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+    _fsync_dir(os.path.dirname(file_path) or '.')
+
+
+class JsonFileStorage:
+    '''
+    Keeps all expenses in expenses.json and rewrites it on every commit.
+
+    With shared=True the files are shared by several processes, which hold a
+    StoreLock around every load and commit. Compactions then run inside the
+    commit that triggers them rather than on a background thread, so they
+    happen under that lock too.
+    '''
+
+    def __init__(self, data_dir: str, shared: bool = False):
+        self.data_dir = data_dir
+        self.shared = shared
+        self.expenses_data_file = os.path.join(data_dir, 'expenses.json')
+        self._lock = threading.Lock()
+        self._signature = None
+
+    def _read_signature(self):
+        stat_result = os.stat(self.expenses_data_file)
+        return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+    def ensure_files(self):
+        if not os.path.exists(self.expenses_data_file):
+            with open(self.expenses_data_file, 'w') as file:
+                json.dump([], file)
+
+    def changed_on_disk(self) -> bool:
+        '''
+        True if the files were modified by someone else since the last load or
+        commit. Lock-free while they are unchanged, so it never waits on a
+        commit running in another thread. A difference is checked again under
+        the lock, as it may be a commit or compaction of this process between
+        replacing a file and recording its signature.
+        '''
+        if self._read_signature() == self._signature:
+            return False
+        with self._lock:
+            return self._read_signature() != self._signature
+
+    def invalidate(self):
+        self._signature = None
+
+    def load_changes(self) -> Optional[List[Operation]]:
+        '''
+        The operations another process committed since the last load or
+        commit, in commit order, or None if they cannot be told apart from a
+        full load. expenses.json is rewritten whole, so always None.
+        '''
+        return None
+
+    def load(self) -> Dict[str, dict]:
+        with self._lock, timed('load', 'parse'):
+            with open(self.expenses_data_file, 'r') as file:
+                expenses = json.load(file)
+            self._signature = self._read_signature()
+        return {expense['id']: expense for expense in expenses}
+
+    def commit(self, expenses: Mapping[str, dict], operations: List[Operation]):
+        '''Persist operations already applied to expenses'''
+        # Encoding and writing are one pass through json.dump, so both count as write here
+        with self._lock, timed('commit', 'write'):
+            write_json_atomic(self.expenses_data_file, list(expenses.values()), indent=4)
+            self._signature = self._read_signature()
+
+    def close(self):
+        pass
+
+
+class JournalFileStorage(JsonFileStorage):
+    '''
+    Keeps a snapshot in expenses.json plus an append-only expenses.journal.
+    Every commit appends one JSON line per operation and fsyncs the journal.
+    Once the journal crosses compact_bytes, or holds more than compact_ratio
+    entries per live expense, a background thread writes a new snapshot,
+    renames it into place and drops the journal entries it covers.
+    Replaying put/delete operations is idempotent, so a crash at any point of
+    compaction still replays to the same state.
+    '''
+
+    def __init__(self, data_dir: str, shared: bool = False, compact_bytes: int = 16 * 1024 * 1024,
+                 compact_ratio: float = 1.0, compact_min_entries: int = 1000):
+        super().__init__(data_dir, shared)
+        self.journal_file = os.path.join(data_dir, 'expenses.journal')
+        self.compact_bytes = compact_bytes
+        self.compact_ratio = compact_ratio
+        self.compact_min_entries = compact_min_entries
+        self._journal_entries = 0
+        self._journal_size = 0
+        self._compaction_thread = None
+
+    def _read_signature(self):
+        journal_stat = os.stat(self.journal_file)
+        return (super()._read_signature(), (journal_stat.st_ino, journal_stat.st_mtime_ns, journal_stat.st_size))
+
+    def ensure_files(self):
+        super().ensure_files()
+        if not os.path.exists(self.journal_file):
+            open(self.journal_file, 'a').close()
+
+    def load(self) -> Dict[str, dict]:
+        with self._lock, timed('load', 'parse'):
+            with open(self.expenses_data_file, 'r') as file:
+                expenses = {expense['id']: expense for expense in json.load(file)}
+
+            entries = 0
+            valid_size = 0
+            with open(self.journal_file, 'rb') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash, everything after it is unusable
+                        logger.warning("Discarding corrupt journal tail at offset %d", valid_size)
+                        break
+                    apply_operations(expenses, [(record['op'], record['data'])])
+                    entries += 1
+                    valid_size += len(line)
+
+            if valid_size != os.path.getsize(self.journal_file):
+                with open(self.journal_file, 'rb+') as file:
+                    file.truncate(valid_size)
+
+            self._journal_entries = entries
+            self._journal_size = valid_size
+            self._signature = self._read_signature()
+        return expenses
+
+    def load_changes(self) -> Optional[List[Operation]]:
+        '''The journal lines appended since the last load or commit, None if the journal was compacted'''
+        with self._lock:
+            if self._signature is None:
+                return None
+            snapshot_signature, (journal_inode, _, _) = self._signature
+            journal_stat = os.stat(self.journal_file)
+            if (super()._read_signature() != snapshot_signature or journal_stat.st_ino != journal_inode
+                    or journal_stat.st_size < self._journal_size):
+                return None
+            with timed('load', 'parse'), open(self.journal_file, 'rb') as file:
+                file.seek(self._journal_size)
+                appended = file.read()
+                operations = []
+                for line in appended.splitlines(keepends=True):
+                    try:
+                        record = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        # Torn or corrupt tail, a full load truncates it
+                        return None
+                    operations.append((record['op'], record['data']))
+            self._journal_entries += len(operations)
+            self._journal_size += len(appended)
+            self._signature = self._read_signature()
+        return operations
+
+    def commit(self, expenses: Mapping[str, dict], operations: List[Operation]):
+        with timed('commit', 'serialize'):
+            lines = b''.join(
+                json.dumps({'op': op, 'data': payload}).encode() + b'\n' for op, payload in operations
+            )
+        with self._lock:
+            with open(self.journal_file, 'ab') as file, timed('commit', 'write'):
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+            self._journal_entries += len(operations)
+            self._journal_size += len(lines)
+            self._signature = self._read_signature()
+
+            compact = self._needs_compaction(len(expenses))
+            if compact and not self.shared:
+                # Shallow copy: stored expense dicts are replaced on change, never mutated
+                snapshot = list(expenses.values())
+                self._compaction_thread = threading.Thread(
+                    target=self._compact, args=(snapshot, self._journal_size), daemon=True)
+                self._compaction_thread.start()
+        if compact and self.shared:
+            # Other processes append too, so compact now, while the caller holds the store lock
+            self._compact(list(expenses.values()), self._journal_size)
+
+    def _needs_compaction(self, live_count: int) -> bool:
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return False
+        if self._journal_size >= self.compact_bytes:
+            return True
+        return (self._journal_entries >= self.compact_min_entries and
+                self._journal_entries > self.compact_ratio * live_count)
+
+    def _compact(self, snapshot: List[dict], journal_offset: int):
+        try:
+            # Written aside first: the files only change under the lock, together with their signature
+            snapshot_path = self.expenses_data_file + '.tmp'
+            with timed('compact', 'write'), open(snapshot_path, 'w') as file:
+                json.dump(snapshot, file)
+                file.flush()
+                os.fsync(file.fileno())
+            with self._lock:
+                # Keep only the entries appended while the snapshot was written
+                with open(self.journal_file, 'rb') as file:
+                    file.seek(journal_offset)
+                    tail = file.read()
+                tmp_path = self.journal_file + '.tmp'
+                with open(tmp_path, 'wb') as file:
+                    file.write(tail)
+                    file.flush()
+                    os.fsync(file.fileno())
+                # Snapshot first: until the journal is replaced too, replaying all of it is still correct
+                os.replace(snapshot_path, self.expenses_data_file)
+                os.replace(tmp_path, self.journal_file)
+                _fsync_dir(self.data_dir)
+                self._journal_entries = tail.count(b'\n')
+                self._journal_size = len(tail)
+                self._signature = self._read_signature()
+            logger.info("Compacted expense journal into a snapshot of %d expenses", len(snapshot))
+        except Exception:
+            logger.exception("Expense journal compaction failed")
+
+    def close(self):
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+
+
+class BinaryFileStorage(JsonFileStorage):
+    '''
+    Keeps expenses in expenses.bin, an append-only file of length-prefixed
+    binary records (see binary_format) about a third the size of
+    expenses.json. Every commit appends one record per operation and fsyncs.
+    Loads decode the file through mmap, without copying it first. Once
+    superseded records outnumber live ones (and there are at least
+    compact_min_entries of them), a background thread rewrites the live
+    records into a new file and renames it into place.
+
+    On first start an existing expenses.json (and expenses.journal) is
+    converted into expenses.bin.
+    '''
+
+    def __init__(self, data_dir: str, shared: bool = False, compact_ratio: float = 1.0,
+                 compact_min_entries: int = 1000):
+        super().__init__(data_dir, shared)
+        self.json_data_file = self.expenses_data_file
+        self.expenses_data_file = os.path.join(data_dir, 'expenses.bin')
+        self.compact_ratio = compact_ratio
+        self.compact_min_entries = compact_min_entries
+        self._records = 0
+        self._size = 0
+        self._compaction_thread = None
+
+    def ensure_files(self):
+        if os.path.exists(self.expenses_data_file):
+            return
+        expenses = load_file_store(self.data_dir)
+        tmp_path = self.expenses_data_file + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(binary_format.MAGIC)
+            binary_format.write_records(file, expenses.values())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.expenses_data_file)
+        _fsync_dir(self.data_dir)
+        if expenses:
+            logger.info("Converted %d expenses to %s", len(expenses), self.expenses_data_file)
+
+    def load(self) -> Dict[str, dict]:
+        expenses = {}
+        with self._lock, timed('load', 'parse'):
+            with open(self.expenses_data_file, 'rb') as file, \
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                binary_format.check_magic(mapped, self.expenses_data_file)
+                with memoryview(mapped) as view:
+                    valid_size, records = binary_format.read_records(view, len(binary_format.MAGIC), expenses)
+                mapped_size = len(mapped)
+
+            if valid_size != mapped_size:
+                # Torn write from a crash, everything after it is unusable
+                logger.warning("Discarding corrupt binary records at offset %d", valid_size)
+                with open(self.expenses_data_file, 'rb+') as file:
+                    file.truncate(valid_size)
+
+            self._records = records
+            self._size = valid_size
+            self._signature = self._read_signature()
+        return expenses
+
+    def load_changes(self) -> Optional[List[Operation]]:
+        '''The records appended since the last load or commit, None if the file was compacted'''
+        with self._lock:
+            if self._signature is None:
+                return None
+            stat_result = os.stat(self.expenses_data_file)
+            if stat_result.st_ino != self._signature[0] or stat_result.st_size < self._size:
+                return None
+            with timed('load', 'parse'), open(self.expenses_data_file, 'rb') as file:
+                file.seek(self._size)
+                appended = file.read()
+                end, operations = binary_format.read_operations(appended, 0)
+            if end != len(appended):
+                # Torn tail, a full load truncates it
+                return None
+            self._records += len(operations)
+            self._size += len(appended)
+            self._signature = self._read_signature()
+        return operations
+
+    def commit(self, expenses: Mapping[str, dict], operations: List[Operation]):
+        with timed('commit', 'serialize'):
+            records = [binary_format.encode_record(op, payload) for op, payload in operations]
+        with self._lock:
+            with open(self.expenses_data_file, 'ab') as file, timed('commit', 'write'):
+                file.write(b''.join(records))
+                file.flush()
+                os.fsync(file.fileno())
+            self._size += sum(len(record) for record in records)
+            self._records += len(records)
+            self._signature = self._read_signature()
+
+            compact = self._needs_compaction(len(expenses))
+            if compact and not self.shared:
+                # Shallow copy: stored expense dicts are replaced on change, never mutated
+                snapshot = list(expenses.values())
+                self._compaction_thread = threading.Thread(
+                    target=self._compact, args=(snapshot, self._size), daemon=True)
+                self._compaction_thread.start()
+        if compact and self.shared:
+            # Other processes append too, so compact now, while the caller holds the store lock
+            self._compact(list(expenses.values()), self._size)
+
+    def _needs_compaction(self, live_count: int) -> bool:
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return False
+        superseded = self._records - live_count
+        return superseded >= self.compact_min_entries and superseded > self.compact_ratio * live_count
+
+    def _compact(self, snapshot: List[dict], file_offset: int):
+        try:
+            tmp_path = self.expenses_data_file + '.tmp'
+            with timed('compact', 'write'), open(tmp_path, 'wb') as file:
+                file.write(binary_format.MAGIC)
+                binary_format.write_records(file, snapshot)
+                snapshot_size = file.tell()
+            with self._lock:
+                # Carry over the records appended while the snapshot was written
+                with open(self.expenses_data_file, 'rb') as file:
+                    file.seek(file_offset)
+                    tail = file.read()
+                _, tail_records = binary_format.read_records(tail, 0, {})
+                with open(tmp_path, 'ab') as file:
+                    file.write(tail)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.expenses_data_file)
+                _fsync_dir(self.data_dir)
+                self._records = len(snapshot) + tail_records
+                self._size = snapshot_size + len(tail)
+                self._signature = self._read_signature()
+            logger.info("Compacted binary expense file to %d expenses", len(snapshot))
+        except Exception:
+            logger.exception("Binary expense file compaction failed")
+
+    def close(self):
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+
+
+STORAGE_MODES = {
+    'json': JsonFileStorage,
+    'journal': JournalFileStorage,
+    'binary': BinaryFileStorage,
+}
+
+
+def shard_of(expense_id: str, shard_count: int) -> int:
+    '''Shard number of an expense id, stable across processes (unlike the salted hash())'''
+    return zlib.crc32(expense_id.encode('utf-8')) % shard_count
+
+
+def shard_dir(shards_dir: str, shard: int) -> str:
+    return os.path.join(shards_dir, f'{shard:03d}')
+
+
+def load_file_store(data_dir: str) -> Dict[str, dict]:
+    '''
+    All expenses of a data directory written by any storage mode, sharded or
+    not; {} if it holds none. Used to convert or import existing data.
+    '''
+    manifest_file = os.path.join(data_dir, 'shards', 'shards.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as file:
+            shard_count = json.load(file)['shards']
+        expenses = {}
+        for shard in range(shard_count):
+            expenses.update(load_file_store(shard_dir(os.path.dirname(manifest_file), shard)))
+        return expenses
+
+    if os.path.exists(os.path.join(data_dir, 'expenses.bin')):
+        storage = BinaryFileStorage(data_dir)
+    elif os.path.exists(os.path.join(data_dir, 'expenses.json')):
+        if os.path.exists(os.path.join(data_dir, 'expenses.journal')):
+            storage = JournalFileStorage(data_dir)
+        else:
+            storage = JsonFileStorage(data_dir)
+    else:
+        return {}
+    try:
+        return storage.load()
+    finally:
+        storage.close()
+
+
+def write_file_store(storage_mode: str, data_dir: str, expenses: Dict[str, dict]):
+    '''Write expenses into an empty data_dir with storage_mode'''
+    os.makedirs(data_dir, exist_ok=True)
+    storage = STORAGE_MODES[storage_mode](data_dir)
+    try:
+        storage.ensure_files()
+        storage.load()
+        if expenses:
+            storage.commit(expenses, [('put', expense) for expense in expenses.values()])
+    finally:
+        storage.close()
+
+
+def write_shards(storage_mode: str, shards_dir: str, shard_count: int, expenses: Dict[str, dict]):
+    '''Split expenses into shard_count shards under an empty shards_dir, then write its manifest'''
+    shards = [{} for _ in range(shard_count)]
+    for expense_id, expense in expenses.items():
+        shards[shard_of(expense_id, shard_count)][expense_id] = expense
+    for shard, shard_expenses in enumerate(shards):
+        write_file_store(storage_mode, shard_dir(shards_dir, shard), shard_expenses)
+    # Written last: without it the directory is an incomplete conversion and gets redone
+    write_json_atomic(os.path.join(shards_dir, 'shards.json'), {'shards': shard_count})
+
+
+class ShardedStorage:
+    '''
+    Splits expenses across shard_count storages of storage_mode, in
+    data_dir/shards/000, 001..., by a hash of the expense id. Every shard has
+    its own files and lock: a commit only writes the shards its operations
+    touch, in parallel, and a load reads the shards in parallel and only
+    re-reads those changed on disk since they were last read.
+
+    data_dir/shards/shards.json records the shard count; change it with
+    python -m reshard. On first start the unsharded data in data_dir is
+    split into shards.
+    '''
+
+    def __init__(self, storage_mode: str, data_dir: str, shard_count: int, shared: bool = False):
+        self.data_dir = data_dir
+        self.storage_mode = storage_mode
+        self.shard_count = shard_count
+        self.shards_dir = os.path.join(data_dir, 'shards')
+        self.expenses_data_file = os.path.join(self.shards_dir, 'shards.json')
+        self.shards = [STORAGE_MODES[storage_mode](shard_dir(self.shards_dir, shard), shared)
+                       for shard in range(shard_count)]
+        # Expenses of every shard as of its last load or commit, None when it must be re-read
+        self._shard_expenses: List[Optional[Dict[str, dict]]] = [None] * shard_count
+        self._executor = ThreadPoolExecutor(max_workers=shard_count, thread_name_prefix='expense-shard')
+
+    def ensure_files(self):
+        if not os.path.exists(self.expenses_data_file):
+            expenses = load_file_store(self.data_dir)
+            write_shards(self.storage_mode, self.shards_dir, self.shard_count, expenses)
+            logger.info("Split %d expenses into %d shards in %s", len(expenses), self.shard_count, self.shards_dir)
+
+        with open(self.expenses_data_file, 'r') as file:
+            shard_count = json.load(file)['shards']
+        if shard_count != self.shard_count:
+            raise ValueError(f"{self.shards_dir} holds {shard_count} shards, not {self.shard_count}; "
+                             f"change the count with python -m reshard")
+        for shard in self.shards:
+            os.makedirs(shard.data_dir, exist_ok=True)
+            shard.ensure_files()
+
+    def _shard_changed(self, shard: int) -> bool:
+        if self._shard_expenses[shard] is None:
+            return True
+        try:
+            return self.shards[shard].changed_on_disk()
+        except FileNotFoundError:
+            return True
+
+    def changed_on_disk(self) -> bool:
+        return any(self._shard_changed(shard) for shard in range(self.shard_count))
+
+    def invalidate(self):
+        for shard in range(self.shard_count):
+            self.shards[shard].invalidate()
+            self._shard_expenses[shard] = None
+
+    def _map(self, func, shards: List[int]) -> list:
+        '''Run func(shard) for every shard in parallel, inline when there is only one'''
+        if len(shards) == 1:
+            return [func(shards[0])]
+        return list(self._executor.map(func, shards))
+
+    def load_changes(self) -> Optional[List[Operation]]:
+        '''
+        The changes of the one shard changed on disk, if its storage can tell
+        them. Changes from several shards cannot be put back in commit order,
+        so then None.
+        '''
+        changed = [shard for shard in range(self.shard_count) if self._shard_changed(shard)]
+        if not changed:
+            return []
+        if len(changed) > 1 or self._shard_expenses[changed[0]] is None:
+            return None
+        operations = self.shards[changed[0]].load_changes()
+        if operations is not None:
+            apply_operations(self._shard_expenses[changed[0]], operations)
+        return operations
+
+    def load(self) -> Dict[str, dict]:
+        changed = [shard for shard in range(self.shard_count) if self._shard_changed(shard)]
+        if changed:
+            for shard, expenses in zip(changed, self._map(lambda shard: self.shards[shard].load(), changed)):
+                self._shard_expenses[shard] = expenses
+        merged = {}
+        for expenses in self._shard_expenses:
+            merged.update(expenses)
+        return merged
+
+    def commit(self, expenses: Mapping[str, dict], operations: List[Operation]):
+        by_shard: Dict[int, List[Operation]] = {}
+        for op, payload in operations:
+            expense_id = payload['id'] if op == 'put' else payload
+            by_shard.setdefault(shard_of(expense_id, self.shard_count), []).append((op, payload))
+
+        def commit_shard(shard: int):
+            shard_operations = by_shard[shard]
+            apply_operations(self._shard_expenses[shard], shard_operations)
+            self.shards[shard].commit(self._shard_expenses[shard], shard_operations)
+
+        self._map(commit_shard, list(by_shard))
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._executor.shutdown(wait=True)
+
+
+def create_storage(storage_mode: str, data_dir: str, shard_count: int = 1, shared: bool = False):
+    if storage_mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode '{storage_mode}', expected one of {list(STORAGE_MODES)}")
+    if shard_count > 1:
+        return ShardedStorage(storage_mode, data_dir, shard_count, shared)
+    return STORAGE_MODES[storage_mode](data_dir, shared)
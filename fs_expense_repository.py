@@ -1,25 +1,130 @@
 import os
-import json
 import uuid
-from typing import List, Optional
+import logging
+import bisect
+import asyncio
+import functools
+import itertools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from fastapi import HTTPException, status, UploadFile
-from data_model import Expense
-from repository import ExpenseRepository
+from data_model import Expense, ExpenseChanges, BatchOperation, BatchResult
+from repository import ExpenseRepository, changes_gone, require_batch_id, require_batch_expense
+from file_storage import Operation, StagedExpenses, create_storage, diff_operations
+from expense_index import AttachmentIndex, FieldIndex, SortedIndex, in_amount_range, intersect
+from attachment_store import AttachmentFile, AttachmentStore
+from rollups import RollupIndex
+from analytics import ColumnarExpenses
+from group_commit import GroupCommitWriter
+from change_log import ChangeLog
+from metrics import timed
+from search_index import SearchIndex
+from expense_json import EncodedExpenses, ExpensesJson, join_array
+from store_lock import StoreLock
+
+logger = logging.getLogger(__name__)
+
+# Expense fields with a closed set of values that get a secondary index
+INDEXED_FIELDS = ('tag', 'category', 'currency')
+
+# An amount range matching more than 1/WIDE_RANGE_FRACTION of the expenses is served in file order by a scan
+WIDE_RANGE_FRACTION = 8
+
+# A reload changing more than 1/REBUILD_FRACTION of the expenses rebuilds the cache instead of applying the differences
+REBUILD_FRACTION = 4
 
 class FileExpenseRepository(ExpenseRepository):
+    '''
+    Expense repository backed by files in data_dir.
+
+    Expenses are cached in memory, so reads never touch the disk. Blocking
+    file work (loading, persisting, attachment files) runs on a bounded
+    thread pool, so the event loop never waits on the disk. Mutations go
+    through a single group commit writer, which applies concurrent changes
+    in order and persists them together with one storage commit. With
+    shards > 1 the files are split by expense id, and a commit only rewrites
+    the shards its changes touch.
+
+    With shared=True several server processes use data_dir, each with its
+    own cache. Loads and commits hold a StoreLock on data_dir/expenses.lock,
+    and a commit first brings the cache up to date with the others' commits.
+    Readers notice those commits by the files' signatures and catch up by
+    replaying the journal or binary records appended since their last read.
+    The lock file also holds the current version, so every process hands
+    out the same versions for the same changes.
+
+    Attachment files are removed in the background at purge_bytes_per_s (see
+    AttachmentStore), and sweep_attachments() reconciles them with the expenses.
+    '''
     _instance = None
 
-    def __new__(cls, data_dir: str):
+    def __new__(cls, data_dir: str, storage_mode: str = 'json', io_workers: int = 4,
+                commit_window: float = 0.002, commit_max_batch: int = 1000, shards: int = 1, shared: bool = False,
+                purge_bytes_per_s: float = 0):
         if cls._instance is None:
             cls._instance = super(FileExpenseRepository, cls).__new__(cls)
-            cls._instance.init(data_dir)
+            cls._instance.init(data_dir, storage_mode, io_workers, commit_window, commit_max_batch, shards, shared,
+                               purge_bytes_per_s)
         return cls._instance
 
-    def init(self, data_dir: str):
+    def init(self, data_dir: str, storage_mode: str = 'json', io_workers: int = 4,
+             commit_window: float = 0.002, commit_max_batch: int = 1000, shards: int = 1, shared: bool = False,
+             purge_bytes_per_s: float = 0):
         self.data_dir = data_dir
-        self.expenses_data_file = os.path.join(data_dir, 'expenses.json')
+        self.storage_mode = storage_mode
         self.attachments_dir = os.path.join(data_dir, 'attachments')
-        self.ensure_data_file()
+        self._storage = create_storage(storage_mode, data_dir, shards, shared)
+        # Held around loads and commits when other processes share the files
+        self._store_lock: Optional[StoreLock] = None
+        if shared:
+            os.makedirs(data_dir, exist_ok=True)
+            self._store_lock = StoreLock(os.path.join(data_dir, 'expenses.lock'))
+        self.expenses_data_file = self._storage.expenses_data_file
+        self._executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='expense-io')
+        self._write_lock = asyncio.Lock()
+        self._writer = GroupCommitWriter(self._commit_batch, commit_window, commit_max_batch)
+
+        # Parsed expenses keyed by id, kept in file order. Stored dicts are
+        # replaced rather than mutated so the storage can snapshot them safely.
+        self._expenses: Dict[str, dict] = {}
+        # Every expense gets a row number in load/insert order. Indexes store
+        # rows, and sorting rows returns index lookups in file order.
+        self._rows: Dict[str, int] = {}
+        self._expenses_by_row: Dict[int, dict] = {}
+        self._next_row = 0
+        self._indexes = {field: FieldIndex(field) for field in INDEXED_FIELDS}
+        # Expenses by amount, for range filters and amount order
+        self._amounts = SortedIndex('amount')
+        self._rollups = RollupIndex()
+        self._columns = ColumnarExpenses()
+        # Saved on close, so a restart with unchanged expenses skips tokenizing them all again
+        self._search = SearchIndex()
+        self.search_index_file = os.path.join(data_dir, 'search_index.npz')
+        # (expense id, file name) of every attachment, for downloads
+        self._attachment_keys = AttachmentIndex()
+        # JSON of every expense read by a list request, until it changes
+        self._encoded = EncodedExpenses()
+        # Everything updated with add(row, expense) / remove(row, expense) on every change
+        self._maintained_indexes = (list(self._indexes.values()) +
+                                    [self._amounts, self._rollups, self._columns, self._search,
+                                     self._attachment_keys, self._encoded])
+        # All ids in sorted order, for cursor pagination
+        self._sorted_ids: List[str] = []
+        # Version of every change, for ETags and /expenses/changes
+        self._changes = ChangeLog()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        with self._store_lock or contextlib.nullcontext():
+            self.ensure_data_file()
+            self._attachments = AttachmentStore(self.attachments_dir, shared, purge_bytes_per_s)
+            self._set_cache(self._storage.load())
+            if self._store_lock is not None:
+                # Above any version another process handed out, as after a restart
+                version = max(self._changes.version, self._store_lock.read_counter() + 1)
+                self._changes.reset(version)
+                self._store_lock.write_counter(version)
 
     def ensure_data_file(self):
         if not os.path.exists(self.data_dir):
@@ -28,33 +133,393 @@ class FileExpenseRepository(ExpenseRepository):
         if not os.path.exists(self.attachments_dir):
             os.makedirs(self.attachments_dir)
 
-        if not os.path.exists(self.expenses_data_file):
-            with open(self.expenses_data_file, 'w') as file:
-                json.dump([], file)
+        self._storage.ensure_files()
 
-    async def get_expenses(self, tag: Optional[str], category: Optional[str], currency: Optional[str]) -> List[Expense]:
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._storage.close()
+        self._attachments.close()
         try:
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
+            with self._store_lock or contextlib.nullcontext():
+                self._search.save(self.search_index_file, self._expenses, self._rows)
+        except Exception:
+            # Only a cache, the next start rebuilds it
+            logger.exception("Could not save the search index to %s", self.search_index_file)
+        if self._store_lock is not None:
+            self._store_lock.close()
+
+    async def _run_io(self, func, *args):
+        '''Run blocking file work on the I/O thread pool'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _set_cache(self, expenses: Dict[str, dict]):
+        with timed('load', 'index'):
+            self._build_cache(expenses)
+        self._changes.reset()
+        self.cache_misses += 1
+
+    def _replace_cache(self, expenses: Dict[str, dict], version: Optional[int] = None):
+        '''
+        Switch to reloaded expenses, applying only the differences when few
+        changed. The differences are not the changes in the order they were
+        made, so they are all logged at one version, newer than any of those
+        changes: version (the shared one) if given, else the next one. Then
+        /expenses/changes since any older version still lists all of them.
+        '''
+        operations = diff_operations(self._expenses, expenses)
+        if len(operations) * REBUILD_FRACTION > len(expenses):
+            self._set_cache(expenses)
+            return
+        if version is None:
+            if not operations:
+                # The files hold what the cache does, as after a failed commit that wrote nothing
+                self.cache_misses += 1
+                return
+            version = self._changes.version + 1
+        with timed('load', 'index'):
+            self._apply(operations, version)
+        # Caught up to version, even when the changes cancelled out and there are no differences
+        self._changes.version = version
+        self.cache_misses += 1
+
+    def _build_cache(self, expenses: Dict[str, dict]):
+        self._expenses = expenses
+        self._expenses_by_row = dict(enumerate(self._expenses.values()))
+        self._rows = {expense_id: row for row, expense_id in enumerate(self._expenses)}
+        self._next_row = len(self._rows)
+        self._sorted_ids = sorted(self._expenses)
+        indexes = self._maintained_indexes
+        # The saved search index is only used if it was saved for these very expense texts
+        if self._search.restore(self.search_index_file, self._expenses, self._rows):
+            indexes = [index for index in indexes if index is not self._search]
+        for index in indexes:
+            index.clear()
+            for row, expense in enumerate(self._expenses.values()):
+                index.add(row, expense)
+
+    def _files_changed(self) -> bool:
+        try:
+            return self._storage.changed_on_disk()
+        except FileNotFoundError:
+            return True
+
+    async def _reload_if_changed(self):
+        '''
+        Bring the cache up to date if the data files changed outside this
+        process. Caller holds the write lock, and the store lock if shared.
+        '''
+        if self._files_changed():
+            await self._run_io(self.ensure_data_file)
+            operations = await self._run_io(self._storage.load_changes)
+            if operations is not None:
+                # Replayed in commit order, so the versions match the committing process's
+                with timed('load', 'index'):
+                    self._apply(operations)
+            else:
+                version = self._store_lock.read_counter() if self._store_lock is not None else None
+                self._replace_cache(await self._run_io(self._storage.load), version)
+            if self._store_lock is not None:
+                self._sync_version()
+
+    def _sync_version(self):
+        '''Take the version in the store lock if this process's differs, forgetting older changes'''
+        version = self._store_lock.read_counter()
+        if version != self._changes.version:
+            self._changes.reset(version)
+
+    @contextlib.asynccontextmanager
+    async def _locked_store(self):
+        '''Hold the store lock, if shared, without blocking the event loop while waiting for it'''
+        if self._store_lock is None:
+            yield
+            return
+        acquired = asyncio.get_running_loop().run_in_executor(self._executor, self._store_lock.acquire)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # The thread still gets the lock: wait for it, still holding the write lock, and give it back
+            await acquired
+            self._store_lock.release()
+            raise
+        try:
+            yield
+        finally:
+            self._store_lock.release()
+
+    async def _get_cached_expenses(self) -> Dict[str, dict]:
+        '''Return the cached expenses, reloading them only if the data files changed outside this process'''
+        # While a write is in flight the files are expected to change under us
+        if not self._write_lock.locked() and self._files_changed():
+            async with self._write_lock, self._locked_store():
+                await self._reload_if_changed()
+        else:
+            self.cache_hits += 1
+        return self._expenses
+
+    def _apply(self, operations: List[Operation], version: Optional[int] = None):
+        '''Apply storage operations to the cache and its indexes, logging them at version if given'''
+        for op, payload in operations:
+            expense_id = payload['id'] if op == 'put' else payload
+            old_expense = self._expenses.get(expense_id)
+            if old_expense is not None:
+                row = self._rows[expense_id]
+                for index in self._maintained_indexes:
+                    index.remove(row, old_expense)
+
+            if op == 'put':
+                if old_expense is None:
+                    row = self._next_row
+                    self._next_row += 1
+                    self._rows[expense_id] = row
+                    bisect.insort(self._sorted_ids, expense_id)
+                self._expenses[expense_id] = payload
+                self._expenses_by_row[row] = payload
+                for index in self._maintained_indexes:
+                    index.add(row, payload)
+                self._changes.put(expense_id, version)
+            elif old_expense is not None:
+                del self._expenses[expense_id]
+                del self._rows[expense_id]
+                del self._expenses_by_row[row]
+                del self._sorted_ids[bisect.bisect_left(self._sorted_ids, expense_id)]
+                self._changes.delete(expense_id, version)
+
+    async def _commit_batch(self, jobs: List[Callable]) -> List[Any]:
+        '''
+        Run queued mutation jobs for the group commit writer. Each job gets the
+        cached expenses, including the changes of the jobs before it, and
+        returns (operations, result) or raises. All operations are persisted
+        with one storage commit, and only then applied to the cache, its
+        indexes and the change log, so readers never see a write that is not
+        durable.
+        '''
+        outcomes = []
+        operations = []
+        async with self._write_lock, self._locked_store():
+            await self._reload_if_changed()
+            if self._store_lock is not None:
+                self._sync_version()
+            staged = StagedExpenses(self._expenses)
+            with timed('commit', 'stage'):
+                for job in jobs:
+                    try:
+                        job_operations, result = job(staged)
+                    except Exception as e:
+                        outcomes.append(e)
+                        continue
+                    staged.stage(job_operations)
+                    operations += job_operations
+                    outcomes.append(result)
+
+            if operations:
+                try:
+                    # Safe to read the cache from another thread: it only changes under the write lock
+                    await self._run_io(self._storage.commit, staged, operations)
+                except Exception:
+                    # Part of the operations may have reached the files, force a reload on next access
+                    self._storage.invalidate()
+                    raise
+                with timed('commit', 'apply'):
+                    self._apply(operations)
+                if self._store_lock is not None:
+                    self._store_lock.write_counter(self._changes.version)
+        return outcomes
+
+    async def _mutate(self, job: Callable[[Dict[str, dict]], Tuple[List[Operation], Any]]) -> Any:
+        '''Queue a mutation job for the writer and return its result once it is durable'''
+        return await self._writer.submit(job)
+
+    def cache_stats(self) -> dict:
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self._expenses),
+            "commits": self._writer.stats(),
+            "attachments": self._attachments.stats(),
+        }
+
+    def _row_sets(self, tag: Optional[str], category: Optional[str], currency: Optional[str]) -> List[Set[int]]:
+        '''The rows of each given equality filter, smallest first'''
+        filters = {'tag': tag, 'category': category, 'currency': currency}
+        return sorted((self._indexes[field].lookup(value) for field, value in filters.items() if value), key=len)
+
+    def _select_expenses(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                         min_amount: Optional[float] = None, max_amount: Optional[float] = None) -> List[dict]:
+        '''Return the cached expenses matching all given filters, in file order'''
+        row_sets = self._row_sets(tag, category, currency)
+        ranged = min_amount is not None or max_amount is not None
+        expenses_by_row = self._expenses_by_row
+        if not row_sets:
+            if not ranged:
+                return list(self._expenses.values())
+            if self._amounts.count(min_amount, max_amount) * WIDE_RANGE_FRACTION > len(self._expenses):
+                # Putting many matches back in file order costs more than checking every amount
+                return [expense for expense in self._expenses.values()
+                        if in_amount_range(expense, min_amount, max_amount)]
+            rows = self._rows
+            matches = sorted(rows[expense_id] for expense_id in self._amounts.select(min_amount, max_amount))
+            return [expenses_by_row[row] for row in matches]
+
+        expenses = [expenses_by_row[row] for row in sorted(intersect(row_sets))]
+        if ranged:
+            # The equality filters already narrowed the expenses down, check their amounts directly
+            expenses = [expense for expense in expenses if in_amount_range(expense, min_amount, max_amount)]
+        return expenses
+
+    def _few_matches(self, row_sets: List[Set[int]], min_amount: Optional[float], max_amount: Optional[float]) -> bool:
+        '''Whether sorting the matches of the filters costs less than walking an ordered index to find them'''
+        matches = len(row_sets[0]) if row_sets else self._amounts.count(min_amount, max_amount)
+        return matches * WIDE_RANGE_FRACTION <= len(self._expenses)
+
+    def _walk_matches(self, expense_ids: Iterable[str], row_sets: List[Set[int]],
+                      min_amount: Optional[float] = None, max_amount: Optional[float] = None) -> Iterator[dict]:
+        '''The expenses of expense_ids, in their order, whose rows are in every row set and amounts in range'''
+        rows = self._rows
+        expenses = self._expenses
+        ranged = min_amount is not None or max_amount is not None
+        for expense_id in expense_ids:
+            row = rows[expense_id]
+            if all(row in row_set for row_set in row_sets):
+                expense = expenses[expense_id]
+                if not ranged or in_amount_range(expense, min_amount, max_amount):
+                    yield expense
+
+    def _save_uploads(self, expense_id: str, files: List[UploadFile]):
+        for file in files:
+            self._attachments.save(expense_id, file.filename, file.file)
+
+    def _select_page(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                     cursor: Optional[str], limit: Optional[int], min_amount: Optional[float] = None,
+                     max_amount: Optional[float] = None, order_by: Optional[str] = None) -> List[dict]:
+        '''Return the matching cached expenses in order_by order (id by default), after cursor and at most limit of them'''
+        if order_by in ('amount', '-amount'):
+            return self._select_by_amount(tag, category, currency, cursor, limit, min_amount, max_amount,
+                                          order_by == '-amount')
+        expense_ids = self._sorted_ids
+        if tag or category or currency or min_amount is not None or max_amount is not None:
+            row_sets = self._row_sets(tag, category, currency)
+            if not self._few_matches(row_sets, min_amount, max_amount):
+                # Walk the ids from the cursor on and stop at limit matches, rather than sorting every match
+                start = bisect.bisect_right(expense_ids, cursor) if cursor else 0
+                walked = (expense_ids[position] for position in range(start, len(expense_ids)))
+                return list(itertools.islice(self._walk_matches(walked, row_sets, min_amount, max_amount), limit))
+            expense_ids = sorted(expense['id'] for expense in
+                                 self._select_expenses(tag, category, currency, min_amount, max_amount))
+        start = bisect.bisect_right(expense_ids, cursor) if cursor else 0
+        end = start + limit if limit else len(expense_ids)
+        return [self._expenses[expense_id] for expense_id in expense_ids[start:end]]
+
+    def _select_by_amount(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                          cursor: Optional[str], limit: Optional[int], min_amount: Optional[float],
+                          max_amount: Optional[float], descending: bool) -> List[dict]:
+        '''Return the matching cached expenses by amount, then id, after cursor and at most limit of them'''
+        after = None
+        if cursor:
+            cursor_expense = self._expenses.get(cursor)
+            if cursor_expense is None:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail="The cursor expense no longer exists, restart from the first page")
+            after = self._amounts.key(cursor_expense)
+
+        row_sets = self._row_sets(tag, category, currency)
+        if row_sets and self._few_matches(row_sets, min_amount, max_amount):
+            # Few matches of the equality indexes: sort them rather than walking the amounts
+            key = self._amounts.key
+            expenses = sorted(self._select_expenses(tag, category, currency, min_amount, max_amount),
+                              key=key, reverse=descending)
+            if after is not None:
+                expenses = [expense for expense in expenses
+                            if (key(expense) < after if descending else key(expense) > after)]
+            return expenses[:limit] if limit else expenses
+
+        expense_ids = self._amounts.select(min_amount, max_amount, descending, after)
+        return list(itertools.islice(self._walk_matches(expense_ids, row_sets), limit))
+
+    def _select_query(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                      cursor: Optional[str], limit: Optional[int], min_amount: Optional[float],
+                      max_amount: Optional[float], order_by: Optional[str]) -> List[dict]:
+        '''The cached expenses a get_expenses() call returns: in file order unless paged or ordered'''
+        if cursor is None and limit is None and order_by is None:
+            return self._select_expenses(tag, category, currency, min_amount, max_amount)
+        return self._select_page(tag, category, currency, cursor, limit, min_amount, max_amount, order_by)
+
+    async def get_expenses(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                           cursor: Optional[str] = None, limit: Optional[int] = None,
+                           min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                           order_by: Optional[str] = None) -> List[Expense]:
+        try:
+            await self._get_cached_expenses()
+            with timed('get_expenses', 'filter'):
+                expenses = self._select_query(tag, category, currency, cursor, limit, min_amount, max_amount, order_by)
+            with timed('get_expenses', 'serialize'):
+                return [Expense(**expense) for expense in expenses]
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-            if tag:
-                expenses = [expense for expense in expenses if expense['tag'] == tag]
+    async def get_expenses_json(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                                cursor: Optional[str] = None, limit: Optional[int] = None,
+                                min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                                order_by: Optional[str] = None) -> ExpensesJson:
+        try:
+            await self._get_cached_expenses()
+            with timed('get_expenses', 'filter'):
+                expenses = self._select_query(tag, category, currency, cursor, limit, min_amount, max_amount, order_by)
+            with timed('get_expenses', 'serialize'):
+                rows, encoded = self._rows, self._encoded
+                body = join_array([encoded.get(rows[expense['id']], expense) for expense in expenses])
+                return ExpensesJson(body, len(expenses), expenses[-1]['id'] if expenses else None)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-            if category:
-                expenses = [expense for expense in expenses if expense['category'] == category]
+    async def get_all_expenses(self, cursor: Optional[str] = None, limit: Optional[int] = None) -> List[Expense]:
+        return await self.get_expenses(None, None, None, cursor, limit)
 
-            if currency:
-                expenses = [expense for expense in expenses if expense['currency'] == currency]
+    async def get_summary(self, group_by: List[str]) -> List[dict]:
+        try:
+            await self._get_cached_expenses()
+            with timed('get_summary', 'aggregate'):
+                return self._rollups.summary(group_by)
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-            return [Expense(**expense) for expense in expenses]
+    async def search_expenses(self, query: str, limit: int = 50, offset: int = 0) -> List[Expense]:
+        try:
+            await self._get_cached_expenses()
+            with timed('search_expenses', 'search'):
+                matches = self._search.search(query, offset + limit)[offset:]
+            with timed('search_expenses', 'serialize'):
+                return [Expense(**self._expenses_by_row[row]) for _, row in matches]
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-    async def get_all_expenses(self) -> List[Expense]:
+    async def get_columns(self) -> ColumnarExpenses:
+        await self._get_cached_expenses()
+        # The report is built off the event loop, while commits keep changing the live columns
+        return self._columns.snapshot()
+
+    async def get_version(self) -> int:
+        await self._get_cached_expenses()
+        return self._changes.version
+
+    async def get_changes(self, since: int) -> ExpenseChanges:
         try:
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
-            return [Expense(**expense) for expense in expenses]
+            expenses = await self._get_cached_expenses()
+            changes = self._changes.changes_since(since)
+            if changes is None:
+                raise changes_gone()
+
+            written, deleted = changes
+            with timed('get_changes', 'serialize'):
+                return ExpenseChanges(version=self._changes.version,
+                                      expenses=[Expense(**expenses[expense_id]) for expense_id in written],
+                                      deleted=deleted)
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
@@ -63,129 +528,172 @@ class FileExpenseRepository(ExpenseRepository):
             expense_id = str(uuid.uuid4())
             expense.id = expense_id
 
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
-            expenses.append(expense.dict())
-            with open(self.expenses_data_file, 'w') as file:
-                json.dump(expenses, file, indent=4)
-
-            return expense
+            return await self._mutate(lambda expenses: ([('put', expense.dict())], expense))
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
     async def update_expense(self, expense_id: str, updated_expense: Expense) -> Expense:
-        try:
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
-
-            for idx, exp in enumerate(expenses):
-                if exp['id'] == expense_id:
-                    updated_expense.id = expense_id
-                    expenses[idx] = updated_expense.dict()
+        def job(expenses):
+            if expense_id not in expenses:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
 
-                    with open(self.expenses_data_file, 'w') as file:
-                        json.dump(expenses, file, indent=4)
+            updated_expense.id = expense_id
+            return [('put', updated_expense.dict())], updated_expense
 
-                    return updated_expense
-
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+        try:
+            return await self._mutate(job)
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
     async def delete_expense(self, expense_id: str) -> dict:
+        def job(expenses):
+            exp = expenses.get(expense_id)
+            if exp is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+            return [('delete', expense_id)], exp
+
         try:
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
+            exp = await self._mutate(job)
+            await self._run_io(self._attachments.remove, expense_id, exp.get('attachments') or [])
 
-            for idx, exp in enumerate(expenses):
-                if exp['id'] == expense_id:
-                    expense_attachment_dir = os.path.join(self.attachments_dir, expense_id)
-                    for attachment in exp.get('attachments', []):
-                        file_path = os.path.join(expense_attachment_dir, attachment)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                    if os.path.exists(expense_attachment_dir):
-                        os.rmdir(expense_attachment_dir)
+            return {"status": "Deleted"}
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-                    del expenses[idx]
+    async def apply_batch(self, operations: List[BatchOperation]) -> List[BatchResult]:
+        deleted_attachments = []
+
+        def job(expenses):
+            results = []
+            storage_operations = []
+            # Expenses created, updated (dict) or deleted (None) earlier in this batch
+            pending: Dict[str, Optional[dict]] = {}
+
+            def current(expense_id: str) -> Optional[dict]:
+                return pending[expense_id] if expense_id in pending else expenses.get(expense_id)
+
+            for operation in operations:
+                try:
+                    if operation.op == 'delete':
+                        expense_id = require_batch_id(operation)
+                        exp = current(expense_id)
+                        if exp is None:
+                            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+                        pending[expense_id] = None
+                        storage_operations.append(('delete', expense_id))
+                        deleted_attachments.append((expense_id, exp.get('attachments') or []))
+                        results.append(BatchResult(op=operation.op, status=status.HTTP_200_OK, id=expense_id))
+                        continue
+
+                    expense = require_batch_expense(operation)
+                    if operation.op == 'create':
+                        expense.id = str(uuid.uuid4())
+                        status_code = status.HTTP_201_CREATED
+                    else:
+                        expense.id = require_batch_id(operation)
+                        if current(expense.id) is None:
+                            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+                        status_code = status.HTTP_200_OK
+                    record = expense.dict()
+                    pending[expense.id] = record
+                    storage_operations.append(('put', record))
+                    results.append(BatchResult(op=operation.op, status=status_code, id=expense.id, expense=expense))
+                except HTTPException as e:
+                    results.append(BatchResult(op=operation.op, status=e.status_code, id=operation.id, detail=str(e.detail)))
+            return storage_operations, results
 
-                    with open(self.expenses_data_file, 'w') as file:
-                        json.dump(expenses, file, indent=4)
+        try:
+            # The whole batch is one job, so it lands in a single storage commit
+            results = await self._mutate(job)
 
-                    return {"status": "Deleted"}
+            for expense_id, attachments in deleted_attachments:
+                await self._run_io(self._attachments.remove, expense_id, attachments)
 
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+            return results
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
     async def add_attachment(self, expense_id: str, files: List[UploadFile]) -> dict:
-        try:
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
-
-            for exp in expenses:
-                if exp['id'] == expense_id:
-                    file_paths = exp.get('attachments', [])
-                    expense_attachment_dir = os.path.join(self.attachments_dir, expense_id)
-                    os.makedirs(expense_attachment_dir, exist_ok=True)
-                    for file in files:
-                        file_path = os.path.join(expense_attachment_dir, file.filename)
-                        with open(file_path, "wb") as f:
-                            f.write(file.file.read())
-                        file_paths.append(file.filename)
-                    exp['attachments'] = file_paths
+        file_names = [file.filename for file in files]
 
-                    with open(self.expenses_data_file, 'w') as file:
-                        json.dump(expenses, file, indent=4)
+        def job(expenses):
+            exp = expenses.get(expense_id)
+            if exp is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
 
-                    return {"status": "Attachments added"}
+            # Re-uploading a name replaces its content, it is not listed twice
+            file_paths = list(exp.get('attachments') or [])
+            file_paths += [name for name in dict.fromkeys(file_names) if name not in file_paths]
+            return [('put', dict(exp, attachments=file_paths))], None
 
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+        try:
+            expenses = await self._get_cached_expenses()
+            if expense_id not in expenses:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+
+            # Stream the files to disk before queueing the change, so uploads never hold up other writers
+            await self._run_io(self._save_uploads, expense_id, files)
+            try:
+                await self._mutate(job)
+            except HTTPException:
+                await self._run_io(self._attachments.remove, expense_id, file_names)
+                raise
+
+            return {"status": "Attachments added"}
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
     async def delete_attachment(self, expense_id: str, file_name: str) -> dict:
-        try:
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
+        def job(expenses):
+            exp = expenses.get(expense_id)
+            if exp is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
 
-            for exp in expenses:
-                if exp['id'] == expense_id:
-                    expense_attachment_dir = os.path.join(self.attachments_dir, expense_id)
-                    file_path = os.path.join(expense_attachment_dir, file_name)
-                    if file_name in exp.get('attachments', []):
-                        exp['attachments'].remove(file_name)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                        if not os.listdir(expense_attachment_dir):
-                            os.rmdir(expense_attachment_dir)
+            if file_name not in (exp.get('attachments') or []):
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
 
-                        with open(self.expenses_data_file, 'w') as file:
-                            json.dump(expenses, file, indent=4)
+            attachments = [attachment for attachment in exp['attachments'] if attachment != file_name]
+            return [('put', dict(exp, attachments=attachments))], None
 
-                        return {"status": "Attachment deleted"}
+        try:
+            await self._mutate(job)
+            await self._run_io(self._attachments.remove, expense_id, [file_name])
 
-                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+            return {"status": "Attachment deleted"}
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+    async def sweep_attachments(self) -> dict:
+        try:
+            await self._get_cached_expenses()
+            return await self._run_io(self._attachments.sweep, self._attachment_keys.snapshot())
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-    async def download_attachment(self, expense_id: str, file_name: str) -> Optional[str]:
+    async def download_attachment(self, expense_id: str, file_name: str) -> Optional[AttachmentFile]:
         try:
-            with open(self.expenses_data_file, 'r') as file:
-                expenses = json.load(file)
+            await self._get_cached_expenses()
 
-            for exp in expenses:
-                if exp['id'] == expense_id:
-                    expense_attachment_dir = os.path.join(self.attachments_dir, expense_id)
-                    file_path = os.path.join(expense_attachment_dir, file_name)
-                    if file_name in exp.get('attachments', []):
-                        if os.path.exists(file_path):
-                            return file_path
+            if expense_id not in self._expenses:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
 
-                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+            if (expense_id, file_name) in self._attachment_keys:
+                attachment = self._attachments.locate(expense_id, file_name)
+                if attachment:
+                    return attachment
 
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
@@ -0,0 +1,67 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, List
+
+
+class GroupCommitWriter:
+    '''
+    Single writer for a repository's mutations.
+
+    Callers submit jobs and wait on a future. One writer task drains the
+    queue: it waits up to `window` seconds for more jobs to arrive, then hands
+    at most `max_batch` of them to `commit_batch`, which applies them in order
+    and persists them with one write. Each future resolves only once that
+    write has completed. While a commit is running, new jobs queue up and
+    go out together in the next batch.
+
+    commit_batch returns one outcome per job, either a result or an exception
+    for jobs that failed on their own. If it raises, every job in the batch
+    fails with that exception.
+
+    The writer task exits when the queue is empty and the next submit starts
+    a new one, so the writer is never left running on a stopped event loop.
+    '''
+
+    def __init__(self, commit_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+                 window: float = 0.002, max_batch: int = 1000):
+        self._commit_batch = commit_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = deque()
+        self._task = None
+        self.batches = 0
+        self.jobs = 0
+
+    async def submit(self, job: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((job, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        while self._queue:
+            if self.window > 0 and len(self._queue) < self.max_batch:
+                await asyncio.sleep(self.window)
+            batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+            try:
+                outcomes = await self._commit_batch([job for job, _ in batch])
+            except Exception as e:
+                outcomes = [e] * len(batch)
+
+            self.batches += 1
+            self.jobs += len(batch)
+            for (_, future), outcome in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if isinstance(outcome, Exception):
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "queued": len(self._queue),
+        }
@@ -0,0 +1,229 @@
+import sys
+import time
+import logging
+import threading
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the payload size histogram buckets, in bytes
+SIZE_BUCKETS = tuple(256 * 4 ** power for power in range(10))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _bound_label(bound) -> str:
+    return 'le="%s"' % bound
+
+
+class Histogram:
+    '''Bucketed observations (Prometheus histogram) for one label set'''
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: Labels) -> Iterable[str]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_format_labels(labels, _bound_label(bound))} {cumulative}'
+        yield f'{name}_bucket{_format_labels(labels, _bound_label("+Inf"))} {self.count}'
+        yield f'{name}_sum{_format_labels(labels)} {self.sum}'
+        yield f'{name}_count{_format_labels(labels)} {self.count}'
+
+
+class MetricsRegistry:
+    '''
+    Counters, gauges and histograms keyed by metric name and labels, rendered
+    in the Prometheus text format. Thread-safe, since repository phases are
+    recorded on the I/O threads.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._values: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._collectors = []
+
+    def _declare(self, name: str, metric_type: str, help_text: str):
+        if name not in self._help:
+            self._help[name] = (metric_type, help_text)
+
+    def inc(self, name: str, labels: Labels, amount: float = 1.0, help_text: str = '', metric_type: str = 'counter'):
+        with self._lock:
+            self._declare(name, metric_type, help_text)
+            values = self._values.setdefault(name, {})
+            values[labels] = values.get(labels, 0.0) + amount
+
+    def observe(self, name: str, labels: Labels, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                help_text: str = ''):
+        with self._lock:
+            self._declare(name, 'histogram', help_text)
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(labels)
+            if histogram is None:
+                histogram = histograms[labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector: Callable[[], Dict[str, float]]):
+        '''Register a callable returning {gauge name: value}, read on every render'''
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in self._help.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in self._values.get(name, {}).items():
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                for labels, histogram in self._histograms.get(name, {}).items():
+                    lines.extend(histogram.lines(name, labels))
+        for collector in self._collectors:
+            for name, value in collector().items():
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+@contextmanager
+def timed(operation: str, phase: str):
+    '''Record the duration of one phase (parse, filter, serialize, write...) of a repository operation'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe('trackxpense_repository_phase_seconds', (('operation', operation), ('phase', phase)),
+                         time.perf_counter() - start, help_text='Time spent in each phase of repository operations')
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording, per route template: request latency, requests
+    in flight, request and response body sizes and a count per status.
+    Requests slower than slow_request_seconds (if set) are logged.
+    '''
+
+    def __init__(self, app, slow_request_seconds: Optional[float] = None):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    def _route(self, scope) -> str:
+        # Route templates keep the label set small, raw paths would add one per expense id
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        labels = (('method', scope['method']), ('route', self._route(scope)))
+        status_code = 500
+        request_bytes = 0
+        response_bytes = 0
+
+        async def counting_receive():
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message):
+            nonlocal status_code, response_bytes
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            elif message['type'] == 'http.response.body':
+                response_bytes += len(message.get('body', b''))
+            await send(message)
+
+        REGISTRY.inc('trackxpense_http_requests_in_flight', labels, 1, 'Requests being handled', 'gauge')
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            duration = time.perf_counter() - start
+            REGISTRY.inc('trackxpense_http_requests_in_flight', labels, -1, 'Requests being handled', 'gauge')
+            REGISTRY.inc('trackxpense_http_requests_total', labels + (('status', str(status_code)),),
+                         help_text='Requests handled, by status')
+            REGISTRY.observe('trackxpense_http_request_duration_seconds', labels, duration,
+                             help_text='Time from receiving a request to sending the last byte of its response')
+            REGISTRY.observe('trackxpense_http_request_size_bytes', labels, request_bytes, SIZE_BUCKETS,
+                             help_text='Request body sizes')
+            REGISTRY.observe('trackxpense_http_response_size_bytes', labels, response_bytes, SIZE_BUCKETS,
+                             help_text='Response body sizes')
+            if self.slow_request_seconds and duration >= self.slow_request_seconds:
+                query = scope.get('query_string', b'').decode('latin-1')
+                logger.warning("Slow request: %s %s%s -> %d in %.1f ms (%d bytes in, %d bytes out)",
+                               scope['method'], scope['path'], f'?{query}' if query else '', status_code,
+                               duration * 1000, request_bytes, response_bytes)
+
+
+class SamplingProfiler:
+    '''
+    Samples the stack of one thread (the event loop's) every interval seconds
+    from a background thread. Stacks are counted in the collapsed format
+    ("outer;inner;leaf count") used by flame graph tools.
+    '''
+
+    def __init__(self, interval: float, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self, reset: bool = False) -> str:
+        samples = self.samples
+        if reset:
+            self.samples = Counter()
+        return ''.join(f'{stack} {count}\n' for stack, count in samples.most_common())
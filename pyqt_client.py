@@ -1,13 +1,157 @@
-import threading
-from server import run_server
+from embedded_server import start_server
 from data_model import CURRENCY_LIST_REGULAR, CATEGORY_LIST_REGULAR, TAG_LIST_REGULAR
 import sys
 import requests
-from requests.exceptions import ConnectionError
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QListWidget, QTextEdit, QPushButton, QMessageBox, QHBoxLayout, QLabel, QLineEdit, QDialog, QFormLayout, QComboBox
+from requests.adapters import HTTPAdapter
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QListView, QTextEdit, QPushButton, QMessageBox, QHBoxLayout, QLabel, QLineEdit, QDialog, QFormLayout, QComboBox
 
 
 BASE_URL = "http://127.0.0.1:8000"
+# Expenses fetched per request when loading the list
+PAGE_SIZE = 500
+# Background threads running requests, each with its own pooled keep-alive connection
+NETWORK_THREADS = 4
+
+
+class ApiError(Exception):
+    pass
+
+
+class ExpenseApi:
+    '''
+    Blocking calls to the server over one keep-alive session. Meant to run on
+    the worker threads, never on the GUI thread.
+    '''
+
+    def __init__(self, base_url: str = BASE_URL):
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=NETWORK_THREADS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, path, expected_status, **kwargs):
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        except requests.exceptions.ConnectionError:
+            raise ApiError('Failed to connect to the server')
+        if response.status_code not in expected_status:
+            raise ApiError(f'Server answered {response.status_code}: {response.text}')
+        return response
+
+    def get_page(self, cursor=None):
+        '''Return (expenses, version, next cursor) for one page of /expenses/all'''
+        params = {'limit': PAGE_SIZE}
+        if cursor:
+            params['cursor'] = cursor
+        response = self._request('GET', '/expenses/all', (200,), params=params)
+        return response.json(), int(response.headers['X-Expenses-Version']), response.headers.get('X-Next-Cursor')
+
+    def get_changes(self, since):
+        '''Return the /expenses/changes response, or None if the client has to reload everything'''
+        response = self._request('GET', '/expenses/changes', (200, 410), params={'since': since})
+        return None if response.status_code == 410 else response.json()
+
+    def add_expense(self, expense):
+        return self._request('POST', '/expenses/', (201,), json=expense).json()
+
+    def update_expense(self, expense_id, expense):
+        return self._request('PUT', f'/expenses/{expense_id}', (200,), json=expense).json()
+
+    def delete_expense(self, expense_id):
+        return self._request('DELETE', f'/expenses/{expense_id}', (200,)).json()
+
+
+class WorkerSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class Worker(QRunnable):
+    '''Run func(*args) on the thread pool and report the outcome through queued signals'''
+
+    def __init__(self, func, *args):
+        super().__init__()
+        self.func = func
+        self.args = args
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            result = self.func(*self.args)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+
+class ExpenseListModel(QAbstractListModel):
+    '''
+    Expenses shown as a list of ids. Changes are applied row by row, so the
+    view only repaints the rows that were inserted, updated or removed.
+    '''
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._ids = []
+        # Row of every listed id, so changes find their rows without scanning the list
+        self._rows = {}
+        self._expenses = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._ids)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return self._ids[index.row()]  # Show ID only
+        return None
+
+    def expense(self, row):
+        return self._expenses[self._ids[row]]
+
+    def clear(self):
+        self.beginResetModel()
+        self._ids = []
+        self._rows = {}
+        self._expenses = {}
+        self.endResetModel()
+
+    def append(self, expenses):
+        expenses = [expense for expense in expenses if expense['id'] not in self._expenses]
+        if not expenses:
+            return
+        self.beginInsertRows(QModelIndex(), len(self._ids), len(self._ids) + len(expenses) - 1)
+        for expense in expenses:
+            self._rows[expense['id']] = len(self._ids)
+            self._ids.append(expense['id'])
+            self._expenses[expense['id']] = expense
+        self.endInsertRows()
+
+    def apply_changes(self, changes):
+        deleted_rows = []
+        for expense_id in changes['deleted']:
+            if self._expenses.pop(expense_id, None) is not None:
+                deleted_rows.append(self._rows.pop(expense_id))
+        # Bottom up, so the rows still to remove keep their numbers, then renumber the rows below the first gap once
+        for row in sorted(deleted_rows, reverse=True):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self._ids[row]
+            self.endRemoveRows()
+        if deleted_rows:
+            for row in range(min(deleted_rows), len(self._ids)):
+                self._rows[self._ids[row]] = row
+
+        added = []
+        for expense in changes['expenses']:
+            if expense['id'] in self._expenses:
+                self._expenses[expense['id']] = expense
+                index = self.index(self._rows[expense['id']])
+                self.dataChanged.emit(index, index)
+            else:
+                added.append(expense)
+        self.append(added)
+
 
 class AddExpenseDialog(QDialog):
     def __init__(self, parent=None):
@@ -49,20 +193,33 @@ class AddExpenseDialog(QDialog):
             'notes': self.notes_field.text()
         }
 
-        try:
-            response = requests.post(f"{BASE_URL}/expenses/", json=new_expense)
-            if response.status_code == 201:
-                QMessageBox.information(self, 'Success', 'Expense added successfully')
-                self.accept()
-            else:
-                QMessageBox.critical(self, 'Error', 'Failed to add expense')
-        except ConnectionError:
-            QMessageBox.critical(self, 'Error', 'Failed to connect to the server')
+        self.add_button.setEnabled(False)
+        self.parent().run_in_background(self.parent().api.add_expense, new_expense,
+                                        on_finished=self.expense_added, on_failed=self.add_failed)
+
+    def expense_added(self, expense):
+        QMessageBox.information(self, 'Success', 'Expense added successfully')
+        self.accept()
+
+    def add_failed(self, message):
+        self.add_button.setEnabled(True)
+        QMessageBox.critical(self, 'Error', f'Failed to add expense\n{message}')
 
 
 class ExpenseTrackerClient(QWidget):
     def __init__(self):
         super().__init__()
+        self.api = ExpenseApi()
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(NETWORK_THREADS)
+        # Workers still running, kept referenced until they report back
+        self._workers = set()
+        # Version of the loaded expenses, None until the first full load
+        self.version = None
+        # Bumped by every full load so pages of an abandoned load are dropped
+        self._load_generation = 0
+        self._loading = False
+        self._sync_pending = False
         self.initUI()
 
     def initUI(self):
@@ -72,8 +229,11 @@ class ExpenseTrackerClient(QWidget):
         layout = QVBoxLayout()
 
         # List of all expenses
-        self.expense_list = QListWidget()
-        self.expense_list.itemClicked.connect(self.show_expense_info)
+        self.expense_model = ExpenseListModel(self)
+        self.expense_list = QListView()
+        self.expense_list.setModel(self.expense_model)
+        self.expense_list.setUniformItemSizes(True)
+        self.expense_list.clicked.connect(self.show_expense_info)
         layout.addWidget(self.expense_list)
 
         # Expense info display
@@ -120,7 +280,7 @@ class ExpenseTrackerClient(QWidget):
         self.button_layout.addWidget(self.delete_button)
 
         self.refresh_button = QPushButton('Refresh Expenses')
-        self.refresh_button.clicked.connect(self.load_expenses)
+        self.refresh_button.clicked.connect(self.sync_expenses)
         self.button_layout.addWidget(self.refresh_button)
 
         layout.addLayout(self.button_layout)
@@ -129,24 +289,76 @@ class ExpenseTrackerClient(QWidget):
 
         self.load_expenses()
 
+    def run_in_background(self, func, *args, on_finished, on_failed=None):
+        '''Run a blocking API call on the thread pool; the callbacks run on the GUI thread'''
+        worker = Worker(func, *args)
+        self._workers.add(worker)
+        worker.signals.finished.connect(on_finished)
+        worker.signals.failed.connect(on_failed or self.show_error)
+        worker.signals.finished.connect(lambda _: self._workers.discard(worker))
+        worker.signals.failed.connect(lambda _: self._workers.discard(worker))
+        self.thread_pool.start(worker)
+
+    def show_error(self, message):
+        QMessageBox.critical(self, 'Error', message)
+
+    def _load_failed(self, message):
+        self._loading = False
+        self.show_error(f'Failed to load expenses\n{message}')
+
     def load_expenses(self):
-        try:
-            self.expense_list.clear()  # Clear the list before adding new items
-            response = requests.get(f"{BASE_URL}/expenses/all")
-            if response.status_code == 200:
-                expenses = response.json()
-                
-                self.expenses = {expense['id']: expense for expense in expenses}  # Store expenses in a dictionary by ID
-                for expense in expenses:
-                    self.expense_list.addItem(expense['id'])  # Show ID only
-            else:
-                QMessageBox.critical(self, 'Error', 'Failed to load expenses')
-        except ConnectionError:
-            QMessageBox.critical(self, 'Error', 'Failed to connect to the server')
+        '''Reload everything, one page at a time; each page is shown as soon as it arrives'''
+        self._load_generation += 1
+        self._loading = True
+        self.version = None
+        self.expense_model.clear()
+        self._fetch_page(self._load_generation, None)
+
+    def _fetch_page(self, generation, cursor):
+        self.run_in_background(self.api.get_page, cursor,
+                               on_finished=lambda page: self._page_loaded(generation, cursor, page),
+                               on_failed=self._load_failed)
+
+    def _page_loaded(self, generation, cursor, page):
+        if generation != self._load_generation:
+            return
+        expenses, version, next_cursor = page
+        if cursor is None:
+            # Versions are read before the data, so changes made during the load are synced afterwards
+            self.version = version
+        self.expense_model.append(expenses)
+        if next_cursor:
+            self._fetch_page(generation, next_cursor)
+            return
+        self._loading = False
+        if self._sync_pending:
+            self.sync_expenses()
+
+    def sync_expenses(self):
+        '''Apply only what changed since the last load, falling back to a full load'''
+        if self._loading:
+            self._sync_pending = True
+            return
+        self._sync_pending = False
+        if self.version is None:
+            self.load_expenses()
+            return
+        self._loading = True
+        self.run_in_background(self.api.get_changes, self.version,
+                               on_finished=self._changes_loaded, on_failed=self._load_failed)
 
-    def show_expense_info(self, item):
-        expense_id = item.text()
-        expense = self.expenses[expense_id]
+    def _changes_loaded(self, changes):
+        self._loading = False
+        if changes is None:
+            self.load_expenses()
+            return
+        self.expense_model.apply_changes(changes)
+        self.version = changes['version']
+        if self._sync_pending:
+            self.sync_expenses()
+
+    def show_expense_info(self, index):
+        expense = self.expense_model.expense(index.row())
         info = f"ID: {expense['id']}\nName: {expense['name']}\nCategory: {expense['category']}\nAmount: {expense['amount']}\nCurrency: {expense['currency']}\nTag: {expense['tag']}\nNotes: {expense['notes']}"
         self.expense_info.setText(info)
         self.name_field.setText(expense['name'])
@@ -171,44 +383,38 @@ class ExpenseTrackerClient(QWidget):
             'notes': self.notes_field.text()
         }
 
-        try:
-            response = requests.put(f"{BASE_URL}/expenses/{self.current_expense_id}", json=updated_expense)
-            if response.status_code == 200:
-                QMessageBox.information(self, 'Success', 'Expense updated successfully')
-                self.load_expenses()
-            else:
-                QMessageBox.critical(self, 'Error', 'Failed to update expense')
-        except ConnectionError:
-            QMessageBox.critical(self, 'Error', 'Failed to connect to the server')
+        self.run_in_background(self.api.update_expense, self.current_expense_id, updated_expense,
+                               on_finished=self.expense_updated,
+                               on_failed=lambda message: self.show_error(f'Failed to update expense\n{message}'))
+
+    def expense_updated(self, expense):
+        QMessageBox.information(self, 'Success', 'Expense updated successfully')
+        self.sync_expenses()
 
     def delete_expense(self):
         if not hasattr(self, 'current_expense_id'):
             QMessageBox.warning(self, 'Warning', 'No expense selected')
             return
 
-        try:
-            response = requests.delete(f"{BASE_URL}/expenses/{self.current_expense_id}")
-            if response.status_code == 200:
-                QMessageBox.information(self, 'Success', 'Expense deleted successfully')
-                self.load_expenses()
-                self.expense_info.clear()
-            else:
-                QMessageBox.critical(self, 'Error', 'Failed to delete expense')
-        except ConnectionError:
-            QMessageBox.critical(self, 'Error', 'Failed to connect to the server')
+        self.run_in_background(self.api.delete_expense, self.current_expense_id,
+                               on_finished=self.expense_deleted,
+                               on_failed=lambda message: self.show_error(f'Failed to delete expense\n{message}'))
+
+    def expense_deleted(self, result):
+        QMessageBox.information(self, 'Success', 'Expense deleted successfully')
+        del self.current_expense_id
+        self.expense_info.clear()
+        self.sync_expenses()
 
     def open_add_expense_dialog(self):
         dialog = AddExpenseDialog(self)
         if dialog.exec_() == QDialog.Accepted:
-            self.load_expenses()
-
-def start_server():
-    server_thread = threading.Thread(target=run_server)
-    server_thread.daemon = True
-    server_thread.start()
+            self.sync_expenses()
 
 if __name__ == '__main__':
-    # start_server()
+    # The server is imported and started only on request, the window usually talks to a running one
+    if '--start-server' in sys.argv[1:]:
+        start_server(BASE_URL)
     app = QApplication(sys.argv)
     client = ExpenseTrackerClient()
     client.show()
@@ -1,17 +1,88 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
-from fastapi import UploadFile
-from data_model import Expense
+from typing import AsyncIterator, List, Optional
+from fastapi import HTTPException, status, UploadFile
+from data_model import Expense, ExpenseChanges, BatchOperation, BatchResult
+from rollups import compute_summary
+from analytics import ColumnarExpenses
+from attachment_store import AttachmentFile
+from expense_json import ExpensesJson
+
+
+def require_batch_id(operation: BatchOperation) -> str:
+    if not operation.id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"'{operation.op}' needs an id")
+    return operation.id
+
+
+def changes_gone() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_410_GONE, detail="Version too old, reload all expenses")
+
+
+def require_batch_expense(operation: BatchOperation) -> Expense:
+    if operation.expense is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"'{operation.op}' needs an expense")
+    return operation.expense
 
 
 class ExpenseRepository(ABC):
     '''Expense repository interface'''
     @abstractmethod
-    async def get_expenses(self, tag: Optional[str], category: Optional[str], currency: Optional[str]) -> List[Expense]:
+    async def get_expenses(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                           cursor: Optional[str] = None, limit: Optional[int] = None,
+                           min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                           order_by: Optional[str] = None) -> List[Expense]:
+        '''
+        Return the expenses matching the filters, min_amount and max_amount
+        included (a missing amount counts as 0). Without cursor, limit and
+        order_by they come in insertion order. Otherwise they are ordered by
+        order_by: 'id' (the default), 'amount' or '-amount' (descending),
+        amount ties ordered by id. They start after the cursor expense, and at
+        most limit are returned.
+        '''
         pass
 
+    async def get_expenses_json(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                                cursor: Optional[str] = None, limit: Optional[int] = None,
+                                min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                                order_by: Optional[str] = None) -> ExpensesJson:
+        '''get_expenses() encoded as a JSON array, for responses that skip the response model'''
+        expenses = await self.get_expenses(tag, category, currency, cursor, limit, min_amount, max_amount, order_by)
+        return ExpensesJson.from_expenses(expenses)
+
+    @abstractmethod
+    async def get_all_expenses(self, cursor: Optional[str] = None, limit: Optional[int] = None) -> List[Expense]:
+        pass
+
+    async def iter_expenses(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                            cursor: Optional[str] = None, limit: Optional[int] = None,
+                            min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                            order_by: Optional[str] = None, page_size: int = 1000) -> AsyncIterator[Expense]:
+        '''Yield matching expenses in order_by order (id by default), fetching one page at a time'''
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            page = await self.get_expenses(tag, category, currency, cursor=cursor, limit=size,
+                                           min_amount=min_amount, max_amount=max_amount, order_by=order_by)
+            for expense in page:
+                yield expense
+            if len(page) < size:
+                return
+            cursor = page[-1].id
+            if remaining is not None:
+                remaining -= len(page)
+
     @abstractmethod
-    async def get_all_expenses(self) -> List[Expense]:
+    async def get_version(self) -> int:
+        '''Version of the expense table, increased by every change'''
+        pass
+
+    @abstractmethod
+    async def get_changes(self, since: int) -> ExpenseChanges:
+        '''
+        Return the expenses created or updated and the ids deleted after
+        version since. Raise 410 Gone if since is too old (or unknown) to
+        answer, in which case the client has to reload all expenses.
+        '''
         pass
 
     @abstractmethod
@@ -35,5 +106,60 @@ class ExpenseRepository(ABC):
         pass
 
     @abstractmethod
-    async def download_attachment(self, expense_id: str, file_name: str) -> Optional[str]:
+    async def download_attachment(self, expense_id: str, file_name: str) -> Optional[AttachmentFile]:
+        '''Locate an attachment of an expense; 404 if the expense or the attachment is missing'''
+        pass
+
+    async def sweep_attachments(self) -> dict:
+        '''
+        Queue attachment files no expense lists for removal and return how many
+        files and bytes were found. This default has nothing to sweep.
+        '''
+        return {'files': 0, 'bytes': 0, 'dropped_refs': 0}
+
+    async def get_summary(self, group_by: List[str]) -> List[dict]:
+        '''
+        Count, sum, min and max of amounts grouped by any of category, tag and
+        currency. This default scans every expense.
+        '''
+        expenses = await self.get_all_expenses()
+        return compute_summary((expense.dict() for expense in expenses), group_by)
+
+    async def get_columns(self) -> ColumnarExpenses:
+        '''
+        Column projection of all expenses for analytics.build_report, which
+        runs on a worker thread: it must not change after it is returned.
+        This default builds it from a full scan on every call.
+        '''
+        expenses = await self.get_all_expenses()
+        return ColumnarExpenses.from_expenses(expense.dict() for expense in expenses)
+
+    async def apply_batch(self, operations: List[BatchOperation]) -> List[BatchResult]:
+        '''
+        Apply create/update/delete operations in order and return one result per
+        operation. A failing item does not stop the others. Implementations
+        should persist all successful items in a single write; this default
+        falls back to one call per item.
+        '''
+        results = []
+        for operation in operations:
+            try:
+                if operation.op == 'create':
+                    expense = await self.add_expense(require_batch_expense(operation))
+                    results.append(BatchResult(op=operation.op, status=status.HTTP_201_CREATED, id=expense.id, expense=expense))
+                elif operation.op == 'update':
+                    expense = await self.update_expense(require_batch_id(operation), require_batch_expense(operation))
+                    results.append(BatchResult(op=operation.op, status=status.HTTP_200_OK, id=expense.id, expense=expense))
+                else:
+                    await self.delete_expense(require_batch_id(operation))
+                    results.append(BatchResult(op=operation.op, status=status.HTTP_200_OK, id=operation.id))
+            except HTTPException as e:
+                results.append(BatchResult(op=operation.op, status=e.status_code, id=operation.id, detail=str(e.detail)))
+        return results
+
+    def cache_stats(self) -> dict:
+        '''Cache hit/miss counters, empty for implementations without a cache'''
+        return {}
+
+    def close(self):
         pass
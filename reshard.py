@@ -0,0 +1,66 @@
+'''
+Change the number of shards of a file backend data directory.
+
+Reads every expense in data_dir, whatever its storage mode and current
+shard count, and writes it again split into --shards shards (1 for a single
+unsharded store) using --storage-mode. Stop the server first.
+
+    python -m reshard data --shards 8 --storage-mode journal
+'''
+import argparse
+import os
+import shutil
+from file_storage import STORAGE_MODES, load_file_store, write_file_store, write_shards
+
+# Files of an unsharded store, in any storage mode
+UNSHARDED_FILES = ('expenses.json', 'expenses.journal', 'expenses.bin')
+
+
+def reshard(data_dir: str, shard_count: int, storage_mode: str) -> int:
+    '''Rewrite data_dir with shard_count shards and return the number of expenses moved'''
+    expenses = load_file_store(data_dir)
+    shards_dir = os.path.join(data_dir, 'shards')
+
+    if shard_count > 1:
+        # Build the new shards next to the old ones and swap them in once complete
+        new_dir = shards_dir + '.new'
+        shutil.rmtree(new_dir, ignore_errors=True)
+        write_shards(storage_mode, new_dir, shard_count, expenses)
+        old_dir = shards_dir + '.old'
+        if os.path.exists(shards_dir):
+            os.replace(shards_dir, old_dir)
+        os.replace(new_dir, shards_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        # A stale unsharded store would come back if the server were started with one shard
+        for file_name in UNSHARDED_FILES:
+            if os.path.exists(os.path.join(data_dir, file_name)):
+                os.remove(os.path.join(data_dir, file_name))
+    else:
+        new_dir = os.path.join(data_dir, 'unsharded.new')
+        shutil.rmtree(new_dir, ignore_errors=True)
+        write_file_store(storage_mode, new_dir, expenses)
+        # Until the shards are removed, readers still prefer them over the files being replaced
+        for file_name in UNSHARDED_FILES:
+            if os.path.exists(os.path.join(new_dir, file_name)):
+                os.replace(os.path.join(new_dir, file_name), os.path.join(data_dir, file_name))
+            elif os.path.exists(os.path.join(data_dir, file_name)):
+                os.remove(os.path.join(data_dir, file_name))
+        os.rmdir(new_dir)
+        shutil.rmtree(shards_dir, ignore_errors=True)
+    return len(expenses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir')
+    parser.add_argument('--shards', type=int, required=True, help="New number of shards, 1 for no sharding")
+    parser.add_argument('--storage-mode', choices=list(STORAGE_MODES), default='json')
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    count = reshard(args.data_dir, args.shards, args.storage_mode)
+    print(f"Moved {count} expenses into {args.shards} shard(s) in {args.data_dir}")
+
+
+if __name__ == '__main__':
+    main()
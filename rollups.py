@@ -0,0 +1,96 @@
+import bisect
+import math
+from itertools import combinations
+from typing import Dict, Iterable, List, Tuple
+
+# Fields /expenses/summary can group by, in the order they appear in results
+SUMMARY_FIELDS = ('category', 'tag', 'currency')
+
+# Every combination of SUMMARY_FIELDS, from the overall total to the finest grouping
+GROUPINGS = [list(fields) for size in range(len(SUMMARY_FIELDS) + 1) for fields in combinations(SUMMARY_FIELDS, size)]
+
+
+def normalize_group_by(group_by: Iterable[str]) -> List[str]:
+    '''Drop duplicates and put the fields in SUMMARY_FIELDS order'''
+    return [field for field in SUMMARY_FIELDS if field in group_by]
+
+
+def _amount(expense: dict) -> float:
+    return expense.get('amount') or 0.0
+
+
+def _summary_row(key: Tuple, group_by: List[str], count: int, total: float, minimum: float, maximum: float) -> dict:
+    row = dict(zip(group_by, key))
+    row.update(count=count, sum=total, min=minimum, max=maximum)
+    return row
+
+
+class RollupIndex:
+    '''
+    Count, sum, min and max of expense amounts per (category, tag, currency),
+    maintained incrementally. Coarser groupings are merged from these at read
+    time, so a summary costs O(groups) instead of O(expenses). Each group keeps
+    its amounts sorted so min and max survive deletions.
+    '''
+
+    def __init__(self):
+        self._totals: Dict[Tuple, float] = {}
+        self._amounts: Dict[Tuple, List[float]] = {}
+
+    @staticmethod
+    def _key(expense: dict) -> Tuple:
+        return tuple(expense.get(field) for field in SUMMARY_FIELDS)
+
+    def add(self, row: int, expense: dict):
+        key = self._key(expense)
+        amount = _amount(expense)
+        self._totals[key] = self._totals.get(key, 0.0) + amount
+        bisect.insort(self._amounts.setdefault(key, []), amount)
+
+    def remove(self, row: int, expense: dict):
+        key = self._key(expense)
+        amounts = self._amounts.get(key)
+        if not amounts:
+            return
+        amount = _amount(expense)
+        del amounts[bisect.bisect_left(amounts, amount)]
+        if amounts:
+            self._totals[key] -= amount
+        else:
+            del self._amounts[key]
+            del self._totals[key]
+
+    def clear(self):
+        self._totals = {}
+        self._amounts = {}
+
+    def summary(self, group_by: List[str]) -> List[dict]:
+        group_by = normalize_group_by(group_by)
+        positions = [SUMMARY_FIELDS.index(field) for field in group_by]
+        merged: Dict[Tuple, list] = {}
+        for key, amounts in self._amounts.items():
+            group_key = tuple(key[position] for position in positions)
+            group = merged.get(group_key)
+            if group is None:
+                merged[group_key] = [len(amounts), self._totals[key], amounts[0], amounts[-1]]
+            else:
+                group[0] += len(amounts)
+                group[1] += self._totals[key]
+                group[2] = min(group[2], amounts[0])
+                group[3] = max(group[3], amounts[-1])
+        return [_summary_row(key, group_by, *group) for key, group in sorted(merged.items(), key=_sort_key)]
+
+
+def _sort_key(item) -> Tuple:
+    return tuple('' if value is None else value for value in item[0])
+
+
+def compute_summary(expenses: Iterable[dict], group_by: List[str]) -> List[dict]:
+    '''Full-scan summary, the reference RollupIndex must agree with'''
+    group_by = normalize_group_by(group_by)
+    groups: Dict[Tuple, List[float]] = {}
+    for expense in expenses:
+        key = tuple(expense.get(field) for field in group_by)
+        groups.setdefault(key, []).append(_amount(expense))
+    return [_summary_row(key, group_by, len(amounts), math.fsum(amounts), min(amounts), max(amounts))
+            for key, amounts in sorted(groups.items(), key=_sort_key)]
@@ -0,0 +1,366 @@
+import os
+import re
+import zlib
+import math
+import bisect
+import unicodedata
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Words of the name count this many times as much as words of the notes
+NAME_WEIGHT = 2
+# BM25 term frequency saturation and length normalization. Lengths are
+# compared to a fixed average, so a stored weight never depends on the rest
+# of the data and never goes stale.
+K1 = 1.2
+B = 0.75
+AVERAGE_LENGTH = 8
+# A word that only starts with the query term scores this fraction of a whole-word match
+PREFIX_FACTOR = 0.5
+# Floor of a word's idf, so that a word in every expense still counts as a match
+MIN_IDF = 0.01
+# Most vocabulary words one query term expands to by prefix
+MAX_EXPANSIONS = 64
+# Postings changed since the last compaction are merged into the arrays once
+# there are this many, or a quarter of the indexed postings if that is more
+COMPACT_MIN = 50_000
+# Words added since the sorted vocabulary was built are kept apart until there are this many
+MERGE_MIN = 4096
+
+FORMAT_VERSION = 1
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    '''Lowercase words of text, with accents stripped ("Café" -> "cafe")'''
+    if not text:
+        return []
+    text = text.lower()
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return TOKEN_PATTERN.findall(text)
+
+
+def term_weights(expense: dict) -> Dict[str, float]:
+    '''BM25 term frequency weight (0-1) of every word of the expense's name and notes'''
+    name_tokens = tokenize(expense.get('name'))
+    notes_tokens = tokenize(expense.get('notes'))
+    frequencies: Dict[str, int] = {}
+    for token in name_tokens:
+        frequencies[token] = frequencies.get(token, 0) + NAME_WEIGHT
+    for token in notes_tokens:
+        frequencies[token] = frequencies.get(token, 0) + 1
+    length = len(name_tokens) * NAME_WEIGHT + len(notes_tokens)
+    norm = K1 * (1 - B + B * length / AVERAGE_LENGTH)
+    return {token: frequency / (frequency + norm) for token, frequency in frequencies.items()}
+
+
+def fingerprint(expenses: Dict[str, dict]) -> int:
+    '''Order-independent checksum of the indexed text of expenses'''
+    # crc32 rather than the salted hash(), the checksum is compared across processes
+    return sum(zlib.crc32(f"{expense_id}\0{expense.get('name')}\0{expense.get('notes')}".encode())
+               for expense_id, expense in expenses.items()) % 2 ** 63
+
+
+class SearchIndex:
+    '''
+    Inverted index from the words of expense names and notes to the rows of
+    the expenses containing them, maintained with add(row, expense) /
+    remove(row, expense) / clear() like FieldIndex.
+
+    Postings live in NumPy arrays sorted by word: the rows and term weights
+    of word w are rows[offsets[w]:offsets[w + 1]]. Changes since the arrays
+    were built are kept in a dict delta, with the rows whose array postings
+    are out of date marked stale, and merged into the arrays once the delta
+    is large. A query matches the expenses containing all its terms, each
+    term matching the words it is a prefix of, and ranks them by BM25-like
+    scores. Only the matches of the rarest term are scored against the
+    others, by binary search in their row-sorted postings.
+    '''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._documents = 0
+        # Every word ever added gets an id, its position in _words
+        self._words: List[str] = []
+        self._word_ids: Dict[str, int] = {}
+        # Word ids ordered by word for prefix lookups, plus words added after it was sorted
+        self._sorted_words: List[str] = []
+        self._sorted_ids: List[int] = []
+        self._new_word_ids: List[int] = []
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._rows = np.zeros(0, dtype=np.int32)
+        self._weights = np.zeros(0, dtype=np.float32)
+        self._row_count = 0
+        # word id -> {row: weight} of the postings added since the arrays were built
+        self._delta: Dict[int, Dict[int, float]] = {}
+        self._delta_size = 0
+        self._delta_rows: Set[int] = set()
+        # Rows whose postings in the arrays no longer count
+        self._stale: Set[int] = set()
+        self._stale_rows: Optional[np.ndarray] = None
+        self._stale_flags: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return self._documents
+
+    def _word_id(self, token: str) -> int:
+        word_id = self._word_ids.get(token)
+        if word_id is None:
+            word_id = self._word_ids[token] = len(self._words)
+            self._words.append(token)
+            self._new_word_ids.append(word_id)
+        return word_id
+
+    def add(self, row: int, expense: dict):
+        self._documents += 1
+        self._row_count = max(self._row_count, row + 1)
+        delta = self._delta
+        for token, weight in term_weights(expense).items():
+            word_id = self._word_id(token)
+            postings = delta.get(word_id)
+            if postings is None:
+                postings = delta[word_id] = {}
+            postings[row] = weight
+            self._delta_size += 1
+        self._delta_rows.add(row)
+
+    def remove(self, row: int, expense: dict):
+        self._documents -= 1
+        if row not in self._delta_rows:
+            self._stale.add(row)
+            self._stale_rows = self._stale_flags = None
+            return
+        self._delta_rows.discard(row)
+        for token in term_weights(expense):
+            postings = self._delta.get(self._word_ids.get(token))
+            if postings is not None and postings.pop(row, None) is not None:
+                self._delta_size -= 1
+
+    def _compact(self):
+        '''Merge the delta into the arrays and drop the postings of stale rows'''
+        words = np.repeat(np.arange(len(self._offsets) - 1, dtype=np.int32), np.diff(self._offsets))
+        rows = self._rows
+        weights = self._weights
+        if self._stale:
+            keep = ~np.isin(rows, self._stale_array())
+            words, rows, weights = words[keep], rows[keep], weights[keep]
+
+        delta_words: List[int] = []
+        delta_rows: List[int] = []
+        delta_weights: List[float] = []
+        for word_id, postings in self._delta.items():
+            delta_words += [word_id] * len(postings)
+            delta_rows += postings.keys()
+            delta_weights += postings.values()
+        words = np.concatenate((words, np.array(delta_words, dtype=np.int32)))
+        rows = np.concatenate((rows, np.array(delta_rows, dtype=np.int32)))
+        weights = np.concatenate((weights, np.array(delta_weights, dtype=np.float32)))
+
+        order = np.lexsort((rows, words))
+        self._set_postings(words[order], rows[order], weights[order])
+        self._delta = {}
+        self._delta_size = 0
+        self._delta_rows = set()
+        self._stale = set()
+        self._stale_rows = self._stale_flags = None
+
+    def _set_postings(self, words: np.ndarray, rows: np.ndarray, weights: np.ndarray):
+        '''Install postings sorted by word id'''
+        counts = np.bincount(words, minlength=len(self._words))
+        self._offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self._rows = rows
+        self._weights = weights
+
+    def _merge_vocabulary(self):
+        self._sorted_ids = sorted(range(len(self._words)), key=self._words.__getitem__)
+        self._sorted_words = [self._words[word_id] for word_id in self._sorted_ids]
+        self._new_word_ids = []
+
+    def _prepare(self):
+        if self._delta_size + len(self._stale) > max(COMPACT_MIN, len(self._rows) // 4):
+            self._compact()
+        if len(self._new_word_ids) > max(MERGE_MIN, len(self._sorted_words) // 32):
+            self._merge_vocabulary()
+
+    def _stale_array(self) -> np.ndarray:
+        if self._stale_rows is None:
+            self._stale_rows = np.fromiter(self._stale, dtype=np.int64, count=len(self._stale))
+        return self._stale_rows
+
+    def _frequency(self, word_id: int) -> int:
+        '''Number of expenses containing the word, counting stale rows until the next compaction'''
+        frequency = len(self._delta.get(word_id, ()))
+        if word_id < len(self._offsets) - 1:
+            frequency += int(self._offsets[word_id + 1] - self._offsets[word_id])
+        return frequency
+
+    def _idf(self, word_id: int) -> float:
+        frequency = self._frequency(word_id)
+        # Stale rows can push the frequency past the document count, keep matches positive
+        return max(math.log(1 + (self._documents - frequency + 0.5) / (frequency + 0.5)), MIN_IDF)
+
+    def _expand(self, term: str) -> List[Tuple[int, float]]:
+        '''Words matching a query term: itself at full weight, longer words starting with it at PREFIX_FACTOR'''
+        word_ids = []
+        start = bisect.bisect_left(self._sorted_words, term)
+        for word, word_id in zip(self._sorted_words[start:start + MAX_EXPANSIONS],
+                                 self._sorted_ids[start:start + MAX_EXPANSIONS]):
+            if not word.startswith(term):
+                break
+            word_ids.append(word_id)
+        word_ids += [word_id for word_id in self._new_word_ids if self._words[word_id].startswith(term)]
+        # Words left without postings by deletes stay in the vocabulary until clear()
+        return [(word_id, 1.0 if self._words[word_id] == term else PREFIX_FACTOR)
+                for word_id in sorted(set(word_ids), key=self._words.__getitem__)[:MAX_EXPANSIONS]
+                if self._frequency(word_id)]
+
+    def _stale_mask(self) -> np.ndarray:
+        if self._stale_flags is None or len(self._stale_flags) < self._row_count:
+            self._stale_flags = np.zeros(self._row_count, dtype=bool)
+            self._stale_flags[self._stale_array()] = True
+        return self._stale_flags
+
+    def _term_postings(self, words: List[Tuple[int, float]]) -> List[Tuple[np.ndarray, np.ndarray, bool]]:
+        '''
+        (rows, scores, stored) postings of the words matching one query term,
+        rows sorted. Stored postings (from the arrays) include stale rows.
+        '''
+        postings = []
+        stored_words = len(self._offsets) - 1
+        for word_id, factor in words:
+            idf = self._idf(word_id) * factor
+            if word_id < stored_words:
+                start, end = self._offsets[word_id], self._offsets[word_id + 1]
+                if end > start:
+                    postings.append((self._rows[start:end], self._weights[start:end] * np.float32(idf), True))
+            delta = self._delta.get(word_id)
+            if delta:
+                rows = np.fromiter(delta.keys(), dtype=np.int32, count=len(delta))
+                weights = np.fromiter(delta.values(), dtype=np.float32, count=len(delta))
+                order = np.argsort(rows)
+                postings.append((rows[order], weights[order] * np.float32(idf), False))
+        return postings
+
+    def _matches(self, postings: List[Tuple[np.ndarray, np.ndarray, bool]],
+                 several_words: bool) -> Tuple[np.ndarray, np.ndarray]:
+        '''Rows matching one query term and their score, the best of its words'''
+        parts = []
+        for rows, scores, stored in postings:
+            if stored and self._stale:
+                current = ~self._stale_mask().take(rows)
+                rows, scores = rows[current], scores[current]
+            parts.append((rows, scores))
+        if len(parts) == 1:
+            return parts[0]
+        rows = np.concatenate([rows for rows, _ in parts])
+        scores = np.concatenate([scores for _, scores in parts])
+        if several_words:
+            # Best score first within each row, then keep the first entry of every row.
+            # A single word's stored and delta postings never share a row.
+            order = np.lexsort((-scores, rows))
+            rows, scores = rows[order], scores[order]
+            first = np.concatenate(([True], rows[1:] != rows[:-1]))
+            rows, scores = rows[first], scores[first]
+        return rows, scores
+
+    def _lookup(self, postings: List[Tuple[np.ndarray, np.ndarray, bool]], rows: np.ndarray,
+                stale: Optional[np.ndarray]) -> np.ndarray:
+        '''Score of rows for one query term, 0 where they do not match it'''
+        result = np.zeros(len(rows), dtype=np.float32)
+        for term_rows, scores, stored in postings:
+            positions = np.searchsorted(term_rows, rows)
+            positions[positions == len(term_rows)] = 0
+            hits = term_rows[positions] == rows
+            if stored and stale is not None:
+                hits &= ~stale
+            result = np.where(hits, np.maximum(result, scores[positions]), result)
+        return result
+
+    def search(self, query: str, limit: int) -> List[Tuple[float, int]]:
+        '''(score, row) of the best limit matches of query, best first, ties in row order'''
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or limit <= 0:
+            return []
+        self._prepare()
+        term_words = [self._expand(term) for term in terms]
+        if not all(term_words):
+            return []
+
+        # Candidates are the matches of the rarest term, the other terms are looked up for them only
+        term_postings = sorted(((self._term_postings(words), len(words) > 1) for words in term_words),
+                               key=lambda item: sum(len(rows) for rows, _, _ in item[0]))
+        rows, total = self._matches(*term_postings[0])
+        stale = self._stale_mask().take(rows) if self._stale and len(term_postings) > 1 else None
+        for postings, _ in term_postings[1:]:
+            scores = self._lookup(postings, rows, stale)
+            matched = scores > 0
+            rows, total = rows[matched], total[matched] + scores[matched]
+            if stale is not None:
+                stale = stale[matched]
+
+        if len(rows) > limit:
+            # Everything scoring at least the limit-th best score, ties included
+            threshold = np.partition(total, len(total) - limit)[len(total) - limit]
+            keep = total >= threshold
+            rows, total = rows[keep], total[keep]
+        order = np.lexsort((rows, -total))[:limit]
+        return [(float(score), int(row)) for score, row in zip(total[order], rows[order])]
+
+    def save(self, file_path: str, expenses: Dict[str, dict], rows: Dict[str, int]):
+        '''
+        Write the index to file_path with the fingerprint of expenses, rows
+        stored as positions in the order of rows (id -> row).
+        '''
+        self._compact()
+        positions = np.full(self._row_count, -1, dtype=np.int32)
+        positions[np.fromiter(rows.values(), dtype=np.int64, count=len(rows))] = np.arange(len(rows), dtype=np.int32)
+        words = np.repeat(np.arange(len(self._offsets) - 1, dtype=np.int32), np.diff(self._offsets))
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez(file,
+                     header=np.array([FORMAT_VERSION, fingerprint(expenses), len(rows)], dtype=np.int64),
+                     ids=np.frombuffer('\n'.join(rows).encode(), dtype=np.uint8),
+                     words=np.frombuffer('\n'.join(self._words).encode(), dtype=np.uint8),
+                     posting_words=words, posting_rows=positions[self._rows], posting_weights=self._weights)
+        os.replace(tmp_path, file_path)
+
+    def restore(self, file_path: str, expenses: Dict[str, dict], rows: Dict[str, int]) -> bool:
+        '''
+        Load an index saved by save() if it was saved for the same expense
+        texts, mapping its positions to rows (id -> row). Returns False,
+        leaving the index untouched, when it cannot be used.
+        '''
+        try:
+            with np.load(file_path, allow_pickle=False) as saved:
+                version, checksum, count = saved['header'].tolist()
+                if version != FORMAT_VERSION or count != len(rows) or checksum != fingerprint(expenses):
+                    return False
+                ids = saved['ids'].tobytes().decode().split('\n') if count else []
+                words = saved['words'].tobytes().decode().split('\n') if saved['words'].size else []
+                posting_words = saved['posting_words']
+                positions = saved['posting_rows']
+                weights = saved['posting_weights']
+        except (OSError, KeyError, ValueError):
+            return False
+        try:
+            row_of = np.fromiter(map(rows.__getitem__, ids), dtype=np.int32, count=len(ids))
+        except KeyError:
+            return False
+
+        self.clear()
+        self._documents = len(rows)
+        self._words = words
+        self._word_ids = {word: word_id for word_id, word in enumerate(words)}
+        self._row_count = int(row_of.max()) + 1 if len(row_of) else 0
+        rows_array = row_of[positions]
+        if not np.array_equal(row_of, np.arange(len(row_of))):
+            # Shards load in shard order, so rows differ from the saved positions and need sorting again
+            order = np.lexsort((rows_array, posting_words))
+            posting_words, rows_array, weights = posting_words[order], rows_array[order], weights[order]
+        self._set_postings(posting_words, rows_array, weights)
+        self._merge_vocabulary()
+        return True
@@ -1,32 +1,90 @@
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, status, Query, File, UploadFile
+from email.utils import parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, status, Query, File, UploadFile, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
-from typing import List, Optional
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse, StreamingResponse
+from typing import AsyncIterator, List, Literal, Optional
 import uvicorn
 
-from data_model import Expense
-from fs_expense_repository import FileExpenseRepository
+import config
+import analytics
+from metrics import REGISTRY, MetricsMiddleware, SamplingProfiler
+from data_model import Expense, ExpenseChanges, BatchOperation, BatchResult, CURRENCY_LIST
+from repository import ExpenseRepository
+from expense_json import ExpensesJson
+from compression import choose_encoding, compress
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 logger = logging.getLogger(__name__)
-data_dir = 'data'
 
-# Initialize singleton repository
-expense_repository = FileExpenseRepository(data_dir)
+def create_expense_repository() -> ExpenseRepository:
+    shared = config.WORKERS > 1
+    purge_bytes_per_s = config.ATTACHMENT_PURGE_MB_PER_S * 2 ** 20
+    if config.BACKEND == 'sqlite':
+        from sqlite_expense_repository import SqliteExpenseRepository
+        return SqliteExpenseRepository(config.DATA_DIR, config.SQLITE_POOL_SIZE, shared, purge_bytes_per_s)
+    if config.BACKEND == 'file':
+        from fs_expense_repository import FileExpenseRepository
+        return FileExpenseRepository(config.DATA_DIR, config.STORAGE_MODE, config.IO_WORKERS,
+                                     config.COMMIT_WINDOW_MS / 1000, config.COMMIT_MAX_BATCH, config.SHARDS, shared,
+                                     purge_bytes_per_s)
+    raise ValueError(f"Unknown repository backend '{config.BACKEND}', expected 'file' or 'sqlite'")
+
+# Singleton repository, created at startup so that with several workers only the worker processes build it,
+# not the supervisor that imports this module too
+expense_repository: Optional[ExpenseRepository] = None
+
+# Exchange rates for /expenses/analytics, read again only when the file changes
+exchange_rates = analytics.RatesFile(config.RATES_FILE)
 
 app = FastAPI()
 
+# Stack sampler of the event loop thread, started at startup when PROFILER_INTERVAL_MS is set
+profiler: Optional[SamplingProfiler] = None
+# Periodic attachment sweep, started at startup when ATTACHMENT_SWEEP_INTERVAL_S is set
+attachment_sweeper: Optional[asyncio.Task] = None
+
+async def sweep_attachments() -> dict:
+    swept = await expense_repository.sweep_attachments()
+    logger.info("Attachment sweep: %d orphaned files (%d bytes) queued for removal, %d dangling references dropped.",
+                swept['files'], swept['bytes'], swept['dropped_refs'])
+    return swept
+
+async def sweep_attachments_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep_attachments()
+        except Exception:
+            logger.exception("Attachment sweep failed.")
+
 @app.on_event("startup")
 async def startup_event():
+    global expense_repository, profiler, attachment_sweeper
+    expense_repository = create_expense_repository()
     expense_repository.ensure_data_file()
-    logger.info("Application startup: Data directory and files ensured.")
+    if config.PROFILER_INTERVAL_MS:
+        profiler = SamplingProfiler(config.PROFILER_INTERVAL_MS / 1000)
+        profiler.start()
+        logger.info("Sampling profiler started, every %s ms.", config.PROFILER_INTERVAL_MS)
+    if config.ATTACHMENT_SWEEP_INTERVAL_S:
+        attachment_sweeper = asyncio.create_task(sweep_attachments_periodically(config.ATTACHMENT_SWEEP_INTERVAL_S))
+    logger.info("Application startup: Data directory and files ensured (%s backend).", config.BACKEND)
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    global expense_repository
+    if profiler is not None:
+        profiler.stop()
+    if attachment_sweeper is not None:
+        attachment_sweeper.cancel()
+    expense_repository.close()
+    expense_repository = None
     logger.info("Application shutdown.")
 
 # Add CORS middleware
@@ -42,19 +100,156 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Expenses-Version"],
 )
 
+# Added last so it is outermost and its timings include the CORS middleware
+app.add_middleware(MetricsMiddleware, slow_request_seconds=config.SLOW_REQUEST_MS / 1000)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def wants_ndjson(request: Request, stream: bool) -> bool:
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+async def ndjson_lines(expenses: AsyncIterator[Expense]) -> AsyncIterator[str]:
+    async for expense in expenses:
+        yield expense.json() + "\n"
+
+VERSION_HEADER = "X-Expenses-Version"
+
+async def json_list_response(request: Request, response: Response, expenses: ExpensesJson,
+                             limit: Optional[int]) -> Response:
+    '''
+    Send an encoded list as is, bypassing the response model, compressed
+    when it is large and the client accepts br or gzip.
+    '''
+    headers = dict(response.headers)
+    if limit and expenses.count == limit:
+        headers["X-Next-Cursor"] = expenses.last_id
+    body = expenses.body
+    if config.COMPRESS_MIN_BYTES and len(body) >= config.COMPRESS_MIN_BYTES:
+        headers["Vary"] = "Accept-Encoding"
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            body = await run_in_threadpool(compress, body, encoding)
+            headers["Content-Encoding"] = encoding
+            # The compressed bytes differ from the identity ones, so the version tag becomes weak
+            if "etag" in headers:
+                headers["etag"] = "W/" + headers["etag"]
+    return Response(body, media_type="application/json", headers=headers)
+
+async def check_not_modified(request: Request, response: Response) -> Optional[Response]:
+    '''
+    Tag the response with the current version of the expenses. Return a 304
+    response if the client already holds that version (If-None-Match).
+    '''
+    # Read before the data, so the tag is never newer than the content it labels
+    version = await expense_repository.get_version()
+    etag = f'"{version}"'
+    headers = {"ETag": etag, VERSION_HEADER: str(version)}
+    response.headers.update(headers)
+    client_tags = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    if etag in client_tags or "W/" + etag in client_tags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return None
+
 @app.get("/expenses/", response_model=List[Expense], status_code=status.HTTP_200_OK)
 async def query_expenses(
+    request: Request,
+    response: Response,
     tag: Optional[str] = Query(None, description="Filter by tag"),
     category: Optional[str] = Query(None, description="Filter by category"),
-    currency: Optional[str] = Query(None, description="Filter by currency")
+    currency: Optional[str] = Query(None, description="Filter by currency"),
+    min_amount: Optional[float] = Query(None, description="Only expenses with at least this amount"),
+    max_amount: Optional[float] = Query(None, description="Only expenses with at most this amount"),
+    order_by: Optional[Literal['id', 'amount', '-amount']] = Query(
+        None, description="Sort by id, by amount or by amount descending; insertion order by default, id with cursor or limit"),
+    cursor: Optional[str] = Query(None, description="Return expenses after this one (from X-Next-Cursor)"),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum number of expenses, ordered by id unless order_by is given"),
+    stream: bool = Query(False, description="Stream newline-delimited JSON")
     ) -> List[Expense]:
-    return await expense_repository.get_expenses(tag, category, currency)
+    not_modified = await check_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    if wants_ndjson(request, stream):
+        expenses = expense_repository.iter_expenses(tag, category, currency, cursor, limit,
+                                                    min_amount, max_amount, order_by)
+        return StreamingResponse(ndjson_lines(expenses), media_type=NDJSON_MEDIA_TYPE, headers=dict(response.headers))
+    expenses = await expense_repository.get_expenses_json(tag, category, currency, cursor, limit,
+                                                          min_amount, max_amount, order_by)
+    return await json_list_response(request, response, expenses, limit)
 
 @app.get("/expenses/all", response_model=List[Expense], status_code=status.HTTP_200_OK)
-async def get_all_expenses() -> List[Expense]:
-    return await expense_repository.get_all_expenses()
+async def get_all_expenses(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = Query(None, description="Return expenses with an id after this one (from X-Next-Cursor)"),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum number of expenses, ordered by id"),
+    stream: bool = Query(False, description="Stream newline-delimited JSON")
+    ) -> List[Expense]:
+    not_modified = await check_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    if wants_ndjson(request, stream):
+        expenses = expense_repository.iter_expenses(None, None, None, cursor, limit)
+        return StreamingResponse(ndjson_lines(expenses), media_type=NDJSON_MEDIA_TYPE, headers=dict(response.headers))
+    expenses = await expense_repository.get_expenses_json(None, None, None, cursor, limit)
+    return await json_list_response(request, response, expenses, limit)
+
+@app.get("/expenses/summary", status_code=status.HTTP_200_OK)
+async def get_summary(
+    request: Request,
+    response: Response,
+    group_by: List[Literal['category', 'tag', 'currency']] = Query([], description="Fields to group totals by")
+    ) -> List[dict]:
+    not_modified = await check_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return await expense_repository.get_summary(group_by)
+
+@app.get("/expenses/changes", response_model=ExpenseChanges, status_code=status.HTTP_200_OK)
+async def get_changes(
+    request: Request,
+    response: Response,
+    since: int = Query(..., description="Version the client holds (from X-Expenses-Version or a previous response)")
+    ) -> ExpenseChanges:
+    '''Expenses created or updated and ids deleted since a version; 410 means reload everything'''
+    not_modified = await check_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return await expense_repository.get_changes(since)
+
+@app.get("/expenses/search", response_model=List[Expense], status_code=status.HTTP_200_OK)
+async def search_expenses(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1, description="Words to find in names and notes, each also matching longer words it starts with"),
+    limit: int = Query(50, ge=1, le=1000, description="Maximum number of expenses"),
+    offset: int = Query(0, ge=0, description="Number of best matches to skip")
+    ) -> List[Expense]:
+    '''Expenses containing every word of q in their name or notes, best matches first'''
+    not_modified = await check_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return await expense_repository.search_expenses(q, limit, offset)
+
+@app.get("/expenses/analytics", status_code=status.HTTP_200_OK)
+async def get_analytics(
+    reporting_currency: CURRENCY_LIST = Query("USD", description="Currency every amount is converted to"),
+    category: Optional[str] = Query(None, description="Filter by category"),
+    tag: Optional[str] = Query(None, description="Filter by tag"),
+    currency: Optional[str] = Query(None, description="Filter by original currency"),
+    group_by: List[Literal['category', 'tag', 'currency']] = Query([], description="Fields to group converted totals by"),
+    bins: int = Query(10, ge=1, le=1000, description="Number of histogram bins")
+    ) -> dict:
+    columns = await expense_repository.get_columns()
+    try:
+        # Reading the rates file and the array work would hold up every other request on the event loop
+        rates = await run_in_threadpool(exchange_rates.get)
+        return await run_in_threadpool(analytics.build_report, columns, rates, reporting_currency, category, tag,
+                                       currency, group_by, bins=bins)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 @app.post("/expenses/", response_model=Expense, status_code=status.HTTP_201_CREATED)
 async def add_expense(expense: Expense) -> Expense:
@@ -68,6 +263,10 @@ async def update_expense(expense_id: str, updated_expense: Expense) -> Expense:
 async def delete_expense(expense_id: str) -> dict:
     return await expense_repository.delete_expense(expense_id)
 
+@app.post("/expenses/batch", response_model=List[BatchResult], status_code=status.HTTP_200_OK)
+async def apply_batch(operations: List[BatchOperation]) -> List[BatchResult]:
+    return await expense_repository.apply_batch(operations)
+
 @app.post("/expenses/{expense_id}/attachments", status_code=status.HTTP_201_CREATED)
 async def add_attachment(expense_id: str, files: List[UploadFile] = File([])) -> dict:
     return await expense_repository.add_attachment(expense_id, files)
@@ -76,14 +275,81 @@ async def add_attachment(expense_id: str, files: List[UploadFile] = File([])) ->
 async def delete_attachment(expense_id: str, file_name: str) -> dict:
     return await expense_repository.delete_attachment(expense_id, file_name)
 
-@app.get("/expenses/{expense_id}/attachments/download", response_class=FileResponse)
-async def download_attachment(expense_id: str, file_name: str) -> FileResponse:
-    file_path = await expense_repository.download_attachment(expense_id, file_name)
-    if file_path:
-        return FileResponse(file_path, filename=file_name)
-    else:
+class AttachmentResponse(FileResponse):
+    '''
+    FileResponse reading 1 MB at a time. Servers offering the
+    http.response.pathsend extension send whole files themselves (sendfile),
+    without the body passing through Python. Range and If-Range requests get
+    206 responses with only the requested bytes.
+    '''
+    chunk_size = 1024 * 1024
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    '''Whether the client's copy is current, by If-None-Match or else If-Modified-Since'''
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        client_tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in client_tags or "*" in client_tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@app.post("/attachments/sweep", status_code=status.HTTP_200_OK)
+async def sweep_attachments_now() -> dict:
+    '''Run the attachment sweep now and report the orphaned files and bytes queued for removal'''
+    return await sweep_attachments()
+
+@app.api_route("/expenses/{expense_id}/attachments/download", methods=["GET", "HEAD"], response_class=FileResponse)
+async def download_attachment(request: Request, expense_id: str, file_name: str) -> Response:
+    attachment = await expense_repository.download_attachment(expense_id, file_name)
+    if not attachment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
 
+    # Blobs are content-addressed, so their hash is a strong validator (needed for If-Range)
+    headers = {"ETag": f'"{attachment.content_hash}"'} if attachment.content_hash else None
+    response = AttachmentResponse(attachment.path, filename=file_name, stat_result=attachment.stat, headers=headers)
+    if is_not_modified(request, response.headers["etag"], attachment.stat.st_mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers={name: response.headers[name] for name in ("etag", "last-modified")})
+    return response
+
+@app.get("/health", status_code=status.HTTP_200_OK)
+async def health() -> dict:
+    '''Readiness probe: uvicorn only accepts connections once startup has finished, so any answer means ready'''
+    return {"status": "ok"}
+
+@app.get("/stats/cache", status_code=status.HTTP_200_OK)
+async def get_cache_stats() -> dict:
+    return expense_repository.cache_stats()
+
+def cache_gauges() -> dict:
+    '''Numeric cache_stats() values as trackxpense_cache_* gauges'''
+    gauges = {}
+    for name, value in expense_repository.cache_stats().items():
+        values = value.items() if isinstance(value, dict) else [('', value)]
+        for key, number in values:
+            if isinstance(number, (int, float)):
+                gauges['_'.join(filter(None, ['trackxpense_cache', name, key]))] = number
+    return gauges
+
+REGISTRY.add_collector(cache_gauges)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/profile", response_class=PlainTextResponse)
+async def get_profile(reset: bool = False) -> PlainTextResponse:
+    '''Sampled event loop stacks in collapsed format, ready for flamegraph.pl or speedscope'''
+    if profiler is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Profiler disabled, set TRACKXPENSE_PROFILER_INTERVAL_MS to enable it")
+    return PlainTextResponse(profiler.collapsed(reset))
+
 @app.get("/")
 async def root(response_class=HTMLResponse) -> HTMLResponse:
     logger.info("Root endpoint accessed.")
@@ -102,8 +368,12 @@ async def root(response_class=HTMLResponse) -> HTMLResponse:
     return HTMLResponse(content=html_content, status_code=200)
     # return await get_all_expenses()
 
-def run_server():
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+def run_server(workers: int = 1, port: int = 8000):
+    '''Serve on 127.0.0.1. Several workers are separate processes, which only works from the main thread.'''
+    if workers > 1:
+        uvicorn.run("server:app", host="127.0.0.1", port=port, workers=workers)
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=port)
 
 if __name__ == "__main__":
-    run_server()
+    run_server(config.WORKERS)
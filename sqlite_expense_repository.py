@@ -0,0 +1,600 @@
+import os
+import json
+import uuid
+import queue
+import asyncio
+import sqlite3
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Optional, Set, Tuple
+from fastapi import HTTPException, status, UploadFile
+from data_model import Expense, ExpenseChanges, BatchOperation, BatchResult
+from repository import ExpenseRepository, changes_gone, require_batch_id, require_batch_expense
+from file_storage import load_file_store
+from search_index import tokenize
+from attachment_store import AttachmentFile, AttachmentStore
+from rollups import normalize_group_by
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Statements are kept as constants so every pooled connection compiles each
+# one once and reuses it from its statement cache.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS expenses (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    name TEXT,
+    category TEXT,
+    amount REAL,
+    currency TEXT,
+    tag TEXT,
+    notes TEXT,
+    attachments TEXT NOT NULL DEFAULT '[]',
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_tag ON expenses(tag);
+CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses(category);
+CREATE INDEX IF NOT EXISTS idx_expenses_currency ON expenses(currency);
+CREATE INDEX IF NOT EXISTS idx_expenses_amount ON expenses(COALESCE(amount, 0), id);
+CREATE TABLE IF NOT EXISTS tombstones (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tombstones_version ON tombstones(version);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(
+    name, notes, content='expenses', content_rowid='seq', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS expenses_fts_insert AFTER INSERT ON expenses BEGIN
+    INSERT INTO expenses_fts (rowid, name, notes) VALUES (new.seq, new.name, new.notes);
+END;
+CREATE TRIGGER IF NOT EXISTS expenses_fts_delete AFTER DELETE ON expenses BEGIN
+    INSERT INTO expenses_fts (expenses_fts, rowid, name, notes) VALUES ('delete', old.seq, old.name, old.notes);
+END;
+CREATE TRIGGER IF NOT EXISTS expenses_fts_update AFTER UPDATE OF name, notes ON expenses BEGIN
+    INSERT INTO expenses_fts (expenses_fts, rowid, name, notes) VALUES ('delete', old.seq, old.name, old.notes);
+    INSERT INTO expenses_fts (rowid, name, notes) VALUES (new.seq, new.name, new.notes);
+END;
+-- Count, total, min and max of the amounts of every (category, tag, currency), kept by the triggers below for
+-- /expenses/summary. The index lets them find a group's new min or max without a scan.
+CREATE INDEX IF NOT EXISTS idx_expenses_group ON expenses(category, tag, currency, COALESCE(amount, 0));
+CREATE TABLE IF NOT EXISTS expense_rollups (
+    category TEXT,
+    tag TEXT,
+    currency TEXT,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    minimum REAL NOT NULL,
+    maximum REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_expense_rollups_group ON expense_rollups(category, tag, currency);
+CREATE TRIGGER IF NOT EXISTS expense_rollups_insert AFTER INSERT ON expenses BEGIN
+    INSERT INTO expense_rollups
+        SELECT new.category, new.tag, new.currency, 0, 0.0, COALESCE(new.amount, 0), COALESCE(new.amount, 0)
+        WHERE NOT EXISTS (SELECT 1 FROM expense_rollups
+                          WHERE category IS new.category AND tag IS new.tag AND currency IS new.currency);
+    UPDATE expense_rollups SET count = count + 1, total = total + COALESCE(new.amount, 0),
+        minimum = MIN(minimum, COALESCE(new.amount, 0)), maximum = MAX(maximum, COALESCE(new.amount, 0))
+        WHERE category IS new.category AND tag IS new.tag AND currency IS new.currency;
+END;
+CREATE TRIGGER IF NOT EXISTS expense_rollups_delete AFTER DELETE ON expenses BEGIN
+    -- The old row is gone from expenses already: min and max are looked up again if it held one of them
+    UPDATE expense_rollups SET count = count - 1, total = total - COALESCE(old.amount, 0)
+        WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency;
+    DELETE FROM expense_rollups
+        WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency AND count = 0;
+    UPDATE expense_rollups SET
+        minimum = (SELECT MIN(COALESCE(amount, 0)) FROM expenses
+                   WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency),
+        maximum = (SELECT MAX(COALESCE(amount, 0)) FROM expenses
+                   WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency)
+        WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency
+        AND COALESCE(old.amount, 0) IN (minimum, maximum);
+END;
+CREATE TRIGGER IF NOT EXISTS expense_rollups_update AFTER UPDATE OF category, tag, currency, amount ON expenses
+    WHEN old.category IS NOT new.category OR old.tag IS NOT new.tag OR old.currency IS NOT new.currency
+        OR COALESCE(old.amount, 0) != COALESCE(new.amount, 0) BEGIN
+    -- Out of the old group and into the new one, as the delete and insert triggers do
+    UPDATE expense_rollups SET count = count - 1, total = total - COALESCE(old.amount, 0)
+        WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency;
+    DELETE FROM expense_rollups
+        WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency AND count = 0;
+    UPDATE expense_rollups SET
+        minimum = (SELECT MIN(COALESCE(amount, 0)) FROM expenses
+                   WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency),
+        maximum = (SELECT MAX(COALESCE(amount, 0)) FROM expenses
+                   WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency)
+        WHERE category IS old.category AND tag IS old.tag AND currency IS old.currency
+        AND COALESCE(old.amount, 0) IN (minimum, maximum);
+    INSERT INTO expense_rollups
+        SELECT new.category, new.tag, new.currency, 0, 0.0, COALESCE(new.amount, 0), COALESCE(new.amount, 0)
+        WHERE NOT EXISTS (SELECT 1 FROM expense_rollups
+                          WHERE category IS new.category AND tag IS new.tag AND currency IS new.currency);
+    UPDATE expense_rollups SET count = count + 1, total = total + COALESCE(new.amount, 0),
+        minimum = MIN(minimum, COALESCE(new.amount, 0)), maximum = MAX(maximum, COALESCE(new.amount, 0))
+        WHERE category IS new.category AND tag IS new.tag AND currency IS new.currency;
+END;
+'''
+
+COLUMNS = 'id, name, category, amount, currency, tag, notes, attachments'
+# Sort key of amount order and range filters, a missing amount counts as 0
+AMOUNT_KEY = 'COALESCE(amount, 0)'
+SELECT_ALL = f'SELECT {COLUMNS} FROM expenses ORDER BY seq'
+SELECT_ONE = f'SELECT {COLUMNS} FROM expenses WHERE id = ?'
+SELECT_AMOUNT_KEY = f'SELECT {AMOUNT_KEY} FROM expenses WHERE id = ?'
+INSERT = f'INSERT INTO expenses ({COLUMNS}, version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+INSERT_OR_IGNORE = f'INSERT OR IGNORE INTO expenses ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+UPDATE = 'UPDATE expenses SET name = ?, category = ?, amount = ?, currency = ?, tag = ?, notes = ?, attachments = ?, version = ? WHERE id = ?'
+SELECT_ATTACHMENTS = "SELECT id, attachments FROM expenses WHERE attachments != '[]'"
+UPDATE_ATTACHMENTS = 'UPDATE expenses SET attachments = ?, version = ? WHERE id = ?'
+DELETE = 'DELETE FROM expenses WHERE id = ?'
+INSERT_TOMBSTONE = 'INSERT OR REPLACE INTO tombstones (id, version) VALUES (?, ?)'
+SELECT_CHANGED = f'SELECT {COLUMNS} FROM expenses WHERE version > ? AND version <= ? ORDER BY version, seq'
+SELECT_DELETED = 'SELECT id FROM tombstones WHERE version > ? AND version <= ? ORDER BY version'
+NEXT_VERSION = "INSERT INTO meta (key, value) VALUES ('version', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1 RETURNING value"
+# bm25 is lower for better matches; name words weigh twice as much as notes words, like the file index
+SEARCH = (f'SELECT {COLUMNS} FROM expenses JOIN '
+          '(SELECT rowid, bm25(expenses_fts, 2.0, 1.0) AS rank FROM expenses_fts WHERE expenses_fts MATCH ?) AS matches '
+          'ON matches.rowid = expenses.seq ORDER BY matches.rank, expenses.seq LIMIT ? OFFSET ?')
+REBUILD_SEARCH = "INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')"
+CLEAR_ROLLUPS = 'DELETE FROM expense_rollups'
+REBUILD_ROLLUPS = (f'INSERT INTO expense_rollups SELECT category, tag, currency, COUNT(*), TOTAL({AMOUNT_KEY}), '
+                   f'MIN({AMOUNT_KEY}), MAX({AMOUNT_KEY}) FROM expenses GROUP BY category, tag, currency')
+GET_META = 'SELECT value FROM meta WHERE key = ?'
+SET_META = 'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)'
+
+FILTER_COLUMNS = ('tag', 'category', 'currency')
+
+
+def _row_to_dict(row: sqlite3.Row) -> dict:
+    expense = dict(row)
+    expense['attachments'] = json.loads(expense['attachments'])
+    return expense
+
+
+def _expense_params(expense: dict) -> tuple:
+    return (expense['id'], expense.get('name'), expense.get('category'), expense.get('amount'),
+            expense.get('currency'), expense.get('tag'), expense.get('notes'),
+            json.dumps(expense.get('attachments') or []))
+
+
+class ConnectionPool:
+    '''Fixed-size pool of SQLite connections in WAL mode'''
+
+    def __init__(self, db_path: str, size: int):
+        self._connections = queue.Queue()
+        for _ in range(size):
+            connection = sqlite3.connect(db_path, check_same_thread=False, cached_statements=64)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._connections.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self._connections.get()
+        try:
+            yield connection
+        finally:
+            self._connections.put(connection)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+class SqliteExpenseRepository(ExpenseRepository):
+    _instance = None
+
+    def __new__(cls, data_dir: str, pool_size: int = 4, shared: bool = False, purge_bytes_per_s: float = 0):
+        if cls._instance is None:
+            cls._instance = super(SqliteExpenseRepository, cls).__new__(cls)
+            cls._instance.init(data_dir, pool_size, shared, purge_bytes_per_s)
+        return cls._instance
+
+    def init(self, data_dir: str, pool_size: int = 4, shared: bool = False, purge_bytes_per_s: float = 0):
+        '''
+        shared: other processes use data_dir too. SQLite handles that itself, the attachment store needs to know.
+        purge_bytes_per_s: rate at which removed attachment files are unlinked in the background, 0 for no limit.
+        '''
+        self.data_dir = data_dir
+        self.db_file = os.path.join(data_dir, 'expenses.db')
+        self.attachments_dir = os.path.join(data_dir, 'attachments')
+        self.ensure_data_file()
+        self._attachments = AttachmentStore(self.attachments_dir, shared, purge_bytes_per_s)
+        self._pool = ConnectionPool(self.db_file, pool_size)
+        # Queries run here, not on the event loop; as many threads as connections, so no thread waits for one
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='sqlite')
+        with self._pool.connection() as connection:
+            connection.executescript(SCHEMA)
+            self._migrate_versions(connection)
+            self._migrate_search(connection)
+            self._migrate_rollups(connection)
+        self._migrate_file_store()
+
+    def ensure_data_file(self):
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+
+        if not os.path.exists(self.attachments_dir):
+            os.makedirs(self.attachments_dir)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._pool.close()
+        self._attachments.close()
+
+    def cache_stats(self) -> dict:
+        return {"attachments": self._attachments.stats()}
+
+    def _migrate_versions(self, connection: sqlite3.Connection):
+        '''Add the version column to databases created before versions existed'''
+        columns = [row['name'] for row in connection.execute('PRAGMA table_info(expenses)')]
+        if 'version' not in columns:
+            with connection:
+                connection.execute('ALTER TABLE expenses ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        connection.execute('CREATE INDEX IF NOT EXISTS idx_expenses_version ON expenses(version)')
+
+    def _migrate_search(self, connection: sqlite3.Connection):
+        '''Index the expenses of databases created before full-text search existed'''
+        if connection.execute(GET_META, ('search_indexed',)).fetchone():
+            return
+        with connection:
+            connection.execute(REBUILD_SEARCH)
+            connection.execute(SET_META, ('search_indexed', '1'))
+
+    def _migrate_rollups(self, connection: sqlite3.Connection):
+        '''Fill the summary rollups of databases created before they existed'''
+        if connection.execute(GET_META, ('rollups_built',)).fetchone():
+            return
+        with connection:
+            connection.execute(CLEAR_ROLLUPS)
+            connection.execute(REBUILD_ROLLUPS)
+            connection.execute(SET_META, ('rollups_built', '1'))
+
+    @staticmethod
+    def _next_version(connection: sqlite3.Connection) -> int:
+        '''Allocate the version of the current write transaction'''
+        return int(connection.execute(NEXT_VERSION).fetchone()[0])
+
+    @staticmethod
+    def _read_version(connection: sqlite3.Connection) -> int:
+        row = connection.execute(GET_META, ('version',)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _migrate_file_store(self):
+        '''One-shot import of the expenses written by FileExpenseRepository, in any storage mode'''
+        with self._pool.connection() as connection:
+            if connection.execute(GET_META, ('file_store_migrated',)).fetchone():
+                return
+
+            expenses = load_file_store(self.data_dir)
+
+            with connection:
+                # Attachment files stay where they are, only records move
+                connection.executemany(INSERT_OR_IGNORE, (_expense_params(expense) for expense in expenses.values()))
+                connection.execute(SET_META, ('file_store_migrated', '1'))
+            if expenses:
+                logger.info("Migrated %d expenses from the file store into %s", len(expenses), self.db_file)
+
+    def _get_expense(self, connection: sqlite3.Connection, expense_id: str) -> dict:
+        row = connection.execute(SELECT_ONE, (expense_id,)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+        return _row_to_dict(row)
+
+    async def _run_db(self, func, *args):
+        '''Run blocking database or attachment work on the thread pool, one thread per pooled connection'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _select_expenses(self, query: str, params: list, cursor: Optional[str], amount_order: bool) -> List[sqlite3.Row]:
+        with self._pool.connection() as connection, timed('get_expenses', 'filter'):
+            if amount_order and cursor:
+                row = connection.execute(SELECT_AMOUNT_KEY, (cursor,)).fetchone()
+                if row is None:
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                        detail="The cursor expense no longer exists, restart from the first page")
+                params = [row[0], row[0], cursor] + params
+            return connection.execute(query, params).fetchall()
+
+    async def get_expenses(self, tag: Optional[str], category: Optional[str], currency: Optional[str],
+                           cursor: Optional[str] = None, limit: Optional[int] = None,
+                           min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                           order_by: Optional[str] = None) -> List[Expense]:
+        try:
+            filters = {'tag': tag, 'category': category, 'currency': currency}
+            conditions = [f'{column} = ?' for column in FILTER_COLUMNS if filters[column]]
+            params = [filters[column] for column in FILTER_COLUMNS if filters[column]]
+            # Same expression as idx_expenses_amount, so range and order read that index
+            if min_amount is not None:
+                conditions.append(f'{AMOUNT_KEY} >= ?')
+                params.append(min_amount)
+            if max_amount is not None:
+                conditions.append(f'{AMOUNT_KEY} <= ?')
+                params.append(max_amount)
+
+            amount_order = order_by in ('amount', '-amount')
+            if amount_order:
+                direction = 'DESC' if order_by == '-amount' else 'ASC'
+                if cursor:
+                    # Spelled out rather than a row value comparison, which SQLite cannot seek the index with.
+                    # Put first, its parameters (the cursor's amount key) are read with the query.
+                    before, after = ('<=', '<') if direction == 'DESC' else ('>=', '>')
+                    conditions.insert(0, f'{AMOUNT_KEY} {before} ? AND ({AMOUNT_KEY} {after} ? OR id {after} ?)')
+                order = f' ORDER BY {AMOUNT_KEY} {direction}, id {direction}'
+            else:
+                if cursor:
+                    conditions.append('id > ?')
+                    params.append(cursor)
+                ordered = cursor is not None or limit is not None or order_by is not None
+                order = ' ORDER BY id' if ordered else ' ORDER BY seq'
+            query = f'SELECT {COLUMNS} FROM expenses'
+            if conditions:
+                query += ' WHERE ' + ' AND '.join(conditions)
+            query += order
+            if limit:
+                query += ' LIMIT ?'
+                params.append(limit)
+
+            rows = await self._run_db(self._select_expenses, query, params, cursor, amount_order)
+            with timed('get_expenses', 'serialize'):
+                return [Expense(**_row_to_dict(row)) for row in rows]
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _fetch_all(self, operation: str, phase: str, query: str, params=()) -> List[sqlite3.Row]:
+        with self._pool.connection() as connection, timed(operation, phase):
+            return connection.execute(query, params).fetchall()
+
+    async def get_all_expenses(self, cursor: Optional[str] = None, limit: Optional[int] = None) -> List[Expense]:
+        if cursor is not None or limit is not None:
+            return await self.get_expenses(None, None, None, cursor, limit)
+        try:
+            rows = await self._run_db(self._fetch_all, 'get_all_expenses', 'filter', SELECT_ALL)
+            with timed('get_all_expenses', 'serialize'):
+                return [Expense(**_row_to_dict(row)) for row in rows]
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    async def get_summary(self, group_by: List[str]) -> List[dict]:
+        try:
+            # Only whitelisted column names ever reach the query
+            columns = normalize_group_by(group_by)
+            select = ''.join(f'{column}, ' for column in columns)
+            # Merged from the per-group rollups the triggers keep, so a summary costs O(groups), not O(expenses)
+            query = f'SELECT {select}SUM(count), TOTAL(total), MIN(minimum), MAX(maximum) FROM expense_rollups'
+            if columns:
+                query += ' GROUP BY ' + ', '.join(columns) + ' ORDER BY ' + ', '.join(columns)
+
+            rows = await self._run_db(self._fetch_all, 'get_summary', 'aggregate', query)
+            summary = []
+            for row in rows:
+                values = tuple(row)
+                count, total, minimum, maximum = values[len(columns):]
+                if count:
+                    summary.append(dict(zip(columns, values), count=count, sum=total, min=minimum, max=maximum))
+            return summary
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    async def search_expenses(self, query: str, limit: int = 50, offset: int = 0) -> List[Expense]:
+        try:
+            # Every word quoted, so no query text is read as FTS5 syntax, and matched as a prefix
+            terms = ' '.join(f'"{token}"*' for token in dict.fromkeys(tokenize(query)))
+            if not terms:
+                return []
+            rows = await self._run_db(self._fetch_all, 'search_expenses', 'search', SEARCH, (terms, limit, offset))
+            with timed('search_expenses', 'serialize'):
+                return [Expense(**_row_to_dict(row)) for row in rows]
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _current_version(self) -> int:
+        with self._pool.connection() as connection:
+            return self._read_version(connection)
+
+    async def get_version(self) -> int:
+        try:
+            return await self._run_db(self._current_version)
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _select_changes(self, since: int) -> Tuple[int, List[sqlite3.Row], List[sqlite3.Row]]:
+        with self._pool.connection() as connection:
+            version = self._read_version(connection)
+            if since < 0 or since > version:
+                raise changes_gone()
+            # Bounded by version, so a write landing between the queries shows up in the next call
+            rows = connection.execute(SELECT_CHANGED, (since, version)).fetchall()
+            deleted = connection.execute(SELECT_DELETED, (since, version)).fetchall()
+        return version, rows, deleted
+
+    async def get_changes(self, since: int) -> ExpenseChanges:
+        try:
+            version, rows, deleted = await self._run_db(self._select_changes, since)
+            return ExpenseChanges(version=version,
+                                  expenses=[Expense(**_row_to_dict(row)) for row in rows],
+                                  deleted=[row[0] for row in deleted])
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _insert(self, params: tuple):
+        with timed('add_expense', 'write'), self._pool.connection() as connection, connection:
+            connection.execute(INSERT, params + (self._next_version(connection),))
+
+    async def add_expense(self, expense: Expense) -> Expense:
+        try:
+            expense.id = str(uuid.uuid4())
+            await self._run_db(self._insert, _expense_params(expense.dict()))
+            return expense
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _update(self, params: tuple):
+        with timed('update_expense', 'write'), self._pool.connection() as connection, connection:
+            cursor = connection.execute(UPDATE, params[1:] + (self._next_version(connection),) + params[:1])
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+
+    async def update_expense(self, expense_id: str, updated_expense: Expense) -> Expense:
+        try:
+            updated_expense.id = expense_id
+            await self._run_db(self._update, _expense_params(updated_expense.dict()))
+            return updated_expense
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _delete(self, expense_id: str):
+        with timed('delete_expense', 'write'), self._pool.connection() as connection, connection:
+            exp = self._get_expense(connection, expense_id)
+            connection.execute(DELETE, (expense_id,))
+            connection.execute(INSERT_TOMBSTONE, (expense_id, self._next_version(connection)))
+        self._attachments.remove(expense_id, exp['attachments'])
+
+    async def delete_expense(self, expense_id: str) -> dict:
+        try:
+            await self._run_db(self._delete, expense_id)
+
+            return {"status": "Deleted"}
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _apply_batch(self, operations: List[BatchOperation]) -> List[BatchResult]:
+        results = []
+        deleted_attachments = []
+        # One transaction for the whole batch
+        with timed('apply_batch', 'write'), self._pool.connection() as connection, connection:
+            # Every change of the batch shares one version
+            version = self._next_version(connection)
+            for operation in operations:
+                try:
+                    if operation.op == 'delete':
+                        exp = self._get_expense(connection, require_batch_id(operation))
+                        connection.execute(DELETE, (exp['id'],))
+                        connection.execute(INSERT_TOMBSTONE, (exp['id'], version))
+                        deleted_attachments.append((exp['id'], exp['attachments']))
+                        results.append(BatchResult(op=operation.op, status=status.HTTP_200_OK, id=exp['id']))
+                        continue
+
+                    expense = require_batch_expense(operation)
+                    if operation.op == 'create':
+                        expense.id = str(uuid.uuid4())
+                        connection.execute(INSERT, _expense_params(expense.dict()) + (version,))
+                        status_code = status.HTTP_201_CREATED
+                    else:
+                        expense.id = require_batch_id(operation)
+                        params = _expense_params(expense.dict())
+                        if connection.execute(UPDATE, params[1:] + (version,) + params[:1]).rowcount == 0:
+                            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+                        status_code = status.HTTP_200_OK
+                    results.append(BatchResult(op=operation.op, status=status_code, id=expense.id, expense=expense))
+                except HTTPException as e:
+                    results.append(BatchResult(op=operation.op, status=e.status_code, id=operation.id, detail=str(e.detail)))
+
+        for expense_id, attachments in deleted_attachments:
+            self._attachments.remove(expense_id, attachments)
+        return results
+
+    async def apply_batch(self, operations: List[BatchOperation]) -> List[BatchResult]:
+        try:
+            return await self._run_db(self._apply_batch, operations)
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _read_expense(self, expense_id: str) -> dict:
+        with self._pool.connection() as connection:
+            return self._get_expense(connection, expense_id)
+
+    def _save_uploads(self, expense_id: str, files: List[UploadFile]):
+        for file in files:
+            self._attachments.save(expense_id, file.filename, file.file)
+
+    def _list_attachments(self, expense_id: str, file_names: List[str]):
+        with self._pool.connection() as connection, connection:
+            exp = self._get_expense(connection, expense_id)
+            # Re-uploading a name replaces its content, it is not listed twice
+            file_paths = exp['attachments']
+            file_paths += [name for name in dict.fromkeys(file_names) if name not in file_paths]
+            connection.execute(UPDATE_ATTACHMENTS, (json.dumps(file_paths), self._next_version(connection), expense_id))
+
+    async def add_attachment(self, expense_id: str, files: List[UploadFile]) -> dict:
+        file_names = [file.filename for file in files]
+        try:
+            await self._run_db(self._read_expense, expense_id)
+            # Stream the files to disk before the transaction, so uploads never hold up other writers
+            await self._run_db(self._save_uploads, expense_id, files)
+            try:
+                await self._run_db(self._list_attachments, expense_id, file_names)
+            except HTTPException:
+                await self._run_db(self._attachments.remove, expense_id, file_names)
+                raise
+
+            return {"status": "Attachments added"}
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _unlist_attachment(self, expense_id: str, file_name: str):
+        with self._pool.connection() as connection, connection:
+            exp = self._get_expense(connection, expense_id)
+            if file_name not in exp['attachments']:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+
+            attachments = [attachment for attachment in exp['attachments'] if attachment != file_name]
+            connection.execute(UPDATE_ATTACHMENTS, (json.dumps(attachments), self._next_version(connection), expense_id))
+        self._attachments.remove(expense_id, [file_name])
+
+    async def delete_attachment(self, expense_id: str, file_name: str) -> dict:
+        try:
+            await self._run_db(self._unlist_attachment, expense_id, file_name)
+
+            return {"status": "Attachment deleted"}
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    def _attachment_references(self) -> Set[Tuple[str, str]]:
+        with self._pool.connection() as connection:
+            return {(row['id'], file_name) for row in connection.execute(SELECT_ATTACHMENTS)
+                    for file_name in json.loads(row['attachments'])}
+
+    def _sweep(self) -> dict:
+        return self._attachments.sweep(self._attachment_references())
+
+    async def sweep_attachments(self) -> dict:
+        try:
+            return await self._run_db(self._sweep)
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    async def download_attachment(self, expense_id: str, file_name: str) -> Optional[AttachmentFile]:
+        try:
+            exp = await self._run_db(self._read_expense, expense_id)
+
+            if file_name in exp['attachments']:
+                attachment = self._attachments.locate(expense_id, file_name)
+                if attachment:
+                    return attachment
+
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attachment not found")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
@@ -0,0 +1,51 @@
+import os
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class StoreLock:
+    '''
+    Exclusive lock on a store shared by several server worker processes: an
+    flock() on lock_file, which is created if missing. flock() locks belong
+    to the open file, so every StoreLock excludes every other one, in this
+    process or another, and may be released from another thread than the
+    one that acquired it. It does not exclude threads sharing one StoreLock.
+
+    The first 8 bytes of the file hold a counter the holder can read and
+    write, used for the version of the expenses across workers.
+    '''
+
+    def __init__(self, lock_file: str):
+        if fcntl is None:
+            raise RuntimeError("Several worker processes need fcntl.flock(), which this platform does not have")
+        self.lock_file = lock_file
+        self._fd: Optional[int] = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __enter__(self) -> 'StoreLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def read_counter(self) -> int:
+        data = os.pread(self._fd, 8, 0)
+        return int.from_bytes(data, 'little') if len(data) == 8 else 0
+
+    def write_counter(self, value: int):
+        os.pwrite(self._fd, value.to_bytes(8, 'little'), 0)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,48 @@
+import threading
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import analytics
+import config
+import server
+from analytics import ColumnarExpenses
+from fs_expense_repository import FileExpenseRepository
+
+
+def test_snapshot_does_not_follow_later_changes():
+    expenses = [{'id': str(i), 'amount': float(i), 'category': 'Food', 'currency': 'USD', 'tag': None}
+                for i in range(5)]
+    columns = ColumnarExpenses.from_expenses(expenses)
+    snapshot = columns.snapshot()
+    columns.remove(None, expenses[0])
+    columns.add(None, {'id': 'new', 'amount': 99.0, 'category': 'Car', 'currency': 'EUR', 'tag': 'Work'})
+
+    assert np.array_equal(snapshot.amounts, [0.0, 1.0, 2.0, 3.0, 4.0])
+    assert len(set(snapshot.codes('category'))) == 1
+    rates = analytics.DEFAULT_RATES
+    assert analytics.build_report(snapshot, rates) == \
+        analytics.build_report(ColumnarExpenses.from_expenses(expenses), rates)
+
+
+def test_report_is_built_off_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(config, 'BACKEND', 'file')
+    monkeypatch.setattr(server, 'exchange_rates', analytics.RatesFile(str(tmp_path / 'rates.json')))
+    threads = []
+    build_report = analytics.build_report
+
+    def recording_build_report(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return build_report(*args, **kwargs)
+
+    monkeypatch.setattr(analytics, 'build_report', recording_build_report)
+    FileExpenseRepository._instance = None
+    with TestClient(server.app) as client:
+        client.post('/expenses/', json={'name': 'Lunch', 'amount': 12})
+        loop_thread = client.portal.call(threading.current_thread)
+        response = client.get('/expenses/analytics', params={'reporting_currency': 'USD'})
+        assert response.status_code == 200
+        assert response.json()['count'] == 1
+    FileExpenseRepository._instance = None
+    assert threads and all(thread is not loop_thread for thread in threads)
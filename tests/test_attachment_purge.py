@@ -0,0 +1,110 @@
+import glob
+import io
+import os
+
+import attachment_store
+from attachment_store import AttachmentStore
+
+FILES = 120
+SLICE_ENTRIES = 25
+
+
+def open_store(tmp_path, purge_bytes_per_s=0):
+    store = AttachmentStore(str(tmp_path / 'attachments'), purge_bytes_per_s=purge_bytes_per_s)
+    # Slices are run by hand below
+    store._stop.set()
+    store._wake.set()
+    store._purger.join()
+    return store
+
+
+def blobs(tmp_path):
+    return glob.glob(str(tmp_path / 'attachments' / 'blobs' / '*' / '*'))
+
+
+def test_queue_drains_in_bounded_slices_without_the_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(attachment_store, 'PURGE_SLICE_ENTRIES', SLICE_ENTRIES)
+    store = open_store(tmp_path)
+    file_names = [f'scan-{i}.pdf' for i in range(FILES)]
+    for file_name in file_names:
+        store.save('expense', file_name, io.BytesIO(file_name.encode()))
+    store.save('other', 'kept.pdf', io.BytesIO(b'scan-0.pdf'))
+    store.remove('expense', file_names)
+    assert store.pending_removals == FILES - 1
+
+    purge = store._purge
+
+    def unlocked_purge(file_path):
+        assert not store._lock.locked()
+        return purge(file_path)
+
+    monkeypatch.setattr(store, '_purge', unlocked_purge)
+    queue_inode = os.stat(store.removals_file).st_ino
+    queue_size = os.path.getsize(store.removals_file)
+    slices = 0
+    more = True
+    while more:
+        removed_before = store.purged_files
+        _, more = store._purge_slice()
+        slices += 1
+        assert store.purged_files - removed_before <= SLICE_ENTRIES
+        if more:
+            # Consumed entries are marked, the queue itself is only appended to until it drains
+            assert os.stat(store.removals_file).st_ino == queue_inode
+            assert os.path.getsize(store.removals_file) == queue_size
+            assert store.pending_removals == FILES - 1 - slices * SLICE_ENTRIES
+
+    assert slices == -(-(FILES - 1) // SLICE_ENTRIES)
+    assert os.path.getsize(store.removals_file) == 0
+    assert store.pending_removals == 0
+    assert store.purged_files == FILES - 1
+    # Only the blob another expense still references is left, nothing renamed aside lingers
+    assert len(blobs(tmp_path)) == 1
+    assert store.locate('other', 'kept.pdf') is not None
+    assert not glob.glob(str(tmp_path / 'attachments' / 'blobs' / 'purge-*'))
+    store.close()
+
+
+def test_blob_uploaded_again_is_not_removed(tmp_path):
+    store = open_store(tmp_path)
+    store.save('expense', 'scan.pdf', io.BytesIO(b'content'))
+    store.remove('expense', ['scan.pdf'])
+    store.save('expense', 'again.pdf', io.BytesIO(b'content'))
+    assert store._purge_slice() == (0, False)
+    with open(store.locate('expense', 'again.pdf').path, 'rb') as file:
+        assert file.read() == b'content'
+
+    # Entries still queued at a restart are removed after it
+    store.remove('expense', ['again.pdf'])
+    store.close()
+    store = open_store(tmp_path)
+    store._purge_slice()
+    assert blobs(tmp_path) == []
+    assert os.path.getsize(store.removals_file) == 0
+    store.close()
+
+
+def test_sweep_leaves_claimed_files_alone(tmp_path, monkeypatch):
+    store = open_store(tmp_path)
+    store.save('expense', 'scan.pdf', io.BytesIO(b'content'))
+    os.makedirs(tmp_path / 'attachments' / 'legacy')
+    (tmp_path / 'attachments' / 'legacy' / 'old.pdf').write_bytes(b'old')
+    store.remove('expense', ['scan.pdf'])
+    store.remove('legacy', ['old.pdf'])
+
+    # A sweep between claiming the files and unlinking them finds them on disk, but not in the queue
+    swept = []
+    purge = store._purge
+
+    def sweeping_purge(file_path):
+        if not swept:
+            swept.append(store.sweep(set()))
+        return purge(file_path)
+
+    monkeypatch.setattr(store, '_purge', sweeping_purge)
+    store._purge_slice()
+    assert swept == [{'files': 0, 'bytes': 0, 'dropped_refs': 0}]
+    assert store.purged_files == 2
+    assert not store._claimed
+    assert os.path.getsize(store.removals_file) == 0
+    store.close()
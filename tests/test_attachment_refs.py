@@ -0,0 +1,95 @@
+import io
+import json
+import os
+
+import attachment_store
+from attachment_store import AttachmentStore
+
+COMPACT_ENTRIES = 10
+
+
+def open_store(tmp_path, shared=False):
+    store = AttachmentStore(str(tmp_path / 'attachments'), shared=shared)
+    # Nothing to purge here, keep the worker out of the lock
+    store._stop.set()
+    store._wake.set()
+    store._purger.join()
+    return store
+
+
+def journal_lines(store):
+    with open(store.refs_journal_file, 'rb') as file:
+        return file.read().count(b'\n')
+
+
+def test_changes_are_appended_and_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(attachment_store, 'REFS_COMPACT_MIN_ENTRIES', COMPACT_ENTRIES)
+    store = open_store(tmp_path)
+    for i in range(4):
+        store.save(f'expense-{i}', 'scan.pdf', io.BytesIO(f'content {i}'.encode()))
+    store.remove('expense-0', ['scan.pdf'])
+    # One line per change, refs.json is not written until the journal outgrows the refs
+    assert journal_lines(store) == 5
+    assert not os.path.exists(store.refs_file)
+
+    store.close()
+    store = open_store(tmp_path)
+    assert store._refs == {f'expense-{i}/scan.pdf': store.locate(f'expense-{i}', 'scan.pdf').content_hash
+                           for i in range(1, 4)}
+    assert sum(store._refcounts.values()) == 3
+
+    for i in range(4, 9):
+        store.save(f'expense-{i}', 'scan.pdf', io.BytesIO(f'content {i}'.encode()))
+    assert journal_lines(store) == 0
+    with open(store.refs_file) as file:
+        assert json.load(file) == store._refs
+    refs = dict(store._refs)
+
+    store.close()
+    store = open_store(tmp_path)
+    assert store._refs == refs
+    store.close()
+
+
+def test_torn_journal_tail_is_dropped(tmp_path):
+    store = open_store(tmp_path)
+    store.save('expense', 'scan.pdf', io.BytesIO(b'content'))
+    store.close()
+    with open(store.refs_journal_file, 'ab') as file:
+        file.write(b'{"key": "expense/tor')
+
+    store = open_store(tmp_path)
+    assert list(store._refs) == ['expense/scan.pdf']
+    assert journal_lines(store) == 1
+    store.save('expense', 'other.pdf', io.BytesIO(b'other'))
+    store.close()
+    assert sorted(open_store(tmp_path)._refs) == ['expense/other.pdf', 'expense/scan.pdf']
+
+
+def test_shared_stores_replay_each_others_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(attachment_store, 'REFS_COMPACT_MIN_ENTRIES', COMPACT_ENTRIES)
+    writer = open_store(tmp_path, shared=True)
+    reader = open_store(tmp_path, shared=True)
+    loads = []
+    load_refs = reader._load_refs
+    monkeypatch.setattr(reader, '_load_refs', lambda locked=False: loads.append(locked) or load_refs(locked))
+
+    writer.save('expense', 'scan.pdf', io.BytesIO(b'content'))
+    assert reader.locate('expense', 'scan.pdf') is not None
+    writer.remove('expense', ['scan.pdf'])
+    assert reader.locate('expense', 'scan.pdf') is None
+    # Appended lines are replayed, the files are not read again
+    assert loads == []
+
+    for i in range(COMPACT_ENTRIES):
+        writer.save(f'expense-{i}', 'scan.pdf', io.BytesIO(f'content {i}'.encode()))
+    # Compacted at the tenth entry, the last two saves are in the journal again
+    assert os.path.exists(writer.refs_file)
+    assert journal_lines(writer) == 2
+    reader.save('reader', 'scan.pdf', io.BytesIO(b'reader'))
+    assert loads == [True]
+    assert reader._refs == {**writer._refs, 'reader/scan.pdf': reader._refs['reader/scan.pdf']}
+    assert writer.locate('reader', 'scan.pdf') is not None
+    assert sum(reader._refcounts.values()) == COMPACT_ENTRIES + 1
+    writer.close()
+    reader.close()
@@ -0,0 +1,51 @@
+import pytest
+
+from binary_format import (MAGIC, decode_expense, decode_record, encode_expense, encode_record, read_operations,
+                           read_records)
+
+EXPENSES = [
+    {'id': 'a', 'name': 'Lunch', 'category': 'Food', 'amount': 12.5, 'currency': 'USD', 'tag': 'Work',
+     'notes': 'hello', 'attachments': ['a.pdf', 'b.png']},
+    {'id': 'b', 'name': 'Café ☕', 'category': 'Food', 'amount': 3.0, 'currency': 'EUR', 'tag': 'Home',
+     'notes': 'ünïcode notes', 'attachments': ['reçu.pdf']},
+    {'id': 'c', 'name': None, 'category': None, 'amount': None, 'currency': None, 'tag': None,
+     'notes': None, 'attachments': None},
+    {'id': 'd', 'name': '', 'category': 'Food', 'amount': 0.0, 'currency': 'USD', 'tag': 'Work',
+     'notes': '', 'attachments': []},
+    {'id': 'e', 'name': 'Notes only', 'category': 'Food', 'amount': 1.0, 'currency': 'USD', 'tag': 'Work',
+     'notes': 'some notes', 'attachments': []},
+    {'id': 'f', 'name': 'Attachments only', 'category': 'Food', 'amount': 1.0, 'currency': 'USD', 'tag': 'Work',
+     'notes': '', 'attachments': ['', 'x.pdf']},
+]
+
+
+@pytest.mark.parametrize('expense', EXPENSES, ids=[expense['id'] for expense in EXPENSES])
+def test_expense_round_trip(expense):
+    assert decode_expense(encode_expense(expense), 0) == expense
+
+
+@pytest.mark.parametrize('expense', EXPENSES, ids=[expense['id'] for expense in EXPENSES])
+def test_record_round_trip(expense):
+    assert decode_record(encode_record('put', expense), 0)[1] == expense
+
+
+def test_read_records_replays_a_file():
+    buffer = MAGIC + b''.join(encode_record('put', expense) for expense in EXPENSES) + encode_record('delete', 'e')
+    expenses = {}
+    end, records = read_records(buffer, len(MAGIC), expenses)
+    assert (end, records) == (len(buffer), len(EXPENSES) + 1)
+    assert expenses == {expense['id']: expense for expense in EXPENSES if expense['id'] != 'e'}
+    # Decoding the same records again, as compaction does, gives the same expenses back
+    reencoded = MAGIC + b''.join(encode_record('put', expense) for expense in expenses.values())
+    again = {}
+    read_records(reencoded, len(MAGIC), again)
+    assert again == expenses
+
+
+def test_read_operations_stops_at_a_torn_record():
+    records = [encode_record('put', expense) for expense in EXPENSES[:2]] + [encode_record('delete', 'a')]
+    torn = encode_record('put', EXPENSES[2])
+    buffer = b''.join(records) + torn[:-1]
+    end, operations = read_operations(buffer, 0)
+    assert end == len(buffer) - len(torn) + 1
+    assert operations == [('put', EXPENSES[0]), ('put', EXPENSES[1]), ('delete', 'a')]
@@ -0,0 +1,57 @@
+import asyncio
+import json
+import os
+import threading
+
+import file_storage
+from data_model import Expense
+from fs_expense_repository import FileExpenseRepository
+
+SEEDED = 20
+
+
+def test_journal_compaction_is_not_a_change_on_disk(tmp_path, monkeypatch):
+    with open(tmp_path / 'expenses.json', 'w') as file:
+        json.dump([{'id': f'seed-{i}', 'name': f'Seed {i}', 'amount': i} for i in range(SEEDED)], file)
+    FileExpenseRepository._instance = None
+    repository = FileExpenseRepository(str(tmp_path), 'journal')
+    storage = repository._storage
+    # Compact after the very next commit
+    storage.compact_min_entries = 1
+    storage.compact_ratio = 0
+
+    # Ask from another thread, as a read would, whenever compaction syncs the directory after a rename
+    seen = []
+    checkers = []
+    fsync_dir = file_storage._fsync_dir
+
+    def checking_fsync_dir(path):
+        if threading.current_thread() is storage._compaction_thread:
+            checker = threading.Thread(target=lambda: seen.append(storage.changed_on_disk()))
+            checker.start()
+            checkers.append(checker)
+        fsync_dir(path)
+
+    monkeypatch.setattr(file_storage, '_fsync_dir', checking_fsync_dir)
+
+    async def write():
+        await repository.add_expense(Expense(name='Trigger', amount=1))
+        return await repository.get_version()
+
+    async def read(since):
+        return await repository.get_version(), await repository.get_changes(since)
+
+    try:
+        version = asyncio.run(write())
+        storage._compaction_thread.join()
+        for checker in checkers:
+            checker.join()
+        assert seen and not any(seen)
+        assert os.path.getsize(tmp_path / 'expenses.journal') == 0
+
+        version_after, changes = asyncio.run(read(version))
+        assert version_after == version
+        assert changes.expenses == [] and changes.deleted == []
+        assert len(asyncio.run(repository.get_all_expenses())) == SEEDED + 1
+    finally:
+        repository.close()
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import random
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from data_model import Expense
+from file_storage import StagedExpenses, apply_operations
+from fs_expense_repository import FileExpenseRepository
+
+SEEDED = 20
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_staged_expenses_match_applied_operations(seed):
+    rng = random.Random(seed)
+    base = {f'e{i}': {'id': f'e{i}', 'amount': i} for i in range(30)}
+    original = dict(base)
+    staged = StagedExpenses(base)
+    expected = dict(base)
+    for step in range(200):
+        expense_id = f'e{rng.randrange(40)}'
+        operations = [('put', {'id': expense_id, 'amount': step})] if rng.random() < 0.6 else [('delete', expense_id)]
+        staged.stage(operations)
+        apply_operations(expected, operations)
+        assert list(staged.items()) == list(expected.items())
+        assert len(staged) == len(expected)
+        assert all((f'e{i}' in staged) == (f'e{i}' in expected) for i in range(40))
+        assert staged.get(expense_id) == expected.get(expense_id)
+    assert base == original
+
+
+@pytest.mark.parametrize('storage_mode', ['json', 'journal', 'binary'])
+def test_writes_are_visible_only_once_durable(tmp_path, storage_mode):
+    with open(tmp_path / 'expenses.json', 'w') as file:
+        json.dump([{'id': f'seed-{i}', 'name': f'Seed {i}', 'amount': i} for i in range(SEEDED)], file)
+    FileExpenseRepository._instance = None
+    repository = FileExpenseRepository(str(tmp_path), storage_mode)
+    storage = repository._storage
+    commit = storage.commit
+
+    async def run():
+        version = await repository.get_version()
+
+        # Hold the commit until the writes have been checked invisible
+        entered, release = threading.Event(), threading.Event()
+
+        def held_commit(expenses, operations):
+            entered.set()
+            release.wait(10)
+            commit(expenses, operations)
+
+        storage.commit = held_commit
+        writes = asyncio.gather(repository.add_expense(Expense(name='Created', amount=1)),
+                                repository.delete_expense('seed-0'))
+        await asyncio.get_running_loop().run_in_executor(None, entered.wait, 10)
+        assert await repository.get_version() == version
+        assert len(await repository.get_all_expenses()) == SEEDED
+        changes = await repository.get_changes(version)
+        assert changes.expenses == [] and changes.deleted == []
+        release.set()
+        created, _ = await writes
+        durable = await repository.get_version()
+        assert durable > version
+        changes = await repository.get_changes(version)
+        assert [expense.id for expense in changes.expenses] == [created.id] and changes.deleted == ['seed-0']
+
+        # A commit that fails publishes nothing and leaves the version where it was
+        def failed_commit(expenses, operations):
+            raise OSError("No space left on device")
+
+        storage.commit = failed_commit
+        with pytest.raises(HTTPException):
+            await repository.add_expense(Expense(name='Lost', amount=2))
+        storage.commit = commit
+        assert await repository.get_version() == durable
+        assert sorted(expense.name for expense in await repository.get_all_expenses()) == \
+            sorted(['Created'] + [f'Seed {i}' for i in range(1, SEEDED)])
+
+    try:
+        asyncio.run(run())
+    finally:
+        storage.commit = commit
+        repository.close()
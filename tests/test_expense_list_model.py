@@ -0,0 +1,43 @@
+import os
+import random
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+pyqt_client = pytest.importorskip('pyqt_client')
+
+
+def expense(expense_id, name='Expense'):
+    return {'id': expense_id, 'name': name}
+
+
+def assert_consistent(model):
+    ids = [model.data(model.index(row)) for row in range(model.rowCount())]
+    assert [model.expense(row)['id'] for row in range(model.rowCount())] == ids
+    assert model._rows == {expense_id: row for row, expense_id in enumerate(ids)}
+
+
+def test_changes_keep_rows_in_step():
+    rng = random.Random(0)
+    model = pyqt_client.ExpenseListModel()
+    model.append([expense(f'e{i}') for i in range(50)])
+    changed = []
+    model.dataChanged.connect(lambda top_left, bottom_right: changed.append(top_left.row()))
+    listed = [f'e{i}' for i in range(50)]
+
+    for step in range(30):
+        deleted = rng.sample(listed, 2)
+        updated = rng.choice([expense_id for expense_id in listed if expense_id not in deleted])
+        created = f'new{step}'
+        model.apply_changes({'deleted': deleted,
+                             'expenses': [expense(updated, f'Updated {step}'), expense(created)]})
+        listed = [expense_id for expense_id in listed if expense_id not in deleted] + [created]
+
+        assert [model.data(model.index(row)) for row in range(model.rowCount())] == listed
+        assert model.expense(listed.index(updated))['name'] == f'Updated {step}'
+        assert changed[-1] == listed.index(updated)
+        assert_consistent(model)
+
+    model.clear()
+    model.append([expense('again')])
+    assert_consistent(model)
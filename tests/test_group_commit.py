@@ -0,0 +1,62 @@
+import asyncio
+import json
+import os
+from collections import Counter
+
+import pytest
+
+from data_model import Expense
+from fs_expense_repository import FileExpenseRepository
+
+SEEDED = 200
+CREATES = 200
+UPDATES = 100
+DELETES = 100
+
+
+def open_repository(data_dir, storage_mode, shards):
+    FileExpenseRepository._instance = None
+    return FileExpenseRepository(str(data_dir), storage_mode, shards=shards)
+
+
+async def stress(data_dir, storage_mode, shards):
+    repository = open_repository(data_dir, storage_mode, shards)
+    try:
+        return await asyncio.gather(
+            *(repository.add_expense(Expense(name=f'New {i}', amount=i)) for i in range(CREATES)),
+            *(repository.update_expense(f'seed-{i}', Expense(id=f'seed-{i}', name=f'Updated {i}', amount=i))
+              for i in range(UPDATES)),
+            *(repository.delete_expense(f'seed-{i}') for i in range(UPDATES, UPDATES + DELETES)))
+    finally:
+        repository.close()
+
+
+async def reload(data_dir, storage_mode, shards):
+    repository = open_repository(data_dir, storage_mode, shards)
+    try:
+        return [expense.dict() for expense in await repository.get_all_expenses()]
+    finally:
+        repository.close()
+
+
+@pytest.mark.parametrize('shards', [1, 3])
+@pytest.mark.parametrize('storage_mode', ['json', 'journal', 'binary'])
+def test_concurrent_writers_lose_and_duplicate_nothing(tmp_path, storage_mode, shards):
+    seeded = [Expense(id=f'seed-{i}', name=f'Seed {i}', amount=i).dict() for i in range(SEEDED)]
+    with open(os.path.join(tmp_path, 'expenses.json'), 'w') as file:
+        json.dump(seeded, file)
+
+    results = asyncio.run(stress(tmp_path, storage_mode, shards))
+    assert len(results) == CREATES + UPDATES + DELETES
+    created_ids = {expense.id for expense in results[:CREATES]}
+    assert len(created_ids) == CREATES
+
+    expenses = asyncio.run(reload(tmp_path, storage_mode, shards))
+    ids = [expense['id'] for expense in expenses]
+    assert len(ids) == len(set(ids))
+    assert set(ids) == created_ids | {f'seed-{i}' for i in range(UPDATES)} | \
+        {f'seed-{i}' for i in range(UPDATES + DELETES, SEEDED)}
+    names = Counter(expense['name'] for expense in expenses)
+    assert all(names[f'New {i}'] == 1 for i in range(CREATES))
+    assert all(names[f'Updated {i}'] == 1 for i in range(UPDATES))
+    assert not any(names[f'Seed {i}'] for i in range(UPDATES))
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import random
+import uuid
+
+import pytest
+
+from data_model import CATEGORY_LIST_REGULAR, TAG_LIST_REGULAR
+from fs_expense_repository import FileExpenseRepository
+
+RECORDS = 3000
+LIMIT = 25
+# Dense filters are walked along the ordered ids or amounts, the rare currency sorts its few matches
+FILTERS = [
+    {},
+    {'tag': 'Work'},
+    {'tag': 'Work', 'category': 'Car'},
+    {'currency': 'ILS'},
+    {'currency': 'ILS', 'tag': 'Work'},
+    {'min_amount': 100, 'max_amount': 900},
+    {'min_amount': 990},
+    {'category': 'Car', 'min_amount': 0, 'max_amount': 500},
+]
+
+
+def write_expenses(data_dir):
+    rng = random.Random(0)
+    expenses = [{
+        'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        'name': f'Expense {i}',
+        'tag': rng.choice(TAG_LIST_REGULAR + [None]),
+        'category': rng.choice(CATEGORY_LIST_REGULAR),
+        'currency': 'ILS' if rng.random() < 0.02 else 'USD',
+        'amount': rng.choice([None, float(rng.randint(0, 20)), round(rng.uniform(0, 1000), 2)]),
+    } for i in range(RECORDS)]
+    with open(data_dir / 'expenses.json', 'w') as file:
+        json.dump(expenses, file)
+    return expenses
+
+
+def matches(expense, filters):
+    amount = expense['amount'] or 0.0
+    return (all(expense[field] == filters[field] for field in ('tag', 'category', 'currency') if field in filters)
+            and amount >= filters.get('min_amount', -float('inf'))
+            and amount <= filters.get('max_amount', float('inf')))
+
+
+def expected_order(expenses, filters, order_by):
+    selected = [expense for expense in expenses if matches(expense, filters)]
+    if order_by is None:
+        return sorted(selected, key=lambda expense: expense['id'])
+    return sorted(selected, key=lambda expense: (expense['amount'] or 0.0, expense['id']),
+                  reverse=order_by == '-amount')
+
+
+async def read_all_pages(repository, filters, order_by):
+    expense_ids = []
+    cursor = None
+    while True:
+        page = await repository.get_expenses(filters.get('tag'), filters.get('category'), filters.get('currency'),
+                                             cursor=cursor, limit=LIMIT, min_amount=filters.get('min_amount'),
+                                             max_amount=filters.get('max_amount'), order_by=order_by)
+        expense_ids += [expense.id for expense in page]
+        if len(page) < LIMIT:
+            return expense_ids
+        cursor = page[-1].id
+
+
+@pytest.fixture(scope='module')
+def repository(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('paging')
+    expenses = write_expenses(data_dir)
+    FileExpenseRepository._instance = None
+    repository = FileExpenseRepository(str(data_dir))
+    yield repository, expenses
+    repository.close()
+
+
+@pytest.mark.parametrize('order_by', [None, 'amount', '-amount'])
+@pytest.mark.parametrize('filters', FILTERS)
+def test_pages_match_sorted_full_scan(repository, filters, order_by):
+    repository, expenses = repository
+    expected = [expense['id'] for expense in expected_order(expenses, filters, order_by)]
+    assert asyncio.run(read_all_pages(repository, filters, order_by)) == expected
@@ -0,0 +1,31 @@
+import json
+import os
+
+import analytics
+
+
+def write_rates(path, rates, mtime_ns):
+    with open(path, 'w') as file:
+        json.dump(rates, file)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_rates_read_once_until_the_file_changes(tmp_path, monkeypatch):
+    path = tmp_path / 'rates.json'
+    rates_file = analytics.RatesFile(str(path))
+    loads = []
+    load_rates = analytics.load_rates
+    monkeypatch.setattr(analytics, 'load_rates', lambda rates_file: loads.append(rates_file) or load_rates(rates_file))
+
+    assert rates_file.get() == analytics.DEFAULT_RATES
+    write_rates(path, {'EUR': 1.1}, 10 ** 18)
+    assert rates_file.get()['EUR'] == 1.1
+    assert rates_file.get()['EUR'] == 1.1
+    assert len(loads) == 2
+
+    # Same size, only the mtime tells the edit apart
+    write_rates(path, {'EUR': 1.2}, 2 * 10 ** 18)
+    assert rates_file.get()['EUR'] == 1.2
+    os.remove(path)
+    assert rates_file.get() == analytics.DEFAULT_RATES
+    assert len(loads) == 4
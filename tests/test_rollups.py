@@ -0,0 +1,116 @@
+import asyncio
+import random
+import sqlite3
+
+import pytest
+
+from data_model import CATEGORY_LIST_REGULAR, CURRENCY_LIST_REGULAR, TAG_LIST_REGULAR, Expense
+from rollups import GROUPINGS, RollupIndex, compute_summary
+from sqlite_expense_repository import SqliteExpenseRepository
+
+
+def random_expense(rng: random.Random, expense_id: str) -> dict:
+    return {
+        'id': expense_id,
+        'category': rng.choice(CATEGORY_LIST_REGULAR + [None]),
+        'tag': rng.choice(TAG_LIST_REGULAR + [None]),
+        'currency': rng.choice(CURRENCY_LIST_REGULAR + [None]),
+        'amount': rng.choice([None, 0.0, round(rng.uniform(-50, 5000), 2), rng.uniform(0, 1e6)]),
+    }
+
+
+def by_group(rows: list, group_by: list) -> list:
+    # None and '' are both valid values and sort alike in summaries, order them apart here
+    return sorted(rows, key=lambda row: [(row[field] is None, row[field] or '') for field in group_by])
+
+
+def assert_matches_full_scan(summary, expenses: dict):
+    for group_by in GROUPINGS:
+        expected = by_group(compute_summary(expenses.values(), group_by), group_by)
+        actual = by_group(summary(group_by), group_by)
+        assert [{key: value for key, value in row.items() if key != 'sum'} for row in actual] == \
+            [{key: value for key, value in row.items() if key != 'sum'} for row in expected], group_by
+        for actual_row, expected_row in zip(actual, expected):
+            # Incremental += / -= drifts from math.fsum by rounding errors
+            assert actual_row['sum'] == pytest.approx(expected_row['sum'], rel=1e-9, abs=1e-6), group_by
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rollups_match_full_scan_after_random_changes(seed):
+    rng = random.Random(seed)
+    index = RollupIndex()
+    expenses = {}
+    rows = {}
+    next_id = 0
+    for step in range(2000):
+        operation = rng.random()
+        if operation < 0.5 or not expenses:
+            expense_id = str(next_id)
+            next_id += 1
+            expense = random_expense(rng, expense_id)
+            rows[expense_id] = len(rows)
+            expenses[expense_id] = expense
+            index.add(rows[expense_id], expense)
+        elif operation < 0.8:
+            expense_id = rng.choice(list(expenses))
+            index.remove(rows[expense_id], expenses[expense_id])
+            expenses[expense_id] = random_expense(rng, expense_id)
+            index.add(rows[expense_id], expenses[expense_id])
+        else:
+            expense_id = rng.choice(list(expenses))
+            index.remove(rows[expense_id], expenses.pop(expense_id))
+        if step % 250 == 0:
+            assert_matches_full_scan(index.summary, expenses)
+    assert_matches_full_scan(index.summary, expenses)
+
+
+def test_rollups_empty_after_removing_everything():
+    index = RollupIndex()
+    expenses = [random_expense(random.Random(1), str(i)) for i in range(50)]
+    for row, expense in enumerate(expenses):
+        index.add(row, expense)
+    for row, expense in enumerate(expenses):
+        index.remove(row, expense)
+    assert all(index.summary(group_by) == compute_summary([], group_by) for group_by in GROUPINGS)
+
+
+def test_sqlite_rollups_match_full_scan_after_random_changes(tmp_path):
+    rng = random.Random(0)
+    SqliteExpenseRepository._instance = None
+    repository = SqliteExpenseRepository(str(tmp_path), pool_size=2)
+    expenses = {}
+
+    def summary(group_by):
+        return asyncio.run(repository.get_summary(group_by))
+
+    try:
+        for step in range(600):
+            operation = rng.random()
+            if operation < 0.5 or not expenses:
+                expense = asyncio.run(repository.add_expense(Expense(**random_expense(rng, ''))))
+            elif operation < 0.8:
+                expense_id = rng.choice(list(expenses))
+                expense = asyncio.run(repository.update_expense(expense_id, Expense(**random_expense(rng, expense_id))))
+            else:
+                expense_id = rng.choice(list(expenses))
+                asyncio.run(repository.delete_expense(expense_id))
+                del expenses[expense_id]
+                continue
+            expenses[expense.id] = expense.dict()
+            if step % 200 == 0:
+                assert_matches_full_scan(summary, expenses)
+        assert_matches_full_scan(summary, expenses)
+    finally:
+        repository.close()
+
+    # A database from before the rollups existed gets them built on open
+    with sqlite3.connect(tmp_path / 'expenses.db') as connection:
+        connection.execute('DROP TABLE expense_rollups')
+        connection.execute("DELETE FROM meta WHERE key = 'rollups_built'")
+    connection.close()
+    SqliteExpenseRepository._instance = None
+    repository = SqliteExpenseRepository(str(tmp_path), pool_size=2)
+    try:
+        assert_matches_full_scan(summary, expenses)
+    finally:
+        repository.close()
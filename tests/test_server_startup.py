@@ -0,0 +1,23 @@
+import threading
+
+from fastapi.testclient import TestClient
+
+import config
+import server
+from fs_expense_repository import FileExpenseRepository
+
+
+def test_repository_is_built_at_startup_not_at_import(tmp_path, monkeypatch):
+    # Importing the app, as the supervisor of several workers does, builds nothing and starts no threads
+    assert server.expense_repository is None
+    assert not any(thread.name == 'attachment-purger' for thread in threading.enumerate())
+
+    monkeypatch.setattr(config, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(config, 'BACKEND', 'file')
+    FileExpenseRepository._instance = None
+    with TestClient(server.app) as client:
+        assert isinstance(server.expense_repository, FileExpenseRepository)
+        assert client.post('/expenses/', json={'name': 'Lunch', 'amount': 12}).status_code == 201
+        assert [expense['name'] for expense in client.get('/expenses/').json()] == ['Lunch']
+    assert (tmp_path / 'expenses.json').exists()
+    FileExpenseRepository._instance = None
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from data_model import Expense
+from fs_expense_repository import FileExpenseRepository
+
+SEEDED = 20
+
+
+def open_worker(data_dir, storage_mode, shards):
+    '''A repository as one server worker process would open it'''
+    FileExpenseRepository._instance = None
+    return FileExpenseRepository(str(data_dir), storage_mode, shards=shards, shared=True)
+
+
+async def delta_sync_across_workers(data_dir, storage_mode, shards):
+    first = open_worker(data_dir, storage_mode, shards)
+    second = open_worker(data_dir, storage_mode, shards)
+    try:
+        start = await second.get_version()
+        created = await first.add_expense(Expense(name='Created', amount=1))
+        after_create = await first.get_version()
+        await first.update_expense('seed-0', Expense(id='seed-0', name='Updated', amount=2))
+        await first.delete_expense('seed-1')
+
+        changes = await second.get_changes(start)
+        assert {expense.id for expense in changes.expenses} == {created.id, 'seed-0'}
+        assert changes.deleted == ['seed-1']
+        assert changes.version == await first.get_version()
+
+        # A version handed out by the other worker, in the middle of its changes
+        changes = await second.get_changes(after_create)
+        assert 'seed-0' in {expense.id for expense in changes.expenses}
+        assert changes.deleted == ['seed-1']
+        assert [expense.name for expense in changes.expenses if expense.id == 'seed-0'] == ['Updated']
+
+        # Changes that cancel out still move the version forward without losing the log
+        synced = await second.get_version()
+        cancelled = await first.add_expense(Expense(name='Short lived', amount=3))
+        await first.delete_expense(cancelled.id)
+        changes = await second.get_changes(synced)
+        assert not changes.expenses and changes.deleted in ([], [cancelled.id])
+        assert (await second.get_changes(start)).deleted[-1:] in (['seed-1'], [cancelled.id])
+
+        # And the other way around
+        synced = await first.get_version()
+        await second.update_expense('seed-2', Expense(id='seed-2', name='From the second', amount=4))
+        changes = await first.get_changes(synced)
+        assert [expense.name for expense in changes.expenses] == ['From the second']
+        assert await first.get_version() == await second.get_version()
+    finally:
+        first.close()
+        second.close()
+
+
+@pytest.mark.parametrize('storage_mode, shards', [('json', 1), ('journal', 1), ('binary', 1), ('json', 3),
+                                                  ('journal', 3), ('binary', 3)])
+def test_delta_sync_across_workers(tmp_path, storage_mode, shards):
+    with open(os.path.join(tmp_path, 'expenses.json'), 'w') as file:
+        json.dump([Expense(id=f'seed-{i}', name=f'Seed {i}', amount=i).dict() for i in range(SEEDED)], file)
+    asyncio.run(delta_sync_across_workers(tmp_path, storage_mode, shards))
@@ -0,0 +1,64 @@
+import asyncio
+import io
+import threading
+from contextlib import contextmanager
+
+import pytest
+from fastapi import HTTPException, UploadFile
+
+from data_model import Expense
+from sqlite_expense_repository import SqliteExpenseRepository
+
+POOL_SIZE = 4
+
+
+def open_repository(data_dir):
+    SqliteExpenseRepository._instance = None
+    return SqliteExpenseRepository(str(data_dir), pool_size=POOL_SIZE)
+
+
+def test_requests_hold_pooled_connections_at_once(tmp_path):
+    repository = open_repository(tmp_path)
+    pool_connection = repository._pool.connection
+    # Every request waits here until all of them hold a connection: on the event loop it would time out
+    barrier = threading.Barrier(POOL_SIZE, timeout=10)
+
+    @contextmanager
+    def meeting_connection():
+        with pool_connection() as connection:
+            barrier.wait()
+            yield connection
+
+    async def run():
+        repository._pool.connection = meeting_connection
+        try:
+            return await asyncio.gather(*(repository.get_all_expenses() for _ in range(POOL_SIZE)))
+        finally:
+            repository._pool.connection = pool_connection
+
+    try:
+        asyncio.run(repository.add_expense(Expense(name='Lunch', amount=12)))
+        pages = asyncio.run(run())
+        assert [[expense.name for expense in page] for page in pages] == [['Lunch']] * POOL_SIZE
+    finally:
+        repository.close()
+
+
+def test_attachments_saved_outside_the_transaction(tmp_path):
+    repository = open_repository(tmp_path)
+
+    async def run():
+        expense = await repository.add_expense(Expense(name='Scan', amount=1))
+        await repository.add_attachment(expense.id, [UploadFile(io.BytesIO(b'%PDF'), filename='scan.pdf')])
+        with pytest.raises(HTTPException) as missing:
+            await repository.add_attachment('missing', [UploadFile(io.BytesIO(b'%PDF'), filename='lost.pdf')])
+        return expense.id, missing.value.status_code
+
+    try:
+        expense_id, status_code = asyncio.run(run())
+        assert status_code == 404
+        assert asyncio.run(repository.get_all_expenses())[0].attachments == ['scan.pdf']
+        assert repository._attachments.locate(expense_id, 'scan.pdf') is not None
+        assert repository._attachments.locate('missing', 'lost.pdf') is None
+    finally:
+        repository.close()